@@ -0,0 +1,134 @@
+"""Riassunti per la dashboard operatori: una chiamata per riga contro l'endpoint batch.
+
+Su un database usa e getta (eliminato alla fine) vengono create --sessions sessioni con profilo
+e --messages messaggi ciascuna. Per ogni dimensione di pagina si misurano latenza mediana e numero
+di comandi Mongo di SessionService.get_session_summary chiamato per ogni riga (come fa oggi la
+dashboard) e di SessionService.get_session_summaries sull'intera pagina. Serve un MongoDB
+raggiungibile: la latenza dipende dai round trip, che mongomock non simula.
+
+Il benchmark fallisce (exit code 1) se la latenza batch della pagina più grande supera di oltre
+--max-growth volte quella della pagina da una sessione.
+
+Uso (dalla cartella backend):
+    MONGO_URL=mongodb://localhost:27017 python -m benchmarks.bench_batch_summary --sizes 1 10 50 100
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+from services.session_service import SessionService
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def seed(service: SessionService, sessions: int, messages: int) -> List[str]:
+    db = service.db
+    session_ids = [str(uuid.uuid4()) for _ in range(sessions)]
+    start = datetime.utcnow() - timedelta(hours=1)
+    await db.chat_sessions.insert_many([
+        {"id": str(uuid.uuid4()), "session_id": session_id, "start_time": start, "message_count": messages,
+         "current_urgency_level": "low", "status": "active", "created_at": start, "updated_at": start}
+        for session_id in session_ids
+    ])
+    await db.user_profiles.insert_many([
+        {"id": str(uuid.uuid4()), "session_id": session_id, "eta": "40", "sintomo_principale": "mal di testa",
+         "sintomi_associati": ["nausea"], "created_at": start, "updated_at": start}
+        for session_id in session_ids
+    ])
+    await db.messages.insert_many([
+        {"id": str(uuid.uuid4()), "session_id": session_id, "message_type": "user" if i % 2 == 0 else "assistant",
+         "content": "Messaggio di prova " * 10, "urgency_level": None if i % 2 == 0 else "medium",
+         "next_questions": [], "metadata": {}, "timestamp": start + timedelta(seconds=i)}
+        for session_id in session_ids for i in range(messages)
+    ])
+    await service.ensure_indexes()
+    return session_ids
+
+
+async def measure(service: SessionService, counter: CommandCounter, page: List[str], repeat: int) -> Dict:
+    per_row, batch = [], []
+    per_row_commands = batch_commands = 0
+    for _ in range(repeat):
+        counter.count = 0
+        start = time.perf_counter()
+        for session_id in page:
+            await service.get_session_summary(session_id)
+        per_row.append(time.perf_counter() - start)
+        per_row_commands = counter.count
+
+        counter.count = 0
+        start = time.perf_counter()
+        summaries = await service.get_session_summaries(page)
+        batch.append(time.perf_counter() - start)
+        batch_commands = counter.count
+        assert len(summaries) == len(page)
+    return {
+        "per_row_ms": statistics.median(per_row) * 1000,
+        "per_row_commands": per_row_commands,
+        "batch_ms": statistics.median(batch) * 1000,
+        "batch_commands": batch_commands
+    }
+
+
+async def run(args) -> List[Dict]:
+    counter = CommandCounter()
+    client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"), event_listeners=[counter])
+    db = client[f"bench_batch_summary_{uuid.uuid4().hex[:8]}"]
+    service = SessionService(db)
+    try:
+        session_ids = await seed(service, max(args.sizes), args.messages)
+        results = []
+        for size in args.sizes:
+            result = await measure(service, counter, session_ids[:size], args.repeat)
+            result["size"] = size
+            results.append(result)
+        return results
+    finally:
+        await client.drop_database(db.name)
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 50, 100])
+    parser.add_argument("--messages", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-growth", type=float, default=3.0)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print(f"{'pagina':>7} {'per riga ms':>12} {'comandi':>8} {'batch ms':>10} {'comandi':>8}")
+    for result in results:
+        print(f"{result['size']:7} {result['per_row_ms']:12.1f} {result['per_row_commands']:8} "
+              f"{result['batch_ms']:10.1f} {result['batch_commands']:8}")
+
+    growth = results[-1]["batch_ms"] / results[0]["batch_ms"]
+    print(f"crescita latenza batch da {results[0]['size']} a {results[-1]['size']} sessioni: {growth:.2f}x")
+    if growth > args.max_growth:
+        print(f"SUPERATO il limite di {args.max_growth}x")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Confronta i turni/secondo tra /api/chat/message (HTTP) e /api/chat/ws/{session_id}.
+
+Richiede un MongoDB raggiungibile (MONGO_URL, DB_NAME); l'LLM è sostituito da FakeLlmChat.
+
+Uso (dalla cartella backend):
+    python -m benchmarks.bench_chat_transports --turns 200 --latency 0.0
+"""
+import argparse
+import os
+import time
+
+from fastapi.testclient import TestClient
+
+from benchmarks.fake_llm import FakeAIService
+
+
+def _create_session(client: TestClient) -> str:
+    response = client.post("/api/chat/session", json={})
+    response.raise_for_status()
+    session_id = response.json()["session_id"]
+    client.post(f"/api/chat/profile/{session_id}", json={"eta": "35", "sintomo_principale": "mal di testa"})
+    return session_id
+
+
+def bench_http(client: TestClient, turns: int) -> float:
+    session_id = _create_session(client)
+    start = time.perf_counter()
+    for i in range(turns):
+        response = client.post("/api/chat/message", json={"session_id": session_id, "message": f"Ho mal di testa ({i})"})
+        response.raise_for_status()
+    return turns / (time.perf_counter() - start)
+
+
+def bench_websocket(client: TestClient, turns: int) -> float:
+    session_id = _create_session(client)
+    with client.websocket_connect(f"/api/chat/ws/{session_id}") as ws:
+        assert ws.receive_json()["type"] == "context"
+        start = time.perf_counter()
+        for i in range(turns):
+            ws.send_json({"type": "message", "message": f"Ho mal di testa ({i})"})
+            while True:
+                frame = ws.receive_json()
+                if frame["type"] == "assistant_message":
+                    break
+                if frame["type"] == "error":
+                    raise RuntimeError(frame["detail"])
+        elapsed = time.perf_counter() - start
+    return turns / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0, help="latenza simulata dell'LLM in secondi")
+    args = parser.parse_args()
+
+    # Si misura il trasporto, non il rate limit per sessione
+    os.environ["ADMISSION_ENABLED"] = "false"
+    from server import app
+    from routes.chat_routes import get_ai_service
+
+    fake_service = FakeAIService(latency=args.latency)
+    app.dependency_overrides[get_ai_service] = lambda: fake_service
+
+    with TestClient(app) as client:
+        http_rate = bench_http(client, args.turns)
+        ws_rate = bench_websocket(client, args.turns)
+
+    print(f"HTTP      : {http_rate:8.1f} turni/s")
+    print(f"WebSocket : {ws_rate:8.1f} turni/s")
+    print(f"Rapporto  : {ws_rate / http_rate:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Avvio a freddo: profilo degli import e tempo fino alla prima richiesta servita.
+
+Ogni misura gira in un processo nuovo, come un pod appena scalato. Il profilo usa
+`python -X importtime` e somma il tempo per pacchetto di primo livello. La prima
+richiesta è GET /api/health/live su un uvicorn avviato da zero; serve un MongoDB
+raggiungibile (MONGO_URL, DB_NAME) perché gli hook di startup lo usano.
+
+Il riferimento non è versionato: i tempi dipendono dalla macchina, quindi va registrato
+con --update-baseline sull'hardware di destinazione prima di confrontare. Con --baseline
+il benchmark fallisce (exit code 1) se una misura supera quel riferimento oltre la tolleranza.
+
+Uso (dalla cartella backend):
+    python -m benchmarks.bench_cold_start --runs 5 --baseline /tmp/cold_start.json --update-baseline
+    python -m benchmarks.bench_cold_start --runs 5 --baseline /tmp/cold_start.json
+    python -m benchmarks.bench_cold_start --skip-server
+"""
+import argparse
+import json
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def import_profile() -> Tuple[float, List[Tuple[str, float]]]:
+    """Tempo totale di `import server` e tempo proprio sommato per pacchetto di primo livello"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import server"],
+        cwd=BACKEND_DIR, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import server fallito:\n{result.stderr[-2000:]}")
+
+    total = 0.0
+    per_package: Dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        package = name.split(".")[0]
+        per_package[package] = per_package.get(package, 0.0) + int(self_us) / 1e6
+        if name == "server":
+            total = int(cumulative_us) / 1e6
+    ranked = sorted(per_package.items(), key=lambda item: item[1], reverse=True)
+    return total, ranked
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def first_request_seconds(timeout: float) -> float:
+    """Dal lancio di uvicorn alla prima risposta 200 di /api/health/live"""
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}/api/health/live"
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"uvicorn terminato con codice {process.returncode}")
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.02)
+        raise RuntimeError(f"nessuna risposta entro {timeout}s")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def check_regressions(measured: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[str]:
+    failures = []
+    for name, value in measured.items():
+        reference = baseline.get(name)
+        if reference and value > reference * (1 + tolerance):
+            failures.append(f"{name}: {value:.3f}s oltre il riferimento {reference:.3f}s (+{tolerance:.0%})")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=12, help="pacchetti mostrati nel profilo degli import")
+    parser.add_argument("--skip-server", action="store_true", help="misura solo gli import (nessun MongoDB)")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    import_times = []
+    ranked: List[Tuple[str, float]] = []
+    for _ in range(args.runs):
+        total, ranked = import_profile()
+        import_times.append(total)
+    measured = {"import_seconds": statistics.median(import_times)}
+
+    print(f"import server: mediana {measured['import_seconds'] * 1000:.0f} ms su {args.runs} processi")
+    for package, seconds in ranked[:args.top]:
+        print(f"   {package:28} {seconds * 1000:8.1f} ms")
+
+    if not args.skip_server:
+        first_requests = [first_request_seconds(args.timeout) for _ in range(args.runs)]
+        measured["first_request_seconds"] = statistics.median(first_requests)
+        print(f"prima richiesta servita: mediana {measured['first_request_seconds'] * 1000:.0f} ms, "
+              f"max {max(first_requests) * 1000:.0f} ms")
+
+    if args.baseline and args.update_baseline:
+        args.baseline.write_text(json.dumps(measured, indent=2) + "\n")
+        print(f"riferimento aggiornato: {args.baseline}")
+    elif args.baseline and args.baseline.exists():
+        failures = check_regressions(measured, json.loads(args.baseline.read_text()), args.tolerance)
+        if failures:
+            print("REGRESSIONE avvio a freddo:\n   " + "\n   ".join(failures))
+            sys.exit(1)
+        print("avvio a freddo entro il riferimento")
+    elif args.baseline:
+        print(f"riferimento {args.baseline} assente: registrarlo con --update-baseline")
+
+
+if __name__ == "__main__":
+    main()
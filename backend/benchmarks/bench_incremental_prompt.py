@@ -0,0 +1,178 @@
+"""Token in ingresso e latenza per turno: contesto riserializzato contro conversazione incrementale.
+
+Ogni sessione simulata esegue --turns turni come /api/chat/message (salvataggio del messaggio
+utente, generate_response, salvataggio della risposta) su un database usa e getta, prima con il
+contesto ricostruito in un unico messaggio e poi con LLM_INCREMENTAL_CONVERSATIONS (ConversationStore).
+Il modello è finto: registra il prompt completo che l'SDK invierebbe (sistema, messaggi precedenti,
+nuovo messaggio) e ne deriva:
+    - token in ingresso (stima a 4 caratteri per token)
+    - token nuovi: quelli oltre il prefisso in comune con la richiesta precedente della sessione,
+      cioè quelli che la cache dei prefissi del provider non può riutilizzare
+    - latenza del provider modellata: --base-ms + token nuovi * --ms-per-token
+      + token in cache * --ms-per-token * --cached-factor
+Oltre ai turni 2, 10 e 30 viene riportata la media su tutti i turni.
+La latenza misurata include anche le letture Mongo dello store (verifica e ricostruzione).
+Serve un MongoDB raggiungibile (MONGO_URL); il database viene eliminato alla fine.
+
+Uso (dalla cartella backend):
+    MONGO_URL=mongodb://localhost:27017 python -m benchmarks.bench_incremental_prompt --sessions 20 --turns 30
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from models.message import MessageCreate
+from models.user_profile import UserProfile
+from services.ai_service import AIService
+from services.conversation_state import ConversationStore, estimate_tokens
+from services.llm_router import LlmRouter, ModelTier
+from services.session_service import SessionService
+
+REPORTED_TURNS = (2, 10, 30)
+
+MESSAGES = [
+    "Da stamattina ho mal di testa e un po' di nausea, cosa mi consigli?",
+    "Il dolore è soprattutto sulla fronte e peggiora quando mi chino",
+    "Ho preso un paracetamolo due ore fa ma non è cambiato molto",
+    "Non ho febbre, però mi sento stanco e ho dormito poco",
+    "Bevo poca acqua durante il giorno, può dipendere da questo?",
+    "Lavoro molte ore al computer, a volte mi bruciano gli occhi"
+]
+
+REPLY = (
+    "Capisco, grazie per i dettagli. Un mal di testa frontale che peggiora chinandosi può essere legato "
+    "a tensione muscolare, poco sonno o a una congestione dei seni paranasali. Ti consiglio di riposare, "
+    "bere regolarmente acqua e fare pause dallo schermo. Se compaiono febbre alta, rigidità del collo, "
+    "disturbi della vista o il dolore diventa molto intenso, contatta il tuo medico. Da quanti giorni "
+    "hai questi sintomi? Hai notato altri disturbi?"
+)
+
+
+class ModelledChat:
+    """Prompt come lo comporrebbe LlmChat; latenza derivata dai token non in cache"""
+
+    def __init__(self, bench: "BenchAIService", session_id: str, system_message: str,
+                 initial_messages: Optional[List[Dict]]):
+        self.bench = bench
+        self.session_id = session_id
+        self.parts = [f"system:{system_message}"] + [
+            f"{message['role']}:{message['content']}" for message in initial_messages or []
+        ]
+
+    async def send_message(self, user_message) -> str:
+        prompt = "\n".join(self.parts + [f"user:{user_message.text}"])
+        previous = self.bench.last_prompts.get(self.session_id, "")
+        shared = len(os.path.commonprefix([previous, prompt]))
+        self.bench.last_prompts[self.session_id] = prompt
+
+        total_tokens = estimate_tokens(prompt)
+        cached_tokens = shared // 4
+        new_tokens = total_tokens - cached_tokens
+        args = self.bench.args
+        modelled_ms = args.base_ms + new_tokens * args.ms_per_token + cached_tokens * args.ms_per_token * args.cached_factor
+        self.bench.last_call = {"input_tokens": total_tokens, "new_tokens": new_tokens, "modelled_ms": modelled_ms}
+        await asyncio.sleep(modelled_ms / 1000 * args.time_scale)
+        return REPLY
+
+
+class BenchAIService(AIService):
+    def __init__(self, args, conversation_store: Optional[ConversationStore]):
+        os.environ.setdefault("GEMINI_API_KEY", "fake-key")
+        super().__init__(router=LlmRouter(hedging_enabled=False), conversation_store=conversation_store)
+        self.args = args
+        self.similarity_cache = None
+        self.last_prompts: Dict[str, str] = {}
+        self.last_call: Dict = {}
+
+    def _lookup_faq(self, user_message, conversation_history):
+        # Ogni turno deve arrivare al modello
+        return None
+
+    async def create_chat_session(self, session_id: str, tier: Optional[ModelTier] = None,
+                                  system_message: Optional[str] = None, initial_messages: Optional[list] = None):
+        return ModelledChat(self, session_id, system_message or self.system_prompt, initial_messages)
+
+
+async def run_session(service: SessionService, ai_service: BenchAIService, turns: int) -> Dict[int, Dict]:
+    session_id = str(uuid.uuid4())
+    profile = UserProfile(session_id=session_id, eta="42", genere="F", sintomo_principale="mal di testa",
+                          durata="1 giorno", intensita=[6], sintomi_associati=["nausea"])
+    results = {}
+    for turn in range(1, turns + 1):
+        message = f"{MESSAGES[(turn - 1) % len(MESSAGES)]} (turno {turn})"
+        await service.save_message(session_id, MessageCreate(content=message, message_type="user"))
+        # Ultimi 10 messaggi, come la cronologia mantenuta dal canale WebSocket
+        history = (await service.get_conversation_history(session_id, limit=turns * 2 + 1))[-10:]
+        start = time.perf_counter()
+        reply, urgency, next_questions = await ai_service.generate_response(session_id, message, profile, history)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        await service.save_message(session_id, MessageCreate(content=reply, message_type="assistant"),
+                                   urgency_level=urgency, next_questions=next_questions)
+        results[turn] = dict(ai_service.last_call, measured_ms=elapsed_ms)
+    return results
+
+
+async def run_mode(db, args, incremental: bool) -> Dict[int, Dict]:
+    store = ConversationStore(db, max_messages=args.window_max, keep_messages=args.window_keep) if incremental else None
+    ai_service = BenchAIService(args, store)
+    service = SessionService(db)
+    per_session = []
+    for _ in range(args.sessions):
+        per_session.append(await run_session(service, ai_service, args.turns))
+
+    summary = {}
+    for turn in REPORTED_TURNS:
+        rows = [results[turn] for results in per_session if turn in results]
+        if rows:
+            summary[turn] = {key: statistics.median(row[key] for row in rows) for key in rows[0]}
+    # Media su tutti i turni: i singoli turni dipendono dalla fase di scorrimento della finestra
+    rows = [row for results in per_session for row in results.values()]
+    summary["media"] = {key: statistics.mean(row[key] for row in rows) for key in rows[0]}
+    return summary
+
+
+async def run(args) -> Dict[str, Dict[int, Dict]]:
+    client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    db = client[f"bench_incremental_{uuid.uuid4().hex[:8]}"]
+    try:
+        await SessionService(db).ensure_indexes()
+        return {
+            "riserializzato": await run_mode(db, args, incremental=False),
+            "incrementale": await run_mode(db, args, incremental=True)
+        }
+    finally:
+        await client.drop_database(db.name)
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--window-max", type=int, default=12)
+    parser.add_argument("--window-keep", type=int, default=4)
+    parser.add_argument("--base-ms", type=float, default=400.0)
+    parser.add_argument("--ms-per-token", type=float, default=0.2)
+    parser.add_argument("--cached-factor", type=float, default=0.25)
+    parser.add_argument("--time-scale", type=float, default=0.0,
+                        help="Frazione della latenza modellata attesa davvero (0: nessuna attesa)")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print(f"{'turno':>5} {'modalità':>15} {'token input':>12} {'token nuovi':>12} {'provider ms':>12} {'misurata ms':>12}")
+    for turn in REPORTED_TURNS + ("media",):
+        for mode, summary in results.items():
+            row = summary.get(turn)
+            if row:
+                print(f"{turn:>5} {mode:>15} {row['input_tokens']:12.0f} {row['new_tokens']:12.0f} "
+                      f"{row['modelled_ms']:12.1f} {row['measured_ms']:12.1f}")
+
+
+if __name__ == "__main__":
+    main()
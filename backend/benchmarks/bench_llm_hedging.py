@@ -0,0 +1,53 @@
+"""Effetto dell'hedging sulla coda delle latenze LLM, con provider finti che iniettano ritardi.
+
+Uso (dalla cartella backend):
+    python -m benchmarks.bench_llm_hedging --calls 400 --slow-probability 0.05
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.fake_llm import FakeAIService, FakeLlmChat
+from services.llm_router import LlmRouter
+from services.metrics import Histogram
+
+
+async def run(hedging: bool, args) -> Histogram:
+    router = LlmRouter(hedging_enabled=hedging, hedge_default_delay=args.hedge_delay, hedge_min_samples=20)
+    chat = FakeLlmChat(latency=args.latency, jitter=args.jitter,
+                       slow_probability=args.slow_probability, slow_latency=args.slow_latency)
+    service = FakeAIService(router=router, tier_chats={name: chat for name in router.tiers})
+
+    latencies = Histogram(window=args.calls)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one_call(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await service.generate_response(f"bench-{i}", "Ho mal di testa da due giorni e un po' di febbre")
+            latencies.observe(time.perf_counter() - start)
+
+    await asyncio.gather(*(one_call(i) for i in range(args.calls)))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--slow-probability", type=float, default=0.05)
+    parser.add_argument("--slow-latency", type=float, default=1.0)
+    parser.add_argument("--hedge-delay", type=float, default=0.2, help="ritardo iniziale prima del percentile osservato")
+    args = parser.parse_args()
+
+    for hedging in (False, True):
+        stats = asyncio.run(run(hedging, args)).snapshot()
+        label = "con hedging " if hedging else "senza hedging"
+        print(f"{label}: p50={stats['p50'] * 1000:7.1f} ms  p95={stats['p95'] * 1000:7.1f} ms  "
+              f"p99={stats['p99'] * 1000:7.1f} ms  max={stats['max'] * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
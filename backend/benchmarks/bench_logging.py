@@ -0,0 +1,101 @@
+"""Impatto del logging sul lag dell'event loop ad alto numero di richieste.
+
+Confronta il vecchio handler sincrono (basicConfig su stderr) con la pipeline a coda di
+services.logging_config. Lo stderr lento (pipe piena, collector in ritardo) è simulato con
+uno stream che blocca per --write-delay secondi ad ogni scrittura.
+
+Uso (dalla cartella backend):
+    python -m benchmarks.bench_logging --rate 2000 --duration 3 --write-delay 0.0002
+"""
+import argparse
+import asyncio
+import io
+import logging
+import time
+
+from services.logging_config import configure_logging, request_id_var, shutdown_logging, TEXT_FORMAT
+from services.metrics import Histogram
+
+logger = logging.getLogger("benchmarks.requests")
+
+
+class SlowStream(io.TextIOBase):
+    """Stream che scarta i dati ma blocca il thread chiamante ad ogni write"""
+
+    def __init__(self, write_delay: float):
+        self.write_delay = write_delay
+        self.writes = 0
+
+    def write(self, data: str) -> int:
+        self.writes += 1
+        if self.write_delay:
+            time.sleep(self.write_delay)
+        return len(data)
+
+
+def setup_sync(stream: SlowStream):
+    shutdown_logging()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(TEXT_FORMAT.replace(" [%(request_id)s]", "")))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+
+
+async def handle_request(i: int):
+    request_id_var.set(f"bench-{i}")
+    logger.info("Sessione creata: %s", f"session-{i}")
+    await asyncio.sleep(0)
+    logger.info("Profilo utente creato per sessione: %s", f"session-{i}")
+
+
+async def measure_lag(stop: asyncio.Event, lag: Histogram, interval: float = 0.005):
+    while not stop.is_set():
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        lag.observe(max(0.0, time.perf_counter() - expected))
+
+
+async def run(rate: int, duration: float) -> Histogram:
+    lag = Histogram(window=100_000)
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(measure_lag(stop, lag))
+    tasks = []
+    start = time.perf_counter()
+    sent = 0
+    # Le richieste arrivano a scaglioni di 10 ms per mantenere il tasso indicato
+    while time.perf_counter() - start < duration:
+        due = int((time.perf_counter() - start) * rate)
+        for i in range(sent, due):
+            tasks.append(asyncio.create_task(handle_request(i)))
+        sent = due
+        await asyncio.sleep(0.01)
+    await asyncio.gather(*tasks)
+    stop.set()
+    await monitor
+    return lag
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=int, default=2000, help="richieste al secondo")
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--write-delay", type=float, default=0.0002, help="blocco per ogni scrittura su stderr")
+    args = parser.parse_args()
+
+    for mode in ("sync", "queue"):
+        stream = SlowStream(args.write_delay)
+        if mode == "sync":
+            setup_sync(stream)
+        else:
+            configure_logging(stream=stream)
+        stats = asyncio.run(run(args.rate, args.duration)).snapshot()
+        shutdown_logging()
+        print(f"{mode:5}: lag loop p50={stats['p50'] * 1000:6.2f} ms  p99={stats['p99'] * 1000:7.2f} ms  "
+              f"max={stats['max'] * 1000:7.2f} ms  scritture={stream.writes}")
+
+
+if __name__ == "__main__":
+    main()
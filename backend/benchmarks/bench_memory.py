@@ -0,0 +1,117 @@
+"""Memoria trattenuta dal processo per ogni 1000 sessioni attive, misurata con tracemalloc.
+
+Ogni sessione simulata esegue --turns turni attraverso gli stessi strati in-process di
+/api/chat/message (rate limit dell'admission, lock di sessione, AIService con LLM finto e
+cronologia di Message). Dopo il garbage collector si misura la memoria ancora allocata rispetto
+allo stato iniziale: è lo stato per sessione che resta nel worker. Il confronto con il totale
+stimato dal registro di services.memory_budget mostra quanto è accurata la stima deep-size.
+
+Il benchmark fallisce (exit code 1) se il valore supera --max-mb-per-1k.
+
+Uso (dalla cartella backend):
+    python -m benchmarks.bench_memory --sessions 5000 --turns 3 --max-mb-per-1k 2
+"""
+import argparse
+import asyncio
+import gc
+import sys
+import tracemalloc
+import uuid
+
+from benchmarks.fake_llm import FakeAIService
+from models.message import Message
+from models.user_profile import UserProfile
+from services.admission import AdmissionController
+from services.memory_budget import memory
+from services.turn_coordinator import TurnCoordinator
+
+MESSAGES = [
+    "Ho mal di testa da due giorni",
+    "Ho la febbre a 38 e un po' di tosse",
+    "Cosa posso prendere per il mal di gola?",
+    "Da ieri ho nausea dopo i pasti"
+]
+
+
+async def run_session(session_id: str, client_ip: str, turns: int, admission: AdmissionController,
+                      coordinator: TurnCoordinator, ai_service: FakeAIService):
+    profile = UserProfile(session_id=session_id, eta="35", sintomo_principale="mal di testa")
+    history = []
+    for turn in range(turns):
+        message = MESSAGES[turn % len(MESSAGES)]
+        admission.check_rate(client_ip, session_id)
+        async with coordinator.session_lock(session_id):
+            async with admission.slot():
+                response, urgency, _ = await ai_service.generate_response(session_id, message, profile, history)
+        history.append(Message(session_id=session_id, content=message, message_type="user"))
+        history.append(Message(session_id=session_id, content=response, message_type="assistant", urgency_level=urgency))
+
+
+async def measure(sessions: int, turns: int, concurrency: int) -> dict:
+    admission = AdmissionController(max_concurrency=concurrency, max_queue=sessions, ip_burst=1e9, session_burst=1e9,
+                                    max_tracked_keys=sessions * 2)
+    coordinator = TurnCoordinator()
+    ai_service = FakeAIService()
+    session_ids = [str(uuid.uuid4()) for _ in range(sessions)]
+
+    # Prima sessione fuori misura: import pigri, cache di pydantic e del tokenizer
+    await run_session(str(uuid.uuid4()), "10.255.255.255", turns, admission, coordinator, ai_service)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    accounted_before = memory.report()["accounted_bytes"]
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(index: int, session_id: str):
+        async with semaphore:
+            client_ip = f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}"
+            await run_session(session_id, client_ip, turns, admission, coordinator, ai_service)
+
+    await asyncio.gather(*(bounded(index, session_id) for index, session_id in enumerate(session_ids)))
+    del session_ids
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, "filename")
+    retained = sum(stat.size_diff for stat in stats)
+    report = memory.report()
+    return {
+        "retained_bytes": retained,
+        "accounted_bytes": report["accounted_bytes"] - accounted_before,
+        "structures": report["structures"],
+        "top": [(stat.traceback[0].filename, stat.size_diff) for stat in stats[:5]]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=5000)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--max-mb-per-1k", type=float, default=2.0)
+    args = parser.parse_args()
+
+    result = asyncio.run(measure(args.sessions, args.turns, args.concurrency))
+    mb_per_1k = result["retained_bytes"] / 1024 / 1024 * 1000 / args.sessions
+    accounted_per_1k = result["accounted_bytes"] / 1024 / 1024 * 1000 / args.sessions
+
+    print(f"sessioni attive: {args.sessions}, turni per sessione: {args.turns}")
+    print(f"memoria trattenuta (tracemalloc): {mb_per_1k:.3f} MB ogni 1000 sessioni")
+    print(f"memoria stimata dal registro:     {accounted_per_1k:.3f} MB ogni 1000 sessioni")
+    for name, usage in result["structures"].items():
+        budget = f"{usage['budget_bytes'] / 1024 / 1024:.1f} MB" if usage["budget_bytes"] else "-"
+        print(f"   {name:28} {usage['bytes'] / 1024:10.1f} KB  voci={usage['entries']:7}  budget={budget}")
+    print("allocazioni trattenute per file:")
+    for filename, size in result["top"]:
+        print(f"   {size / 1024:10.1f} KB  {filename}")
+
+    if mb_per_1k > args.max_mb_per_1k:
+        print(f"SUPERATO il limite di {args.max_mb_per_1k} MB ogni 1000 sessioni")
+        sys.exit(1)
+    print(f"entro il limite di {args.max_mb_per_1k} MB ogni 1000 sessioni")
+
+
+if __name__ == "__main__":
+    main()
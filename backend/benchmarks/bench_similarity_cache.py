@@ -0,0 +1,98 @@
+"""Hit rate e latenza di lookup della cache per similarità con molte voci.
+
+Le domande sintetiche sono combinazioni casuali di parole da un vocabolario fisso; le parafrasi
+rimescolano l'ordine, aggiungono parole funzionali e a volte un termine in più, le domande
+nuove usano parole mai inserite. Si misurano hit rate sulle parafrasi, falsi hit sulle domande
+nuove e sulle varianti con numero diverso, latenza di put/get e memoria delle strutture.
+
+Uso (dalla cartella backend):
+    python -m benchmarks.bench_similarity_cache --entries 1000000 --queries 20000
+"""
+import argparse
+import random
+import string
+import time
+
+from services.metrics import Histogram
+from services.similarity_cache import SimilarityCache
+
+FILLERS = ["ho", "da", "un", "di", "il", "mi", "che", "per"]
+
+
+def make_vocabulary(rng: random.Random, size: int) -> list:
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(5, 9))))
+    return sorted(words)
+
+
+def make_question(rng: random.Random, vocabulary: list) -> list:
+    return rng.sample(vocabulary, rng.randint(4, 7))
+
+
+def paraphrase(rng: random.Random, words: list, vocabulary: list) -> str:
+    variant = list(words)
+    rng.shuffle(variant)
+    variant.insert(rng.randrange(len(variant) + 1), rng.choice(FILLERS))
+    if rng.random() < 0.3:
+        variant.append(rng.choice(vocabulary))
+    return " ".join(variant)
+
+
+def measure(cache: SimilarityCache, queries: list) -> tuple:
+    latencies = Histogram(window=len(queries))
+    hits = 0
+    for query in queries:
+        start = time.perf_counter()
+        hit = cache.get(query)
+        latencies.observe(time.perf_counter() - start)
+        hits += hit is not None
+    return hits / len(queries), latencies.snapshot()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=20_000)
+    parser.add_argument("--vocabulary", type=int, default=50_000)
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng, args.vocabulary)
+    # Metà del vocabolario resta fuori dalla cache per generare domande davvero nuove
+    stored_vocabulary, unseen_vocabulary = vocabulary[::2], vocabulary[1::2]
+
+    cache = SimilarityCache(capacity=args.entries, threshold=args.threshold)
+    questions = [make_question(rng, stored_vocabulary) for _ in range(args.entries)]
+
+    put_latencies = Histogram(window=args.entries)
+    start = time.perf_counter()
+    for words in questions:
+        put_start = time.perf_counter()
+        cache.put(" ".join(words), "risposta", "low", [])
+        put_latencies.observe(time.perf_counter() - put_start)
+    fill_seconds = time.perf_counter() - start
+
+    sample = rng.sample(questions, min(args.queries, len(questions)))
+    workloads = {
+        "parafrasi": [paraphrase(rng, words, stored_vocabulary) for words in sample],
+        "domande nuove": [" ".join(make_question(rng, unseen_vocabulary)) for _ in sample],
+        "numero diverso": [" ".join(words) + f" {rng.randint(1, 99)}" for words in sample]
+    }
+
+    memory = sum(array.nbytes for array in (
+        cache._signatures, cache._guards, cache._stored_at, cache._referenced, cache._band_keys, cache._band_slots
+    ))
+    put_stats = put_latencies.snapshot()
+    print(f"{len(cache)} voci inserite in {fill_seconds:.1f}s (put p50={put_stats['p50'] * 1e6:.0f} us, "
+          f"p99={put_stats['p99'] * 1e6:.0f} us); strutture numpy {memory / 2 ** 20:.0f} MB")
+    for name, queries in workloads.items():
+        hit_rate, stats = measure(cache, queries)
+        print(f"{name:15}: hit rate {hit_rate:6.1%}  get p50={stats['p50'] * 1e6:6.0f} us  "
+              f"p95={stats['p95'] * 1e6:6.0f} us  p99={stats['p99'] * 1e6:6.0f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Latenza della risposta con e senza speculazione sulle domande suggerite, con LLM finto.
+
+Ogni sessione simulata esegue --turns turni: dopo ogni risposta l'utente attende --think-time
+secondi e con probabilità --tap-rate tocca una delle domande suggerite, altrimenti scrive un
+messaggio libero (che annulla le speculazioni). Oltre alla latenza per tipo di turno vengono
+riportati hit rate, quota di token sprecati e chiamate LLM totali, cioè il costo della speculazione.
+
+Uso (dalla cartella backend):
+    python -m benchmarks.bench_speculation --sessions 50 --turns 6 --tap-rate 0.5
+"""
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from typing import Optional
+
+from benchmarks.fake_llm import FakeAIService, FakeLlmChat
+from services.llm_router import LlmRouter
+from services.metrics import Histogram, metrics
+from services.speculation import SpeculativeResponder
+
+FREE_TEXT = [
+    "Ho mal di testa da due giorni e un po' di febbre",
+    "Adesso mi fa male anche la gola quando deglutisco",
+    "Ho preso un antidolorifico ma non è cambiato molto"
+]
+
+
+async def run_session(service: FakeAIService, responder: Optional[SpeculativeResponder], args,
+                      latencies: dict, rng: random.Random):
+    session_id = str(uuid.uuid4())
+    questions = []
+    for turn in range(args.turns):
+        tapped = bool(questions) and rng.random() < args.tap_rate
+        message = rng.choice(questions) if tapped else rng.choice(FREE_TEXT)
+        start = time.perf_counter()
+        reply = await responder.take(session_id, message, f"{session_id}-{turn}") if responder else None
+        if reply is None:
+            reply = await service.generate_response(session_id, message)
+        latencies["tap" if tapped else "libero"].observe(time.perf_counter() - start)
+
+        questions = reply[2]
+        if responder:
+            responder.schedule(service, session_id, f"{session_id}-{turn + 1}", questions, None, [])
+        await asyncio.sleep(args.think_time * rng.uniform(0.5, 1.5))
+
+
+async def run(speculation: bool, args) -> dict:
+    router = LlmRouter(hedging_enabled=False)
+    chat = FakeLlmChat(latency=args.latency, jitter=args.jitter)
+    service = FakeAIService(router=router, tier_chats={name: chat for name in router.tiers})
+    service.faq_resolver = None
+    responder = SpeculativeResponder(max_inflight=args.max_inflight, session_token_budget=args.session_budget,
+                                     global_tokens_per_minute=args.tokens_per_minute) if speculation else None
+    latencies = {"tap": Histogram(window=100_000), "libero": Histogram(window=100_000)}
+    rng = random.Random(args.seed)
+
+    await asyncio.gather(*(run_session(service, responder, args, latencies, rng) for _ in range(args.sessions)))
+    result = {"latencies": latencies, "llm_calls": chat.calls}
+    if responder:
+        await responder.close()
+        result["hit_rate"] = responder.hit_rate()
+        result["wasted_token_ratio"] = responder.wasted_token_ratio()
+        counters = metrics.snapshot()["counters"]
+        result["skipped"] = {name.rsplit(".", 1)[1]: value for name, value in counters.items()
+                             if name.startswith("speculation.skipped.")}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--tap-rate", type=float, default=0.5)
+    parser.add_argument("--think-time", type=float, default=0.5)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--max-inflight", type=int, default=16)
+    parser.add_argument("--session-budget", type=int, default=8000)
+    parser.add_argument("--tokens-per-minute", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    for speculation in (False, True):
+        result = asyncio.run(run(speculation, args))
+        label = "con speculazione " if speculation else "senza speculazione"
+        for kind, histogram in result["latencies"].items():
+            stats = histogram.snapshot()
+            if stats["count"]:
+                print(f"{label} {kind:>6}: n={stats['count']:4}  p50={stats['p50'] * 1000:7.1f} ms  "
+                      f"p95={stats['p95'] * 1000:7.1f} ms")
+        line = f"{label} chiamate LLM: {result['llm_calls']}"
+        if speculation:
+            line += (f"  hit rate: {result['hit_rate']:.2f}  token sprecati: {result['wasted_token_ratio']:.2f}"
+                     f"  saltate: {result['skipped'] or 0}")
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
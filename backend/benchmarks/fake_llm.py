@@ -0,0 +1,56 @@
+"""LLM finto per benchmark e replay: nessuna chiamata di rete, latenza configurabile."""
+import asyncio
+import os
+import random
+from typing import Dict, Optional
+
+from services.ai_service import AIService
+from services.llm_router import LlmRouter, ModelTier
+
+DEFAULT_REPLY = (
+    "Capisco la tua preoccupazione. Ti consiglio di riposare, bere molta acqua "
+    "e monitorare i sintomi. Se peggiorano o persistono, contatta il tuo medico."
+)
+
+
+class FakeLlmChat:
+    """Sostituto di LlmChat con la stessa interfaccia send_message.
+
+    Con slow_probability > 0 una parte delle chiamate dura slow_latency secondi,
+    per riprodurre la coda lunga delle latenze upstream.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, reply: str = DEFAULT_REPLY,
+                 slow_probability: float = 0.0, slow_latency: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.reply = reply
+        self.slow_probability = slow_probability
+        self.slow_latency = slow_latency
+        self.calls = 0
+
+    async def send_message(self, user_message) -> str:
+        self.calls += 1
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if self.slow_probability and random.random() < self.slow_probability:
+            delay = self.slow_latency
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self.reply
+
+
+class FakeAIService(AIService):
+    """AIService che usa FakeLlmChat invece di Gemini; tier_chats permette latenze diverse per tier"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, reply: Optional[str] = None,
+                 router: Optional[LlmRouter] = None, tier_chats: Optional[Dict[str, FakeLlmChat]] = None):
+        os.environ.setdefault("GEMINI_API_KEY", "fake-key")
+        super().__init__(router=router)
+        self.fake_chat = FakeLlmChat(latency=latency, jitter=jitter, reply=reply or DEFAULT_REPLY)
+        self.tier_chats = tier_chats or {}
+
+    async def create_chat_session(self, session_id: str, tier: Optional[ModelTier] = None,
+                                  system_message: Optional[str] = None, initial_messages: Optional[list] = None):
+        if tier and tier.name in self.tier_chats:
+            return self.tier_chats[tier.name]
+        return self.fake_chat
@@ -0,0 +1,309 @@
+"""Replay deterministico del traffico catturato (services/traffic_capture.py) per test di regressione.
+
+Ogni sessione catturata viene rigiocata nell'ordine originale e con gli stessi intervalli
+(divisi per --speed); le sessioni girano in parallelo come in produzione. L'LLM è sostituito
+da un finto che risponde con le latenze registrate per quel turno: hedging e admission vedono
+la stessa coda lunga della cattura. Le latenze LLM non sono accelerate, salvo --scale-llm.
+
+Le operazioni Mongo sono contate con un CommandListener di pymongo, per comando. Il risultato
+(percentili per endpoint, operazioni Mongo) va in un file JSON; "diff" confronta due risultati,
+ad esempio prima e dopo una modifica:
+
+Uso (dalla cartella backend, con MONGO_URL e DB_NAME di un database di test):
+    TRAFFIC_CAPTURE_ENABLED=true TRAFFIC_CAPTURE_PATH=traffic.ndjson.gz uvicorn server:app   # cattura
+    python -m benchmarks.replay_traffic run traffic.ndjson.gz --speed 4 --output build_a.json
+    git checkout feature && python -m benchmarks.replay_traffic run traffic.ndjson.gz --speed 4 --output build_b.json
+    python -m benchmarks.replay_traffic diff build_a.json build_b.json
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import statistics
+import sys
+import time
+from collections import deque
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+# Comandi di servizio del driver, non generati dalle richieste
+_IGNORED_COMMANDS = {"ping", "hello", "ismaster", "isMaster", "endSessions", "buildInfo"}
+
+
+class MongoOpCounter(monitoring.CommandListener):
+    """Conteggio e durata dei comandi Mongo inviati dal processo"""
+
+    def __init__(self):
+        self.ops: Dict[str, Dict[str, float]] = {}
+        self.enabled = False
+
+    def _observe(self, event, failed: bool):
+        if not self.enabled or event.command_name in _IGNORED_COMMANDS:
+            return
+        stats = self.ops.setdefault(event.command_name, {"count": 0, "failed": 0, "seconds": 0.0})
+        stats["count"] += 1
+        stats["failed"] += int(failed)
+        stats["seconds"] += event.duration_micros / 1e6
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._observe(event, failed=False)
+
+    def failed(self, event):
+        self._observe(event, failed=True)
+
+
+def load_capture(path: Path) -> Tuple[Dict, List[Dict]]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        if header.get("format") != "medagent-traffic":
+            raise SystemExit(f"{path}: non è un file di cattura del traffico")
+        events = [json.loads(line) for line in f if line.strip()]
+    return header, events
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    return {"count": len(ordered), "p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": ordered[-1]}
+
+
+def _fake_service_factory():
+    from benchmarks.fake_llm import FakeAIService, FakeLlmChat
+
+    class RecordedLatencyChat(FakeLlmChat):
+        def __init__(self, service: "ReplayAIService", session_id: str, tier: str):
+            super().__init__()
+            self.service = service
+            self.session_id = session_id
+            self.tier = tier
+
+        async def send_message(self, user_message) -> str:
+            self.calls += 1
+            self.service.calls += 1
+            await asyncio.sleep(self.service.next_latency(self.session_id, self.tier))
+            return self.reply
+
+    class ReplayAIService(FakeAIService):
+        """Latenze LLM prese, in ordine, da quelle registrate per il turno in corso della sessione"""
+
+        def __init__(self, llm_scale: float, fallback: Dict[str, float]):
+            super().__init__()
+            self.llm_scale = llm_scale
+            self.fallback = fallback
+            self.pending: Dict[str, Deque[float]] = {}
+            self.calls = 0
+            self.unmatched = 0
+
+        def next_latency(self, session_id: str, tier: str) -> float:
+            queued = self.pending.get(session_id)
+            if queued:
+                return queued.popleft() * self.llm_scale
+            # Turno risolto dalla cache nella cattura ma non nel replay: latenza tipica del tier
+            self.unmatched += 1
+            return self.fallback.get(tier, self.fallback.get("*", 0.0)) * self.llm_scale
+
+        async def create_chat_session(self, session_id: str, tier=None):
+            base_id = session_id[:-len("-hedge")] if session_id.endswith("-hedge") else session_id
+            return RecordedLatencyChat(self, base_id, tier.name if tier else "standard")
+
+    return ReplayAIService
+
+
+def _fallback_latencies(events: List[Dict]) -> Dict[str, float]:
+    by_tier: Dict[str, List[float]] = {}
+    for event in events:
+        for tier, seconds in event.get("llm", []):
+            by_tier.setdefault(tier, []).append(seconds)
+            by_tier.setdefault("*", []).append(seconds)
+    return {tier: statistics.median(values) for tier, values in by_tier.items()}
+
+
+def _session_ip(pseudonym: str) -> str:
+    return "10." + ".".join(str(int(pseudonym[i:i + 2], 16)) for i in (0, 2, 4))
+
+
+class Replayer:
+    def __init__(self, client, service, events: List[Dict], speed: float):
+        self.client = client
+        self.service = service
+        self.events = events
+        self.speed = speed
+        self.session_ids: Dict[str, str] = {}
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.skipped = 0
+        self.max_lag = 0.0
+
+    async def _request(self, event: Dict, start: float):
+        pseudonym = event.get("s")
+        template = event["p"]
+        session_id = self.session_ids.get(pseudonym) if pseudonym else None
+        if "{session_id}" in template or template == "/api/chat/message":
+            if not session_id:
+                # Sessione creata prima dell'inizio della cattura: non rigiocabile
+                self.skipped += 1
+                return
+        path = template.replace("{session_id}", session_id or "")
+        body = dict(event.get("b") or {})
+        if template == "/api/chat/message":
+            body["session_id"] = session_id
+            self.service.pending[session_id] = deque(seconds for _, seconds in event.get("llm", []))
+
+        due = start + event["t"] / self.speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            self.max_lag = max(self.max_lag, -delay)
+
+        # Un IP distinto per sessione: il rate limit per IP si comporta come con client diversi
+        headers = {"x-forwarded-for": _session_ip(pseudonym)} if pseudonym else {}
+        request_start = time.perf_counter()
+        response = await self.client.request(event["m"], path, json=body if event["m"] == "POST" else None, headers=headers)
+        key = f"{event['m']} {template}"
+        self.latencies.setdefault(key, []).append(time.perf_counter() - request_start)
+        if response.status_code >= 400:
+            self.errors[key] = self.errors.get(key, 0) + 1
+        if template == "/api/chat/session" and event["m"] == "POST" and response.status_code == 200 and pseudonym:
+            self.session_ids[pseudonym] = response.json()["session_id"]
+
+    async def _session(self, events: List[Dict], start: float):
+        # Le richieste di una sessione restano sequenziali, come dal browser
+        for event in events:
+            await self._request(event, start)
+
+    async def run(self) -> float:
+        sessions: Dict[Optional[str], List[Dict]] = {}
+        for event in self.events:
+            sessions.setdefault(event.get("s"), []).append(event)
+        start = time.perf_counter() - self.events[0]["t"] / self.speed if self.events else time.perf_counter()
+        await asyncio.gather(*(self._session(events, start) for events in sessions.values()))
+        return time.perf_counter() - start
+
+
+async def replay(capture: Path, speed: float, llm_scale: float) -> Dict:
+    header, events = load_capture(capture)
+    events.sort(key=lambda event: event["t"])
+
+    # Prima di importare server: il listener vale per i client creati dopo la registrazione
+    counter = MongoOpCounter()
+    monitoring.register(counter)
+    os.environ["TRAFFIC_CAPTURE_ENABLED"] = "false"
+    # Con --speed > 1 i limiti per IP e sessione scarterebbero il traffico registrato
+    os.environ["ADMISSION_ENABLED"] = "false"
+
+    import httpx
+    from server import app
+    from routes.chat_routes import get_ai_service
+
+    service = _fake_service_factory()(llm_scale, _fallback_latencies(events))
+    app.dependency_overrides[get_ai_service] = lambda: service
+
+    await app.router.startup()
+    try:
+        counter.enabled = True
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://replay", timeout=120) as client:
+            replayer = Replayer(client, service, events, speed)
+            elapsed = await replayer.run()
+        counter.enabled = False
+    finally:
+        await app.router.shutdown()
+
+    requests = sum(len(values) for values in replayer.latencies.values())
+    return {
+        "capture": str(capture),
+        "capture_started_at": header.get("started_at"),
+        "speed": speed,
+        "llm_scale": llm_scale,
+        "elapsed_seconds": elapsed,
+        "requests": requests,
+        "skipped": replayer.skipped,
+        "max_schedule_lag_seconds": replayer.max_lag,
+        "llm_calls": service.calls,
+        "llm_unmatched": service.unmatched,
+        "endpoints": {
+            key: {**percentiles(values), "errors": replayer.errors.get(key, 0)}
+            for key, values in sorted(replayer.latencies.items())
+        },
+        "mongo_ops": dict(sorted(counter.ops.items())),
+        "mongo_ops_per_request": sum(stats["count"] for stats in counter.ops.values()) / max(1, requests)
+    }
+
+
+def _delta(before: Optional[float], after: Optional[float]) -> str:
+    if not before or after is None:
+        return ""
+    return f"{(after - before) / before:+.0%}"
+
+
+def _ms(seconds: Optional[float]) -> str:
+    return f"{seconds * 1000:.1f}" if seconds is not None else "-"
+
+
+def print_diff(a: Dict, b: Dict):
+    print(f"A: {a['capture']} (x{a['speed']})  richieste={a['requests']}  durata={a['elapsed_seconds']:.1f}s")
+    print(f"B: {b['capture']} (x{b['speed']})  richieste={b['requests']}  durata={b['elapsed_seconds']:.1f}s")
+    print(f"\nlatenze in ms\n{'endpoint':40} {'p50 A':>8} {'p50 B':>8} {'Δ':>6} {'p95 A':>8} {'p95 B':>8} {'Δ':>6} "
+          f"{'p99 A':>8} {'p99 B':>8} {'Δ':>6} {'err A':>6} {'err B':>6}")
+    for key in sorted(set(a["endpoints"]) | set(b["endpoints"])):
+        ea, eb = a["endpoints"].get(key, {}), b["endpoints"].get(key, {})
+        row = f"{key:40}"
+        for p in ("p50", "p95", "p99"):
+            va, vb = ea.get(p), eb.get(p)
+            row += f" {_ms(va):>8} {_ms(vb):>8} {_delta(va, vb):>6}"
+        row += f" {ea.get('errors', 0):6} {eb.get('errors', 0):6}"
+        print(row)
+
+    print(f"\n{'comando Mongo':24} {'ops A':>8} {'ops B':>8} {'Δ':>6} {'ms A':>9} {'ms B':>9}")
+    for command in sorted(set(a["mongo_ops"]) | set(b["mongo_ops"])):
+        oa = a["mongo_ops"].get(command, {"count": 0, "seconds": 0.0})
+        ob = b["mongo_ops"].get(command, {"count": 0, "seconds": 0.0})
+        print(f"{command:24} {oa['count']:8} {ob['count']:8} {_delta(oa['count'], ob['count']):>6} "
+              f"{oa['seconds'] * 1000:9.1f} {ob['seconds'] * 1000:9.1f}")
+    print(f"\noperazioni Mongo per richiesta: {a['mongo_ops_per_request']:.2f} -> {b['mongo_ops_per_request']:.2f} "
+          f"{_delta(a['mongo_ops_per_request'], b['mongo_ops_per_request'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="rigioca una cattura contro il backend locale")
+    run_parser.add_argument("capture", type=Path)
+    run_parser.add_argument("--speed", type=float, default=1.0, help="accelerazione degli intervalli tra richieste")
+    run_parser.add_argument("--scale-llm", action="store_true", help="accelera anche le latenze LLM registrate")
+    run_parser.add_argument("--output", type=Path)
+    diff_parser = commands.add_parser("diff", help="confronta i risultati di due replay")
+    diff_parser.add_argument("a", type=Path)
+    diff_parser.add_argument("b", type=Path)
+    args = parser.parse_args()
+
+    if args.command == "diff":
+        print_diff(json.loads(args.a.read_text()), json.loads(args.b.read_text()))
+        return
+
+    result = asyncio.run(replay(args.capture, args.speed, 1 / args.speed if args.scale_llm else 1.0))
+    output = json.dumps(result, indent=2)
+    if args.output:
+        args.output.write_text(output + "\n")
+        print(f"risultati salvati in {args.output}", file=sys.stderr)
+    for key, stats in result["endpoints"].items():
+        print(f"{key:40} n={stats['count']:5}  p50={stats['p50'] * 1000:7.1f} ms  p95={stats['p95'] * 1000:7.1f} ms  "
+              f"p99={stats['p99'] * 1000:7.1f} ms  errori={stats['errors']}")
+    print(f"operazioni Mongo per richiesta: {result['mongo_ops_per_request']:.2f}  "
+          f"chiamate LLM: {result['llm_calls']} (senza latenza registrata: {result['llm_unmatched']})")
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,9 @@ class ChatSessionUpdate(BaseModel):
     status: Optional[str] = None
     context_summary: Optional[str] = None
 
+class SessionBatchRequest(BaseModel):
+    session_ids: List[str] = Field(..., min_length=1)
+
 class ChatSessionResponse(BaseModel):
     id: str
     session_id: str
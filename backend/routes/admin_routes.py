@@ -0,0 +1,131 @@
+import os
+import hmac
+import logging
+from fastapi import APIRouter, HTTPException, Depends, Header, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from typing import Optional
+from datetime import datetime
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from services.export_service import ExportService
+from services.drain import get_drain_controller
+from services.turn_events import EVENT_TYPES, get_turn_event_log
+from services.memory_budget import memory
+from services.request_profiler import get_request_profiler
+
+logger = logging.getLogger(__name__)
+
+# Dependency per il database
+async def get_database():
+    from server import db
+    return db
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Consente l'accesso solo con il token di ADMIN_API_TOKEN nell'header X-Admin-Token"""
+    expected = os.environ.get('ADMIN_API_TOKEN')
+    if not expected:
+        raise HTTPException(status_code=403, detail="Endpoint amministrativi disabilitati")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, expected):
+        raise HTTPException(status_code=401, detail="Token amministratore non valido")
+
+router = APIRouter(prefix="/admin", tags=["admin"], dependencies=[Depends(require_admin)])
+
+@router.get("/export")
+async def export_conversations(
+    after: Optional[str] = Query(None, description="Riprende dopo questo session_id (checkpoint)"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    batch_size: int = Query(200, ge=1, le=5000),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+):
+    """Esporta le sessioni con profilo e messaggi in NDJSON, una sessione per riga, in ordine di session_id"""
+    export_service = ExportService(db, batch_size=batch_size)
+    return StreamingResponse(
+        export_service.iter_ndjson(after_session_id=after, since=since, until=until, limit=limit),
+        media_type="application/x-ndjson"
+    )
+
+@router.get("/memory")
+async def memory_report():
+    """Memoria stimata per struttura in-process (byte, voci, budget) e RSS del processo"""
+    return memory.report()
+
+def _event_log_or_404():
+    log = get_turn_event_log()
+    if not log:
+        raise HTTPException(status_code=404, detail="Log eventi di turno disabilitato (TURN_EVENTS_ENABLED)")
+    return log
+
+@router.get("/events")
+async def read_turn_events(
+    after: int = Query(0, ge=0, description="Offset dell'ultimo evento già consumato"),
+    limit: int = Query(500, ge=1, le=5000),
+    session_id: Optional[str] = None,
+    type: Optional[str] = Query(None, description=f"Uno tra: {', '.join(EVENT_TYPES)}")
+):
+    """Eventi di turno con offset > after; next_offset va passato come after alla chiamata successiva"""
+    log = _event_log_or_404()
+    try:
+        events, next_offset = await log.read(after=after, limit=limit, session_id=session_id, event_type=type)
+    except Exception as e:
+        logger.error("Errore lettura eventi di turno: %s", e)
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+    for event in events:
+        event["offset"] = event.pop("_id")
+    return {"events": events, "next_offset": next_offset}
+
+@router.get("/events/consumers")
+async def turn_event_consumers():
+    """Offset salvato e ritardo di ciascun consumatore del log eventi"""
+    log = _event_log_or_404()
+    try:
+        return {"latest_offset": await log.latest_offset(), "consumers": await log.consumer_offsets()}
+    except Exception as e:
+        logger.error("Errore lettura consumatori eventi: %s", e)
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@router.post("/drain")
+async def start_drain(timeout: float = Query(20.0, ge=0, le=300)):
+    """Avvia il drain (readiness negativa, nuovi turni rifiutati) e attende i turni in corso.
+
+    Pensato per l'hook preStop del rilascio: nessun turno viene interrotto, lo spegnimento
+    successivo interrompe quelli eventualmente ancora aperti.
+    """
+    return await get_drain_controller().drain(timeout, cancel=False)
+
+def _profiler_or_404():
+    profiler = get_request_profiler()
+    if not profiler:
+        raise HTTPException(status_code=404, detail="Profilazione disabilitata (PROFILING_ENABLED)")
+    return profiler
+
+@router.get("/profiles")
+async def list_request_profiles(limit: int = Query(50, ge=1, le=500)):
+    """Profili delle richieste salvati, dal più recente, senza gli stack"""
+    try:
+        return await _profiler_or_404().list_profiles(limit)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Errore elenco profili: %s", e)
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@router.get("/profiles/{profile_id}")
+async def download_request_profile(profile_id: str, format: str = Query("folded", pattern="^(folded|json)$")):
+    """Stack piegati per flamegraph.pl / speedscope (format=folded) o profilo completo con riepilogo (format=json)"""
+    try:
+        profile = await _profiler_or_404().get_profile(profile_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Errore lettura profilo %s: %s", profile_id, e)
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profilo non trovato")
+    if format == "json":
+        return profile
+    return PlainTextResponse(
+        profile["folded"],
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'}
+    )
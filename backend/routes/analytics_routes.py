@@ -0,0 +1,66 @@
+import logging
+from fastapi import APIRouter, HTTPException, Depends, Query
+from datetime import datetime, timedelta
+from typing import Optional
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from routes.admin_routes import get_database, require_admin
+from services.analytics_service import AnalyticsService, GRANULARITIES
+
+logger = logging.getLogger(__name__)
+
+# Dependency per il servizio
+async def get_analytics_service(db: AsyncIOMotorDatabase = Depends(get_database)):
+    return AnalyticsService(db)
+
+router = APIRouter(prefix="/analytics", tags=["analytics"], dependencies=[Depends(require_admin)])
+
+def _resolve_range(granularity: str, start: Optional[datetime], end: Optional[datetime]):
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"Granularità non valida: usare {', '.join(GRANULARITIES)}")
+    end = end or datetime.utcnow()
+    start = start or end - (timedelta(days=7) if granularity == "day" else timedelta(hours=48))
+    return start, end
+
+@router.get("/urgency")
+async def get_urgency_series(
+    granularity: str = "day",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    analytics_service: AnalyticsService = Depends(get_analytics_service)
+):
+    """Sessioni avviate per ora o giorno divise per urgenza, lette dai rollup precalcolati"""
+    start, end = _resolve_range(granularity, start, end)
+    try:
+        buckets = await analytics_service.urgency_series(granularity, start, end)
+        return {"granularity": granularity, "start": start, "end": end, "buckets": buckets}
+    except Exception as e:
+        logger.error("Errore analytics urgenza: %s", e)
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@router.get("/symptoms")
+async def get_top_symptoms(
+    granularity: str = "day",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    top: int = Query(10, ge=1, le=100),
+    analytics_service: AnalyticsService = Depends(get_analytics_service)
+):
+    """Sintomi principali più frequenti nell'intervallo, letti dai rollup precalcolati"""
+    start, end = _resolve_range(granularity, start, end)
+    try:
+        symptoms = await analytics_service.top_symptoms(granularity, start, end, top)
+        return {"granularity": granularity, "start": start, "end": end, "symptoms": symptoms}
+    except Exception as e:
+        logger.error("Errore analytics sintomi: %s", e)
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@router.post("/refresh")
+async def refresh_rollups(analytics_service: AnalyticsService = Depends(get_analytics_service)):
+    """Forza l'aggiornamento incrementale dei rollup"""
+    try:
+        written = await analytics_service.refresh()
+        return {"buckets_written": written}
+    except Exception as e:
+        logger.error("Errore aggiornamento rollup: %s", e)
+        raise HTTPException(status_code=500, detail="Errore interno del server")
@@ -1,14 +1,24 @@
 import logging
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List, Optional
+from contextlib import nullcontext
+import json
+from fastapi import APIRouter, HTTPException, Depends, Header, Request, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from typing import List, Optional, Tuple, Callable, Awaitable
 from datetime import datetime
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
-from models.message import MessageCreate, MessageResponse, ChatRequest, ChatResponse
-from models.chat_session import ChatSessionCreate, ChatSessionResponse
+from models.message import Message, MessageCreate, MessageResponse, ChatRequest, ChatResponse
+from models.chat_session import ChatSession, ChatSessionCreate, ChatSessionResponse, ChatSessionUpdate, SessionBatchRequest
 from models.user_profile import UserProfileCreate, UserProfile
-from services.ai_service import AIService
+from services.ai_service import AIService, get_ai_service as get_shared_ai_service
 from services.session_service import SessionService
+from services.turn_coordinator import get_turn_coordinator
+from services.change_feed import get_change_feed
+from services.drain import get_drain_controller
+from services.turn_events import emit_turn_event
+from services.speculation import get_speculative_responder
+from services.admission import AdmissionController, AdmissionRejected, client_ip, estimate_priority, get_admission_controller
 
 logger = logging.getLogger(__name__)
 
@@ -22,10 +32,123 @@ async def get_session_service(db: AsyncIOMotorDatabase = Depends(get_database)):
     return SessionService(db)
 
 async def get_ai_service():
-    return AIService()
+    return get_shared_ai_service()
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
+# Numero di messaggi di storia passati all'AI ad ogni turno
+HISTORY_WINDOW = 10
+
+# Numero massimo di sessioni per richiesta degli endpoint batch
+MAX_BATCH_SESSIONS = 100
+
+# Messaggio restituito quando il turno viene rifiutato dal controllo di ammissione o durante il drain
+OVERLOAD_DETAIL = "Servizio momentaneamente sovraccarico, riprova tra poco"
+
+def _admission_slot(controller: Optional[AdmissionController], priority: int):
+    return controller.slot(priority) if controller else nullcontext()
+
+def _to_session_response(session: ChatSession) -> ChatSessionResponse:
+    return ChatSessionResponse(
+        id=session.id,
+        session_id=session.session_id,
+        user_profile_id=session.user_profile_id,
+        start_time=session.start_time,
+        end_time=session.end_time,
+        message_count=session.message_count,
+        current_urgency_level=session.current_urgency_level,
+        status=session.status,
+        context_summary=session.context_summary
+    )
+
+def _batch_session_ids(batch: SessionBatchRequest) -> List[str]:
+    # Ordine preservato, duplicati rimossi prima di applicare il limite
+    session_ids = list(dict.fromkeys(batch.session_ids))
+    if len(session_ids) > MAX_BATCH_SESSIONS:
+        raise HTTPException(status_code=422, detail=f"Massimo {MAX_BATCH_SESSIONS} sessioni per richiesta")
+    return session_ids
+
+def _to_message_response(msg: Message) -> MessageResponse:
+    return MessageResponse(
+        id=msg.id,
+        session_id=msg.session_id,
+        message_type=msg.message_type,
+        content=msg.content,
+        urgency_level=msg.urgency_level,
+        next_questions=msg.next_questions,
+        metadata=msg.metadata,
+        timestamp=msg.timestamp
+    )
+
+async def _process_chat_turn(
+    session_service: SessionService,
+    ai_service: AIService,
+    session_id: str,
+    user_message: str,
+    user_profile: Optional[UserProfile],
+    conversation_history: List[Message],
+    on_user_saved: Optional[Callable[[Message], Awaitable[None]]] = None
+) -> Tuple[Message, Message, str]:
+    """Esegue un turno di conversazione condiviso tra HTTP e WebSocket"""
+    # Tap su una domanda suggerita: risposta già generata in background, se ancora valida
+    speculation = get_speculative_responder()
+    speculative_reply = None
+    if speculation and speculation.has_pending(session_id):
+        last_message_id = await session_service.get_last_message_id(session_id)
+        speculative_reply = await speculation.take(session_id, user_message, last_message_id)
+    
+    # Salva il messaggio utente
+    user_msg_create = MessageCreate(content=user_message, message_type="user")
+    saved_user_msg = await session_service.save_message(session_id, user_msg_create)
+    if on_user_saved:
+        await on_user_saved(saved_user_msg)
+    
+    # Genera risposta AI
+    if speculative_reply:
+        ai_response, urgency_level, next_questions = speculative_reply
+    else:
+        ai_response, urgency_level, next_questions = await ai_service.generate_response(
+            session_id=session_id,
+            user_message=user_message,
+            user_profile=user_profile,
+            conversation_history=conversation_history
+        )
+    
+    # Salva la risposta AI
+    ai_msg_create = MessageCreate(content=ai_response, message_type="assistant")
+    saved_ai_msg = await session_service.save_message(
+        session_id, 
+        ai_msg_create, 
+        urgency_level=urgency_level,
+        next_questions=next_questions,
+        metadata={"speculative": True} if speculative_reply else None
+    )
+    
+    # Aggiorna urgenza sessione se necessario
+    if urgency_level and urgency_level != "low":
+        update_data = ChatSessionUpdate(current_urgency_level=urgency_level)
+        await session_service.update_session(session_id, update_data)
+    
+    emit_turn_event("turn", session_id, {
+        "user_message_id": saved_user_msg.id,
+        "assistant_message_id": saved_ai_msg.id,
+        "user_message": saved_user_msg.content,
+        "assistant_message": saved_ai_msg.content,
+        "urgency_level": urgency_level,
+        "next_questions": next_questions
+    })
+    
+    if speculation:
+        history = (conversation_history + [saved_user_msg, saved_ai_msg])[-HISTORY_WINDOW:]
+        speculation.schedule(ai_service, session_id, saved_ai_msg.id, next_questions, user_profile, history)
+    
+    return saved_user_msg, saved_ai_msg, urgency_level
+
+def _cancel_speculation(session_id: str):
+    speculation = get_speculative_responder()
+    if speculation:
+        speculation.cancel(session_id)
+
 @router.post("/session", response_model=ChatSessionResponse)
 async def create_chat_session(
     session_data: ChatSessionCreate,
@@ -34,19 +157,32 @@ async def create_chat_session(
     """Crea una nuova sessione di chat"""
     try:
         session = await session_service.create_session(session_data)
-        return ChatSessionResponse(
-            id=session.id,
-            session_id=session.session_id,
-            user_profile_id=session.user_profile_id,
-            start_time=session.start_time,
-            end_time=session.end_time,
-            message_count=session.message_count,
-            current_urgency_level=session.current_urgency_level,
-            status=session.status,
-            context_summary=session.context_summary
-        )
+        return _to_session_response(session)
+    except Exception as e:
+        logger.error("Errore creazione sessione: %s", e)
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@router.post("/sessions/batch")
+async def get_chat_sessions_batch(
+    batch: SessionBatchRequest,
+    session_service: SessionService = Depends(get_session_service)
+):
+    """Sessioni e profili di più session_id con due query $in, indicizzati per session_id"""
+    try:
+        session_ids = _batch_session_ids(batch)
+        sessions = await session_service.get_sessions(session_ids)
+        profiles = await session_service.get_user_profiles(list(sessions)) if sessions else {}
+        return {
+            "sessions": {
+                session_id: {"session": _to_session_response(session), "user_profile": profiles.get(session_id)}
+                for session_id, session in sessions.items()
+            },
+            "missing": [session_id for session_id in session_ids if session_id not in sessions]
+        }
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Errore creazione sessione: {e}")
+        logger.error("Errore recupero sessioni batch: %s", e)
         raise HTTPException(status_code=500, detail="Errore interno del server")
 
 @router.get("/session/{session_id}", response_model=ChatSessionResponse)
@@ -60,21 +196,11 @@ async def get_chat_session(
         if not session:
             raise HTTPException(status_code=404, detail="Sessione non trovata")
         
-        return ChatSessionResponse(
-            id=session.id,
-            session_id=session.session_id,
-            user_profile_id=session.user_profile_id,
-            start_time=session.start_time,
-            end_time=session.end_time,
-            message_count=session.message_count,
-            current_urgency_level=session.current_urgency_level,
-            status=session.status,
-            context_summary=session.context_summary
-        )
+        return _to_session_response(session)
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Errore recupero sessione {session_id}: {e}")
+        logger.error("Errore recupero sessione %s: %s", session_id, e)
         raise HTTPException(status_code=500, detail="Errore interno del server")
 
 @router.post("/profile/{session_id}", response_model=UserProfile)
@@ -91,11 +217,14 @@ async def create_or_update_profile(
             raise HTTPException(status_code=404, detail="Sessione non trovata")
         
         profile = await session_service.create_user_profile(session_id, profile_data)
+        emit_turn_event("profile", session_id, profile_data.dict(exclude_unset=True))
+        # Le risposte anticipate usavano il profilo precedente
+        _cancel_speculation(session_id)
         return profile
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Errore gestione profilo utente: {e}")
+        logger.error("Errore gestione profilo utente: %s", e)
         raise HTTPException(status_code=500, detail="Errore interno del server")
 
 @router.get("/profile/{session_id}", response_model=Optional[UserProfile])
@@ -108,7 +237,7 @@ async def get_user_profile(
         profile = await session_service.get_user_profile(session_id)
         return profile
     except Exception as e:
-        logger.error(f"Errore recupero profilo {session_id}: {e}")
+        logger.error("Errore recupero profilo %s: %s", session_id, e)
         raise HTTPException(status_code=500, detail="Errore interno del server")
 
 @router.get("/history/{session_id}", response_model=List[MessageResponse])
@@ -133,12 +262,54 @@ async def get_conversation_history(
             ) for msg in messages
         ]
     except Exception as e:
-        logger.error(f"Errore recupero conversazione {session_id}: {e}")
+        logger.error("Errore recupero conversazione %s: %s", session_id, e)
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+def _sse_frame(event: Optional[dict]) -> str:
+    if event is None:
+        return ": keepalive\n\n"
+    payload = json.dumps(jsonable_encoder(event.get("data", event)), ensure_ascii=False)
+    event_id = f"id: {event['id']}\n" if event.get("id") else ""
+    return f"{event_id}event: {event['type']}\ndata: {payload}\n\n"
+
+@router.get("/stream/{session_id}")
+async def stream_session_events(
+    session_id: str,
+    resume_after: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None),
+    session_service: SessionService = Depends(get_session_service)
+):
+    """Server-Sent Events con i nuovi messaggi e gli aggiornamenti della sessione.
+    
+    Ogni evento ha come id il resume token: alla riconnessione EventSource lo rimanda in
+    Last-Event-ID (oppure si passa resume_after) e gli eventi persi vengono recuperati.
+    Un evento "reset" chiede al client di ricaricare la cronologia da /history.
+    """
+    feed = get_change_feed()
+    if not feed:
+        raise HTTPException(status_code=503, detail="Aggiornamenti in tempo reale non disponibili")
+    try:
+        session = await session_service.get_session(session_id)
+    except Exception as e:
+        logger.error("Errore recupero sessione %s: %s", session_id, e)
         raise HTTPException(status_code=500, detail="Errore interno del server")
+    if not session:
+        raise HTTPException(status_code=404, detail="Sessione non trovata")
+    
+    async def events():
+        async for event in feed.subscribe(session_id, resume_after=resume_after or last_event_id):
+            yield _sse_frame(event)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @router.post("/message", response_model=ChatResponse)
 async def send_message(
     chat_request: ChatRequest,
+    request: Request,
     session_service: SessionService = Depends(get_session_service),
     ai_service: AIService = Depends(get_ai_service)
 ):
@@ -152,66 +323,43 @@ async def send_message(
         if not session:
             raise HTTPException(status_code=404, detail="Sessione non trovata")
         
-        # Recupera profilo utente e storia conversazione
-        user_profile = await session_service.get_user_profile(session_id)
-        conversation_history = await session_service.get_conversation_history(session_id, limit=10)
-        
-        # Salva il messaggio utente
-        user_msg_create = MessageCreate(content=user_message, message_type="user")
-        saved_user_msg = await session_service.save_message(session_id, user_msg_create)
-        
-        # Genera risposta AI
-        ai_response, urgency_level, next_questions = await ai_service.generate_response(
-            session_id=session_id,
-            user_message=user_message,
-            user_profile=user_profile,
-            conversation_history=conversation_history
-        )
+        # Limiti per IP e per sessione controllati prima di qualsiasi lavoro sul turno
+        admission = get_admission_controller()
+        if admission:
+            admission.check_rate(client_ip(request.headers, request.client), session_id)
         
-        # Salva la risposta AI
-        ai_msg_create = MessageCreate(content=ai_response, message_type="assistant")
-        saved_ai_msg = await session_service.save_message(
-            session_id, 
-            ai_msg_create, 
-            urgency_level=urgency_level,
-            next_questions=next_questions
-        )
+        async def run_turn():
+            # Profilo e storia letti dopo aver ottenuto il lock, così includono il turno precedente
+            user_profile = await session_service.get_user_profile(session_id)
+            conversation_history = await session_service.get_recent_history(session_id, HISTORY_WINDOW)
+            priority = estimate_priority(user_message, session.current_urgency_level, conversation_history)
+            async with _admission_slot(admission, priority):
+                return await _process_chat_turn(
+                    session_service,
+                    ai_service,
+                    session_id,
+                    user_message,
+                    user_profile,
+                    conversation_history
+                )
         
-        # Aggiorna urgenza sessione se necessario
-        if urgency_level and urgency_level != "low":
-            from models.chat_session import ChatSessionUpdate
-            update_data = ChatSessionUpdate(current_urgency_level=urgency_level)
-            await session_service.update_session(session_id, update_data)
+        # Turni della stessa sessione serializzati, messaggi identici in corso uniti; nessun nuovo turno durante il drain
+        async with get_drain_controller().turn():
+            saved_user_msg, saved_ai_msg, _ = await get_turn_coordinator().run(session_id, user_message, run_turn)
         
         return ChatResponse(
             session_id=session_id,
-            user_message=MessageResponse(
-                id=saved_user_msg.id,
-                session_id=saved_user_msg.session_id,
-                message_type=saved_user_msg.message_type,
-                content=saved_user_msg.content,
-                urgency_level=saved_user_msg.urgency_level,
-                next_questions=saved_user_msg.next_questions,
-                metadata=saved_user_msg.metadata,
-                timestamp=saved_user_msg.timestamp
-            ),
-            assistant_message=MessageResponse(
-                id=saved_ai_msg.id,
-                session_id=saved_ai_msg.session_id,
-                message_type=saved_ai_msg.message_type,
-                content=saved_ai_msg.content,
-                urgency_level=saved_ai_msg.urgency_level,
-                next_questions=saved_ai_msg.next_questions,
-                metadata=saved_ai_msg.metadata,
-                timestamp=saved_ai_msg.timestamp
-            ),
+            user_message=_to_message_response(saved_user_msg),
+            assistant_message=_to_message_response(saved_ai_msg),
             session_status=session.status
         )
         
     except HTTPException:
         raise
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=OVERLOAD_DETAIL, headers=e.headers())
     except Exception as e:
-        logger.error(f"Errore invio messaggio: {e}")
+        logger.error("Errore invio messaggio: %s", e)
         raise HTTPException(status_code=500, detail="Errore interno del server")
 
 @router.post("/welcome/{session_id}", response_model=MessageResponse)
@@ -230,17 +378,28 @@ async def get_welcome_message(
         # Recupera profilo utente
         user_profile = await session_service.get_user_profile(session_id)
         
-        # Genera messaggio di benvenuto
-        welcome_message, urgency_level, next_questions = await ai_service.generate_welcome_message(user_profile)
-        
-        # Salva il messaggio di benvenuto
-        welcome_msg_create = MessageCreate(content=welcome_message, message_type="assistant")
-        saved_welcome_msg = await session_service.save_message(
-            session_id, 
-            welcome_msg_create, 
-            urgency_level=urgency_level,
-            next_questions=next_questions
-        )
+        async with get_drain_controller().turn():
+            # Genera messaggio di benvenuto
+            welcome_message, urgency_level, next_questions = await ai_service.generate_welcome_message(user_profile)
+            
+            # Salva il messaggio di benvenuto
+            welcome_msg_create = MessageCreate(content=welcome_message, message_type="assistant")
+            saved_welcome_msg = await session_service.save_message(
+                session_id, 
+                welcome_msg_create, 
+                urgency_level=urgency_level,
+                next_questions=next_questions
+            )
+        emit_turn_event("welcome", session_id, {
+            "message_id": saved_welcome_msg.id,
+            "content": saved_welcome_msg.content,
+            "urgency_level": urgency_level,
+            "next_questions": next_questions
+        })
+        speculation = get_speculative_responder()
+        if speculation:
+            speculation.schedule(ai_service, session_id, saved_welcome_msg.id, next_questions,
+                                 user_profile, [saved_welcome_msg])
         
         return MessageResponse(
             id=saved_welcome_msg.id,
@@ -255,8 +414,10 @@ async def get_welcome_message(
         
     except HTTPException:
         raise
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=OVERLOAD_DETAIL, headers=e.headers())
     except Exception as e:
-        logger.error(f"Errore generazione messaggio benvenuto: {e}")
+        logger.error("Errore generazione messaggio benvenuto: %s", e)
         raise HTTPException(status_code=500, detail="Errore interno del server")
 
 @router.post("/close/{session_id}")
@@ -269,12 +430,33 @@ async def close_session(
         success = await session_service.close_session(session_id)
         if not success:
             raise HTTPException(status_code=404, detail="Sessione non trovata")
+        emit_turn_event("close", session_id, {"status": "completed"})
+        _cancel_speculation(session_id)
         
         return {"message": "Sessione chiusa con successo", "session_id": session_id}
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Errore chiusura sessione {session_id}: {e}")
+        logger.error("Errore chiusura sessione %s: %s", session_id, e)
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+@router.post("/summary/batch")
+async def get_session_summaries_batch(
+    batch: SessionBatchRequest,
+    session_service: SessionService = Depends(get_session_service)
+):
+    """Riassunti di più sessioni per la dashboard operatori: tre query in totale, indicizzati per session_id"""
+    try:
+        session_ids = _batch_session_ids(batch)
+        summaries = await session_service.get_session_summaries(session_ids)
+        return {
+            "summaries": summaries,
+            "missing": [session_id for session_id in session_ids if session_id not in summaries]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Errore generazione riassunti batch: %s", e)
         raise HTTPException(status_code=500, detail="Errore interno del server")
 
 @router.get("/summary/{session_id}")
@@ -292,5 +474,144 @@ async def get_session_summary(
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Errore generazione riassunto {session_id}: {e}")
-        raise HTTPException(status_code=500, detail="Errore interno del server")
\ No newline at end of file
+        logger.error("Errore generazione riassunto %s: %s", session_id, e)
+        raise HTTPException(status_code=500, detail="Errore interno del server")
+
+class _ConnectionContext:
+    """Contesto di sessione caricato una sola volta per connessione WebSocket"""
+    
+    def __init__(self, session: ChatSession, user_profile: Optional[UserProfile], history: List[Message]):
+        self.session = session
+        self.user_profile = user_profile
+        self.history = history
+        self.urgency_level = session.current_urgency_level
+    
+    def append(self, *messages: Message):
+        self.history.extend(messages)
+        if len(self.history) > HISTORY_WINDOW:
+            del self.history[:-HISTORY_WINDOW]
+
+async def _load_connection_context(session_service: SessionService, session_id: str) -> Optional[_ConnectionContext]:
+    session = await session_service.get_session(session_id)
+    if not session:
+        return None
+    user_profile = await session_service.get_user_profile(session_id)
+    history = await session_service.get_recent_history(session_id, HISTORY_WINDOW)
+    return _ConnectionContext(session, user_profile, history)
+
+@router.websocket("/ws/{session_id}")
+async def chat_websocket(
+    websocket: WebSocket,
+    session_id: str,
+    session_service: SessionService = Depends(get_session_service),
+    ai_service: AIService = Depends(get_ai_service)
+):
+    """Canale WebSocket per la chat con contesto di sessione mantenuto in memoria.
+    
+    Frame in ingresso: {"type": "message", "message": "..."} oppure {"type": "refresh"}.
+    Frame in uscita: "context", "user_message" (appena salvato), "assistant_message", "urgency", "error".
+    """
+    await websocket.accept()
+    
+    context = await _load_connection_context(session_service, session_id)
+    if not context:
+        await websocket.send_json({"type": "error", "detail": "Sessione non trovata"})
+        await websocket.close(code=4404)
+        return
+    
+    await websocket.send_json({
+        "type": "context",
+        "session_id": session_id,
+        "session_status": context.session.status,
+        "urgency_level": context.urgency_level,
+        "message_count": context.session.message_count
+    })
+    
+    admission = get_admission_controller()
+    
+    acked_ids = set()
+    
+    async def send_user_message(message: Message):
+        acked_ids.add(message.id)
+        await websocket.send_json({
+            "type": "user_message",
+            "message": jsonable_encoder(_to_message_response(message))
+        })
+    
+    try:
+        while True:
+            try:
+                frame = await websocket.receive_json()
+            except (ValueError, KeyError, TypeError):
+                # Frame non JSON (o binario): la connessione resta aperta
+                frame = None
+            if not isinstance(frame, dict):
+                await websocket.send_json({"type": "error", "detail": "Messaggio non valido"})
+                continue
+            frame_type = frame.get("type", "message")
+            
+            if frame_type == "refresh":
+                # Ricarica il contesto, ad esempio dopo un aggiornamento del profilo via HTTP
+                try:
+                    refreshed = await _load_connection_context(session_service, session_id)
+                except Exception as e:
+                    logger.error("Errore aggiornamento contesto WebSocket %s: %s", session_id, e)
+                    await websocket.send_json({"type": "error", "detail": "Errore interno del server"})
+                    continue
+                if refreshed:
+                    context = refreshed
+                continue
+            
+            user_message = (frame.get("message") or "").strip()
+            if frame_type != "message" or not user_message:
+                await websocket.send_json({"type": "error", "detail": "Messaggio non valido"})
+                continue
+            
+            async def run_turn():
+                priority = estimate_priority(user_message, context.urgency_level, context.history)
+                async with _admission_slot(admission, priority):
+                    return await _process_chat_turn(
+                        session_service,
+                        ai_service,
+                        session_id,
+                        user_message,
+                        context.user_profile,
+                        list(context.history),
+                        on_user_saved=send_user_message
+                    )
+            
+            try:
+                if admission:
+                    admission.check_rate(client_ip(websocket.headers, websocket.client), session_id)
+                async with get_drain_controller().turn():
+                    saved_user_msg, saved_ai_msg, urgency_level = await get_turn_coordinator().run(
+                        session_id, user_message, run_turn
+                    )
+            except AdmissionRejected as e:
+                await websocket.send_json({
+                    "type": "error",
+                    "detail": OVERLOAD_DETAIL,
+                    "retry_after": int(e.headers()["Retry-After"])
+                })
+                continue
+            except Exception as e:
+                logger.error("Errore turno WebSocket %s: %s", session_id, e)
+                await websocket.send_json({"type": "error", "detail": "Errore interno del server"})
+                continue
+            
+            context.append(saved_user_msg, saved_ai_msg)
+            
+            # Turno unito a uno identico già in corso: il salvataggio l'ha notificato l'altra connessione
+            if saved_user_msg.id not in acked_ids:
+                await send_user_message(saved_user_msg)
+            acked_ids.clear()
+            await websocket.send_json({
+                "type": "assistant_message",
+                "message": jsonable_encoder(_to_message_response(saved_ai_msg))
+            })
+            
+            if urgency_level and urgency_level != "low" and urgency_level != context.urgency_level:
+                context.urgency_level = urgency_level
+                await websocket.send_json({"type": "urgency", "urgency_level": urgency_level})
+    except WebSocketDisconnect:
+        logger.info("WebSocket chiuso per sessione: %s", session_id)
@@ -0,0 +1,100 @@
+"""Verifica del change feed contro un MongoDB reale in replica set (basta un nodo singolo).
+
+Avvio di un replica set locale a nodo singolo:
+    mongod --replSet rs0 --dbpath /tmp/rs0 --port 27017 --bind_ip 127.0.0.1
+    mongosh --eval 'rs.initiate({_id: "rs0", members: [{_id: 0, host: "127.0.0.1:27017"}]})'
+
+oppure, senza mongod installato, con Docker:
+    docker run -d --name mongo-rs0 -p 27017:27017 mongo:7 --replSet rs0 --bind_ip_all
+    docker exec mongo-rs0 mongosh --eval 'rs.initiate({_id: "rs0", members: [{_id: 0, host: "127.0.0.1:27017"}]})'
+
+Serve solo il driver già in requirements.txt; i test in tests/ girano su mongomock e non ne hanno bisogno,
+perché mongomock non implementa i change stream.
+
+Controlli eseguiti su un database usa e getta (eliminato alla fine):
+    1. un messaggio inserito arriva all'iscritto della sessione, non a quello di un'altra sessione
+    2. l'aggiornamento della sessione arriva come evento "session"
+    3. dopo la disconnessione, i messaggi inseriti nel frattempo arrivano riprendendo dall'ultimo id
+
+Uso (dalla cartella backend):
+    MONGO_URL="mongodb://127.0.0.1:27017/?replicaSet=rs0" python -m scripts.check_change_feed
+"""
+import asyncio
+import os
+import sys
+import uuid
+from datetime import datetime
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from services.change_feed import ChangeFeed
+
+
+async def next_event(events, timeout: float = 5.0):
+    while True:
+        event = await asyncio.wait_for(events.__anext__(), timeout)
+        if event is not None:
+            return event
+
+
+def message(session_id: str, content: str) -> dict:
+    return {"id": str(uuid.uuid4()), "session_id": session_id, "message_type": "user", "content": content,
+            "timestamp": datetime.utcnow()}
+
+
+async def run() -> bool:
+    client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://127.0.0.1:27017/?replicaSet=rs0"))
+    db = client[f"change_feed_check_{uuid.uuid4().hex[:8]}"]
+    feed = ChangeFeed(db, idle_timeout=1.0)
+    session_id, other_id = str(uuid.uuid4()), str(uuid.uuid4())
+    ok = True
+    try:
+        await db.chat_sessions.insert_one({"session_id": session_id, "status": "active", "message_count": 0})
+        events = feed.subscribe(session_id, keepalive=1.0)
+        others = feed.subscribe(other_id, keepalive=0.5)
+        first = asyncio.ensure_future(next_event(events))
+        await feed.wait_ready(5.0)
+
+        await db.messages.insert_one(message(session_id, "primo"))
+        event = await first
+        ok &= _check("messaggio ricevuto", event["type"] == "message" and event["data"]["content"] == "primo")
+        ok &= _check("nessun evento per l'altra sessione", await _no_event(others))
+
+        await db.chat_sessions.update_one({"session_id": session_id}, {"$set": {"message_count": 1}})
+        event = await next_event(events)
+        ok &= _check("aggiornamento sessione ricevuto", event["type"] == "session" and event["data"]["message_count"] == 1)
+        last_id = event["id"]
+        await events.aclose()
+
+        await db.messages.insert_one(message(session_id, "durante la disconnessione"))
+        resumed = feed.subscribe(session_id, resume_after=last_id, keepalive=1.0)
+        event = await next_event(resumed)
+        ok &= _check("evento perso recuperato col resume token", event["data"].get("content") == "durante la disconnessione")
+        await db.messages.insert_one(message(session_id, "dopo la riconnessione"))
+        event = await next_event(resumed)
+        ok &= _check("flusso live dopo il recupero", event["data"].get("content") == "dopo la riconnessione")
+        await resumed.aclose()
+        await others.aclose()
+    finally:
+        await feed.stop()
+        await client.drop_database(db.name)
+        client.close()
+    return ok
+
+
+async def _no_event(events) -> bool:
+    event = await asyncio.wait_for(events.__anext__(), 2.0)
+    return event is None
+
+
+def _check(name: str, passed: bool) -> bool:
+    print(f"{'OK  ' if passed else 'FAIL'} {name}")
+    return passed
+
+
+def main():
+    sys.exit(0 if asyncio.run(run()) else 1)
+
+
+if __name__ == "__main__":
+    main()
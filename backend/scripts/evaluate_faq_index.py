@@ -0,0 +1,52 @@
+"""Valutazione offline dell'indice FAQ su un insieme di domande etichettate.
+
+Per ogni soglia di confidenza riporta copertura (quota di domande a cui l'indice risponde),
+precisione (risposte con la voce attesa) e recall (domande in tema che ricevono la voce attesa).
+
+Uso (dalla cartella backend):
+    python -m scripts.evaluate_faq_index --eval-file data/faq_eval_it.json
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+
+from services.knowledge_index import DEFAULT_CONTENT_PATH, KnowledgeIndex
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--content", type=Path, default=DEFAULT_CONTENT_PATH)
+    parser.add_argument("--eval-file", type=Path, default=Path(__file__).parent.parent / "data" / "faq_eval_it.json")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.5, 0.6, 0.7, 0.8, 0.9, 1.0])
+    parser.add_argument("--verbose", action="store_true", help="stampa il risultato di ogni domanda")
+    args = parser.parse_args()
+
+    index = KnowledgeIndex.from_file(args.content)
+    with open(args.eval_file, encoding="utf-8") as f:
+        cases = json.load(f)
+
+    start = time.perf_counter()
+    results = [(case, index.search(case["query"])) for case in cases]
+    elapsed = time.perf_counter() - start
+
+    if args.verbose:
+        for case, match in results:
+            found = f"{match.entry.id} ({match.confidence:.2f})" if match else "-"
+            print(f"{case['query'][:55]:55} atteso={case['expected'] or '-':28} trovato={found}")
+        print()
+
+    in_scope = sum(1 for case in cases if case["expected"])
+    print(f"{len(cases)} domande ({in_scope} in tema), {elapsed / len(cases) * 1e6:.0f} µs per ricerca\n")
+    print(f"{'soglia':>7} {'copertura':>10} {'precisione':>11} {'recall':>7}")
+    for threshold in args.thresholds:
+        answered = [(case, match) for case, match in results if match and match.confidence >= threshold]
+        correct = sum(1 for case, match in answered if match.entry.id == case["expected"])
+        coverage = len(answered) / len(cases)
+        precision = correct / len(answered) if answered else 0.0
+        recall = correct / in_scope if in_scope else 0.0
+        print(f"{threshold:7.2f} {coverage:10.1%} {precision:11.1%} {recall:7.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Valutazione offline vettorializzata delle regole di urgenza e delle domande suggerite.
+
+Il corpus etichettato (CSV, JSONL o Parquet) deve avere le colonne:
+    user_message     messaggio dell'utente
+    response         risposta dell'assistente
+    urgency          etichetta attesa: low, medium o high
+    topics           (opzionale) argomenti attesi per le domande suggerite, separati da "|"
+
+Le regole candidate sono file JSON con le chiavi (tutte opzionali, le mancanti restano quelle attuali):
+    {"high": [...], "medium": [...], "user_medium": [...], "question_triggers": [...]}
+
+La presenza di ogni parola chiave viene calcolata una sola volta per l'unione di tutte le regole,
+in parallelo su più processi; ogni regola candidata si valuta poi con operazioni NumPy sulla matrice.
+
+Uso (dalla cartella backend):
+    python -m scripts.evaluate_urgency_rules corpus.parquet --rules candidata_a.json candidata_b.json
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from services.triage import (
+    HIGH_URGENCY_KEYWORDS, MEDIUM_URGENCY_KEYWORDS, USER_MEDIUM_URGENCY_KEYWORDS, SUGGESTED_QUESTION_RULES
+)
+
+LEVELS = ["low", "medium", "high"]
+
+
+def baseline_rules() -> Dict[str, List[str]]:
+    """Regole attualmente usate da AIService._analyze_response"""
+    return {
+        "high": list(HIGH_URGENCY_KEYWORDS),
+        "medium": list(MEDIUM_URGENCY_KEYWORDS),
+        "user_medium": list(USER_MEDIUM_URGENCY_KEYWORDS),
+        "question_triggers": [trigger for trigger, _ in SUGGESTED_QUESTION_RULES]
+    }
+
+
+def load_corpus(path: Path) -> pd.DataFrame:
+    if path.suffix == ".parquet":
+        frame = pd.read_parquet(path)
+    elif path.suffix in (".jsonl", ".ndjson"):
+        frame = pd.read_json(path, lines=True)
+    else:
+        frame = pd.read_csv(path)
+    frame["user_message"] = frame["user_message"].fillna("").str.lower()
+    frame["response"] = frame["response"].fillna("").str.lower()
+    frame["urgency"] = frame["urgency"].fillna("low").str.lower()
+    return frame
+
+
+def _presence_chunk(args) -> np.ndarray:
+    """Matrice booleana (parole chiave x righe) per un blocco del corpus"""
+    texts, keywords = args
+    series = pd.Series(texts, dtype="string")
+    matrix = np.zeros((len(keywords), len(series)), dtype=bool)
+    for i, keyword in enumerate(keywords):
+        matrix[i] = series.str.contains(keyword, regex=False).to_numpy(dtype=bool, na_value=False)
+    return matrix
+
+
+def presence_matrix(texts: pd.Series, keywords: List[str], workers: int, chunk_size: int) -> np.ndarray:
+    if not keywords:
+        return np.zeros((0, len(texts)), dtype=bool)
+    chunks = [(texts.iloc[start:start + chunk_size].tolist(), keywords) for start in range(0, len(texts), chunk_size)]
+    if workers <= 1 or len(chunks) == 1:
+        parts = [_presence_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(_presence_chunk, chunks))
+    return np.concatenate(parts, axis=1)
+
+
+class KeywordMatrix:
+    """Presenza precalcolata delle parole chiave nelle risposte e nei messaggi utente"""
+
+    def __init__(self, frame: pd.DataFrame, rule_sets: Dict[str, Dict], workers: int, chunk_size: int):
+        response_keywords = sorted({kw for rules in rule_sets.values() for kw in rules["high"] + rules["medium"]})
+        user_keywords = sorted({kw for rules in rule_sets.values() for kw in rules["user_medium"] + rules["question_triggers"]})
+        self.response_index = {kw: i for i, kw in enumerate(response_keywords)}
+        self.user_index = {kw: i for i, kw in enumerate(user_keywords)}
+        self.response = presence_matrix(frame["response"], response_keywords, workers, chunk_size)
+        self.user = presence_matrix(frame["user_message"], user_keywords, workers, chunk_size)
+        self.n_rows = len(frame)
+
+    def any_response(self, keywords: List[str]) -> np.ndarray:
+        rows = [self.response_index[kw] for kw in keywords]
+        return self.response[rows].any(axis=0) if rows else np.zeros(self.n_rows, dtype=bool)
+
+    def any_user(self, keywords: List[str]) -> np.ndarray:
+        rows = [self.user_index[kw] for kw in keywords]
+        return self.user[rows].any(axis=0) if rows else np.zeros(self.n_rows, dtype=bool)
+
+
+def predict_urgency(matrix: KeywordMatrix, rules: Dict) -> np.ndarray:
+    """Stessa precedenza di _analyze_response: alta, media nella risposta, media nel messaggio utente"""
+    predicted = np.zeros(matrix.n_rows, dtype=np.int8)
+    predicted[matrix.any_user(rules["user_medium"])] = 1
+    predicted[matrix.any_response(rules["medium"])] = 1
+    predicted[matrix.any_response(rules["high"])] = 2
+    return predicted
+
+
+def urgency_report(labels: np.ndarray, predicted: np.ndarray) -> Dict:
+    report = {"accuracy": float((labels == predicted).mean()) if len(labels) else 0.0}
+    for code, level in enumerate(LEVELS):
+        true_positive = int(((predicted == code) & (labels == code)).sum())
+        predicted_count = int((predicted == code).sum())
+        support = int((labels == code).sum())
+        precision = true_positive / predicted_count if predicted_count else 0.0
+        recall = true_positive / support if support else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        report[level] = {"precision": precision, "recall": recall, "f1": f1, "support": support}
+    return report
+
+
+def topic_report(frame: pd.DataFrame, matrix: KeywordMatrix, rules: Dict) -> Dict:
+    """Precisione/recall micro dei trigger delle domande suggerite rispetto agli argomenti attesi"""
+    if "topics" not in frame:
+        return {}
+    topics = "|" + frame["topics"].fillna("").str.lower() + "|"
+    true_positive = predicted_total = expected_total = 0
+    for trigger in rules["question_triggers"]:
+        fired = matrix.any_user([trigger])
+        wanted = topics.str.contains(f"|{trigger}|", regex=False).to_numpy(dtype=bool)
+        true_positive += int((fired & wanted).sum())
+        predicted_total += int(fired.sum())
+        expected_total += int(wanted.sum())
+    return {
+        "precision": true_positive / predicted_total if predicted_total else 0.0,
+        "recall": true_positive / expected_total if expected_total else 0.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("corpus", type=Path)
+    parser.add_argument("--rules", type=Path, nargs="*", default=[], help="file JSON di regole candidate")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=20000)
+    parser.add_argument("--json", action="store_true", help="stampa il report in JSON")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    frame = load_corpus(args.corpus)
+    labels = frame["urgency"].map({level: code for code, level in enumerate(LEVELS)}).fillna(0).to_numpy(dtype=np.int8)
+    loaded = time.perf_counter()
+
+    rule_sets = {"baseline": baseline_rules()}
+    for path in args.rules:
+        rule_sets[path.stem] = {**baseline_rules(), **json.loads(path.read_text())}
+
+    matrix = KeywordMatrix(frame, rule_sets, args.workers, args.chunk_size)
+    indexed = time.perf_counter()
+
+    reports = {}
+    for name, rules in rule_sets.items():
+        reports[name] = {
+            "urgency": urgency_report(labels, predict_urgency(matrix, rules)),
+            "questions": topic_report(frame, matrix, rules)
+        }
+    evaluated = time.perf_counter()
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+        return
+
+    print(f"{len(frame)} trascrizioni, {len(rule_sets)} regole: caricamento {loaded - start:.2f}s, "
+          f"matrice parole chiave {indexed - loaded:.2f}s, valutazione {evaluated - indexed:.3f}s\n")
+    for name, report in reports.items():
+        urgency = report["urgency"]
+        print(f"== {name}  (accuratezza {urgency['accuracy']:.1%})")
+        print(f"   {'livello':8} {'precisione':>10} {'recall':>8} {'f1':>6} {'supporto':>9}")
+        for level in LEVELS:
+            stats = urgency[level]
+            print(f"   {level:8} {stats['precision']:10.1%} {stats['recall']:8.1%} {stats['f1']:6.2f} {stats['support']:9d}")
+        if report["questions"]:
+            print(f"   domande suggerite: precisione {report['questions']['precision']:.1%}, "
+                  f"recall {report['questions']['recall']:.1%}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""Export in streaming delle conversazioni (sessioni + profili + messaggi) per analisi.
+
+Formati:
+    ndjson   una sessione per riga, appesa al file di output
+    parquet  una riga per messaggio, un file part-NNNNN.parquet per lotto nella cartella di output
+
+Il checkpoint (ultimo session_id esportato) viene salvato dopo ogni lotto: rilanciando lo stesso
+comando l'export riprende da dove si era fermato.
+
+Uso (dalla cartella backend, con MONGO_URL e DB_NAME impostati):
+    python -m scripts.export_conversations --format ndjson --output export.ndjson
+    python -m scripts.export_conversations --format parquet --output export_parquet/ --since 2025-01-01
+"""
+import argparse
+import asyncio
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from services.export_service import ExportService, FLAT_COLUMNS, flatten_session, to_ndjson_line
+
+
+def load_checkpoint(path: Path) -> dict:
+    if path.exists():
+        return json.loads(path.read_text())
+    return {"last_session_id": None, "sessions": 0, "parts": 0}
+
+
+def save_checkpoint(path: Path, checkpoint: dict):
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    tmp_path.write_text(json.dumps(checkpoint))
+    os.replace(tmp_path, path)
+
+
+def write_parquet_part(directory: Path, part: int, documents: list):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Per l'export parquet serve pyarrow: pip install pyarrow")
+
+    rows = [row for document in documents for row in flatten_session(document)]
+    table = pa.Table.from_pylist(rows, schema=pa.schema([
+        (column, pa.timestamp("ms") if column in ("session_start_time", "session_end_time", "timestamp")
+         else pa.int64() if column == "intensita" else pa.string())
+        for column in FLAT_COLUMNS
+    ]))
+    pq.write_table(table, directory / f"part-{part:05d}.parquet", compression="zstd")
+
+
+async def run(args):
+    load_dotenv(Path(__file__).parent.parent / ".env")
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+    db = client[os.environ["DB_NAME"]]
+    export_service = ExportService(db, batch_size=args.batch_size)
+
+    output = Path(args.output)
+    checkpoint_path = Path(args.checkpoint) if args.checkpoint else Path(f"{output.as_posix().rstrip('/')}.checkpoint.json")
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint["last_session_id"]:
+        print(f"Ripresa dopo session_id {checkpoint['last_session_id']} ({checkpoint['sessions']} sessioni già esportate)")
+
+    if args.format == "parquet":
+        output.mkdir(parents=True, exist_ok=True)
+        ndjson_file = None
+    else:
+        ndjson_file = open(output, "a", encoding="utf-8")
+
+    batch = []
+
+    def flush_batch():
+        if not batch:
+            return
+        if ndjson_file:
+            ndjson_file.writelines(to_ndjson_line(document) for document in batch)
+            ndjson_file.flush()
+            os.fsync(ndjson_file.fileno())
+        else:
+            checkpoint["parts"] += 1
+            write_parquet_part(output, checkpoint["parts"], batch)
+        checkpoint["last_session_id"] = batch[-1]["session_id"]
+        checkpoint["sessions"] += len(batch)
+        save_checkpoint(checkpoint_path, checkpoint)
+        batch.clear()
+
+    try:
+        async for document in export_service.iter_sessions(
+            after_session_id=checkpoint["last_session_id"],
+            since=args.since,
+            until=args.until
+        ):
+            batch.append(document)
+            if len(batch) >= args.batch_size:
+                flush_batch()
+                print(f"{checkpoint['sessions']} sessioni esportate", end="\r")
+        flush_batch()
+    finally:
+        if ndjson_file:
+            ndjson_file.close()
+        client.close()
+
+    print(f"Export completato: {checkpoint['sessions']} sessioni, checkpoint in {checkpoint_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--format", choices=["ndjson", "parquet"], default="ndjson")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--checkpoint", help="file di checkpoint (default: <output>.checkpoint.json)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--since", type=datetime.fromisoformat)
+    parser.add_argument("--until", type=datetime.fromisoformat)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
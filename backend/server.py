@@ -1,27 +1,49 @@
-from fastapi import FastAPI, APIRouter
+from fastapi import FastAPI, APIRouter, Depends, Query, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import json
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List
+from typing import List, Optional
 import uuid
 from datetime import datetime
 
-# Import delle route
-import sys
-import os
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+# Import delle route: il backend si avvia dalla sua cartella (uvicorn server:app, oppure --app-dir backend)
 from routes.chat_routes import router as chat_router
+from routes.admin_routes import router as admin_router, require_admin
+from routes.analytics_routes import router as analytics_router
+from services.metrics import metrics
+from services.write_behind import init_write_behind, shutdown_write_behind
+from services.turn_coordinator import init_turn_coordinator
+from services.analytics_service import init_rollup_job, shutdown_rollup_job
+from services.health import pool_monitor, get_health_prober, init_health_prober, shutdown_health_prober
+from services.session_sweeper import init_session_sweeper, shutdown_session_sweeper
+from services.warmup import start_warmup, shutdown_warmup
+from services.logging_config import RequestIdMiddleware, configure_logging, shutdown_logging
+from services.change_feed import init_change_feed, shutdown_change_feed
+from services.request_profiler import ProfilingMiddleware, init_request_profiler, shutdown_request_profiler
+from services.drain import get_drain_controller
+from services.conversation_state import init_conversation_store, shutdown_conversation_store
+from services.turn_events import init_turn_event_log, shutdown_turn_event_log
+from services.speculation import init_speculative_responder, shutdown_speculative_responder
+from services.traffic_capture import TrafficCaptureMiddleware, get_traffic_recorder, shutdown_traffic_recorder
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=pool_monitor.max_pool_size,
+    minPoolSize=int(os.environ.get('MONGO_MIN_POOL_SIZE', '10')),
+    event_listeners=[pool_monitor]
+)
 db = client[os.environ['DB_NAME']]
 
 # Create the main app without a prefix
@@ -51,37 +73,139 @@ async def create_status_check(input: StatusCheckCreate):
     _ = await db.status_checks.insert_one(status_obj.dict())
     return status_obj
 
+# Come prima della paginazione: fino a 1000 status check in ordine di inserimento
+STATUS_PAGE_DEFAULT = 1000
+STATUS_PAGE_MAX = 1000
+STATUS_STREAM_BATCH_SIZE = int(os.environ.get('STATUS_STREAM_BATCH_SIZE', '500'))
+
+def _status_sort(order: str) -> list:
+    direction = -1 if order == "desc" else 1
+    return [("timestamp", direction), ("id", direction)]
+
+def _status_keyset_filter(order: str, cursor: Optional[datetime], cursor_id: Optional[str]) -> dict:
+    # Paginazione keyset su (timestamp, id): costo costante a qualsiasi profondità, in entrambe le direzioni
+    if not cursor:
+        return {}
+    op = "$lt" if order == "desc" else "$gt"
+    if not cursor_id:
+        return {"timestamp": {op: cursor}}
+    return {"$or": [
+        {"timestamp": {op: cursor}},
+        {"timestamp": cursor, "id": {op: cursor_id}}
+    ]}
+
+async def _stream_status_checks(query: dict, order: str, limit: Optional[int]):
+    cursor = db.status_checks.find(query, {"_id": 0}).sort(_status_sort(order)).batch_size(STATUS_STREAM_BATCH_SIZE)
+    if limit:
+        cursor = cursor.limit(limit)
+    async for status_check in cursor:
+        yield StatusCheck(**status_check).json() + "\n"
+
 @api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    status_checks = await db.status_checks.find().to_list(1000)
+async def get_status_checks(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    after: Optional[datetime] = None,
+    after_id: Optional[str] = None,
+    before: Optional[datetime] = None,
+    before_id: Optional[str] = None,
+    stream: bool = False
+):
+    """Status check dal più vecchio (order=desc dal più recente); stream=true restituisce NDJSON senza limite di pagina.
+
+    La pagina successiva parte da after/after_id (ordine asc) o before/before_id (ordine desc),
+    presi dagli header X-Next-After(-Id) / X-Next-Before(-Id) della risposta.
+    """
+    if order == "desc":
+        query = _status_keyset_filter(order, before, before_id)
+    else:
+        query = _status_keyset_filter(order, after, after_id)
+    
+    if stream:
+        return StreamingResponse(_stream_status_checks(query, order, limit), media_type="application/x-ndjson")
+    
+    page_size = min(limit or STATUS_PAGE_DEFAULT, STATUS_PAGE_MAX)
+    status_checks = await db.status_checks.find(query, {"_id": 0}).sort(
+        _status_sort(order)
+    ).limit(page_size).to_list(page_size)
+    
+    # Cursore per la pagina successiva negli header, il corpo resta una lista come prima
+    if len(status_checks) == page_size:
+        last = status_checks[-1]
+        prefix = "X-Next-Before" if order == "desc" else "X-Next-After"
+        response.headers[prefix] = last["timestamp"].isoformat()
+        response.headers[f"{prefix}-Id"] = last["id"]
+    
     return [StatusCheck(**status_check) for status_check in status_checks]
 
+@api_router.get("/status/summary")
+async def get_status_summary(since: Optional[datetime] = None):
+    """Solo conteggi: stima dai metadati della collezione, conteggio esatto se è indicato since"""
+    if since:
+        count = await db.status_checks.count_documents({"timestamp": {"$gte": since}})
+    else:
+        count = await db.status_checks.estimated_document_count()
+    
+    latest = await db.status_checks.find_one({}, {"_id": 0, "timestamp": 1}, sort=[("timestamp", -1)])
+    return {
+        "count": count,
+        "since": since,
+        "latest_timestamp": latest["timestamp"] if latest else None
+    }
+
 # Health check per la nuova API
 @api_router.get("/health")
 async def health_check():
-    """Health check endpoint per verificare lo stato dell'API"""
-    try:
-        # Test connessione database
-        await db.command("ping")
-        
-        # Test variabili ambiente
-        gemini_key = os.environ.get('GEMINI_API_KEY')
-        
-        return {
-            "status": "healthy",
-            "database": "connected",
-            "ai_service": "configured" if gemini_key else "not_configured",
-            "timestamp": datetime.utcnow().isoformat()
-        }
-    except Exception as e:
+    """Health check endpoint per verificare lo stato dell'API (servito dallo stato del prober)"""
+    prober = get_health_prober()
+    if not prober:
+        return {"status": "unhealthy", "error": "prober non avviato", "timestamp": datetime.utcnow().isoformat()}
+    
+    _, state = prober.readiness()
+    gemini_key = os.environ.get('GEMINI_API_KEY')
+    
+    if state["database"] != "connected":
         return {
             "status": "unhealthy",
-            "error": str(e),
+            "error": state["database_error"] or state["database"],
             "timestamp": datetime.utcnow().isoformat()
         }
+    
+    return {
+        "status": "healthy",
+        "database": "connected",
+        "ai_service": "configured" if gemini_key else "not_configured",
+        "llm_breaker": state["llm_breaker"],
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+@api_router.get("/health/live")
+async def liveness_probe():
+    """Liveness: nessun accesso a database o rete"""
+    prober = get_health_prober()
+    return prober.liveness() if prober else {"status": "alive"}
+
+@api_router.get("/health/ready")
+async def readiness_probe():
+    """Readiness: 503 se il database non risponde o lo stato del prober è scaduto"""
+    prober = get_health_prober()
+    if not prober:
+        return JSONResponse(status_code=503, content={"ready": False, "not_ready_reasons": ["startup"]})
+    
+    ready, state = prober.readiness()
+    return JSONResponse(status_code=200 if ready else 503, content=jsonable_encoder(state))
+
+# Metriche in-process (write-behind, cache, code): solo con token amministratore, come /api/admin
+@api_router.get("/metrics", dependencies=[Depends(require_admin)])
+async def get_metrics():
+    """Restituisce uno snapshot delle metriche del processo"""
+    return metrics.snapshot()
 
 # Include chat routes
 api_router.include_router(chat_router)
+api_router.include_router(admin_router)
+api_router.include_router(analytics_router)
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -92,21 +216,169 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "X-Profile-Id", "X-Next-After", "X-Next-After-Id", "X-Next-Before", "X-Next-Before-Id"],
 )
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Cattura opzionale del traffico /api/chat/* per il replay (benchmarks/replay_traffic.py)
+traffic_recorder = get_traffic_recorder()
+if traffic_recorder:
+    app.add_middleware(TrafficCaptureMiddleware, recorder=traffic_recorder)
+
+# Profilazione per singola richiesta (header X-Profile-Request con token admin, o PROFILING_SAMPLE_RATE)
+request_profiler = init_request_profiler(db)
+if request_profiler:
+    app.add_middleware(ProfilingMiddleware, profiler=request_profiler)
+
+# Correlation ID per richiesta, incluso in ogni log emesso durante la sua gestione
+app.add_middleware(RequestIdMiddleware)
+
+# Log JSON tramite coda: la scrittura su stderr avviene in un thread, non sull'event loop
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Log startup info
 logger.info("MedAgent API starting...")
-logger.info(f"Database: {os.environ.get('DB_NAME', 'Not configured')}")
-logger.info(f"Gemini API: {'Configured' if os.environ.get('GEMINI_API_KEY') else 'Not configured'}")
+logger.info("Database: %s", os.environ.get('DB_NAME', 'Not configured'))
+logger.info("Gemini API: %s", 'Configured' if os.environ.get('GEMINI_API_KEY') else 'Not configured')
+
+@app.on_event("startup")
+async def startup_status_checks():
+    # La collezione status_checks cresce con i ping: indice per la paginazione e limite opzionale
+    capped_bytes = int(os.environ.get('STATUS_CHECKS_CAPPED_BYTES', '0'))
+    ttl_seconds = int(os.environ.get('STATUS_CHECKS_TTL_SECONDS', '0'))
+    try:
+        if capped_bytes:
+            existing = await db.list_collection_names(filter={"name": "status_checks"})
+            if not existing:
+                await db.create_collection("status_checks", capped=True, size=capped_bytes)
+            else:
+                options = await db.status_checks.options()
+                if not options.get("capped"):
+                    logger.warning("status_checks esiste già e non è capped: usare convertToCapped manualmente")
+        
+        await db.status_checks.create_index([("timestamp", -1), ("id", -1)])
+        if ttl_seconds:
+            await db.status_checks.create_index("timestamp", name="timestamp_ttl", expireAfterSeconds=ttl_seconds)
+    except Exception as e:
+        logger.error("Errore configurazione status_checks: %s", e)
+
+@app.on_event("startup")
+async def startup_write_behind():
+    # Modalità write-behind opzionale per i salvataggi dei messaggi; WRITE_BEHIND_JOURNAL è il percorso
+    # base, ogni worker usa in esclusiva il primo journal libero (path, path.1, ...)
+    if os.environ.get('WRITE_BEHIND_ENABLED', 'false').lower() == 'true':
+        await init_write_behind(
+            db,
+            journal_path=os.environ.get('WRITE_BEHIND_JOURNAL', str(ROOT_DIR / 'data' / 'write_behind.journal')),
+            batch_size=int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', '500')),
+            flush_interval=float(os.environ.get('WRITE_BEHIND_FLUSH_INTERVAL', '0.05'))
+        )
+
+@app.on_event("startup")
+async def startup_turn_coordinator():
+    # Serializzazione dei turni per sessione: "memory" (singolo worker) o "mongo" (lease distribuite)
+    await init_turn_coordinator(db, backend_name=os.environ.get('TURN_LOCK_BACKEND', 'memory'))
+
+@app.on_event("startup")
+async def startup_health_prober():
+    # Probe di salute in background: gli endpoint /health leggono solo lo stato in memoria
+    await init_health_prober(db)
+
+@app.on_event("startup")
+async def startup_rollup_job():
+    # Rollup orari/giornalieri per gli endpoint /api/analytics
+    try:
+        if os.environ.get('ANALYTICS_ROLLUPS_ENABLED', 'true').lower() == 'true':
+            await init_rollup_job(db, interval=float(os.environ.get('ANALYTICS_ROLLUP_INTERVAL', '300')))
+    except Exception as e:
+        logger.error("Errore avvio rollup analytics: %s", e)
+
+@app.on_event("startup")
+async def startup_session_sweeper():
+    # Sessioni attive senza attività da SESSION_IDLE_MINUTES passano in "abandoned"
+    if os.environ.get('SESSION_SWEEPER_ENABLED', 'true').lower() == 'true':
+        await init_session_sweeper(
+            db,
+            idle_minutes=float(os.environ.get('SESSION_IDLE_MINUTES', '60')),
+            interval=float(os.environ.get('SESSION_SWEEP_INTERVAL', '300')),
+            batch_size=int(os.environ.get('SESSION_SWEEP_BATCH_SIZE', '500'))
+        )
+
+@app.on_event("startup")
+async def startup_change_feed():
+    # Push dei nuovi messaggi via /api/chat/stream: richiede un replica set (anche a nodo singolo)
+    if os.environ.get('CHANGE_FEED_ENABLED', 'false').lower() == 'true':
+        init_change_feed(
+            db,
+            max_queue=int(os.environ.get('CHANGE_FEED_MAX_QUEUE', '256')),
+            idle_timeout=float(os.environ.get('CHANGE_FEED_IDLE_TIMEOUT', '60'))
+        )
+
+@app.on_event("startup")
+async def startup_turn_event_log():
+    # Eventi di turno append-only in turn_events, leggibili per offset da /api/admin/events
+    if os.environ.get('TURN_EVENTS_ENABLED', 'true').lower() == 'true':
+        try:
+            await init_turn_event_log(
+                db,
+                batch_size=int(os.environ.get('TURN_EVENTS_BATCH_SIZE', '200')),
+                flush_interval=float(os.environ.get('TURN_EVENTS_FLUSH_INTERVAL', '0.5')),
+                max_buffer=int(os.environ.get('TURN_EVENTS_MAX_BUFFER', '10000'))
+            )
+        except Exception as e:
+            logger.error("Errore avvio log eventi di turno: %s", e)
+
+@app.on_event("startup")
+async def startup_conversation_store():
+    # Conversazione per sessione con prefisso stabile: ad ogni turno si invia solo il nuovo messaggio
+    if os.environ.get('LLM_INCREMENTAL_CONVERSATIONS', 'false').lower() == 'true':
+        init_conversation_store(db)
+
+@app.on_event("startup")
+async def startup_speculative_responder():
+    # Risposte alle domande suggerite generate in anticipo con la capacità LLM libera (richiede admission control)
+    if os.environ.get('LLM_SPECULATION_ENABLED', 'false').lower() == 'true':
+        init_speculative_responder()
+
+@app.on_event("startup")
+async def startup_traffic_capture():
+    if traffic_recorder:
+        traffic_recorder.start()
+
+@app.on_event("startup")
+async def startup_request_profiler():
+    if request_profiler:
+        try:
+            await request_profiler.ensure_indexes()
+        except Exception as e:
+            logger.error("Errore indici profili richieste: %s", e)
+
+@app.on_event("startup")
+async def startup_warmup():
+    # Pool Mongo, indici, client AI e indice FAQ pronti prima che la readiness diventi positiva
+    start_warmup(db, min_pool_size=int(os.environ.get('MONGO_MIN_POOL_SIZE', '10')))
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # Drain: nessun nuovo turno, quelli in corso finiscono chiamata LLM e salvataggi prima di chiudere i pool
+    report = await get_drain_controller().drain(float(os.environ.get('SHUTDOWN_DRAIN_TIMEOUT', '20')))
+    await shutdown_speculative_responder()
+    await shutdown_warmup()
+    await shutdown_change_feed()
+    await shutdown_session_sweeper()
+    await shutdown_rollup_job()
+    await shutdown_health_prober()
+    await shutdown_write_behind()
+    await shutdown_turn_event_log()
+    shutdown_conversation_store()
+    await shutdown_request_profiler()
+    shutdown_traffic_recorder()
+    logger.info("Metriche finali: %s", json.dumps(metrics.snapshot(), default=str))
     client.close()
-    logger.info("MedAgent API shutdown complete")
+    logger.info("MedAgent API shutdown complete: %d turni conclusi nel drain, %d interrotti dopo %.1fs",
+                report["drained"], report["cut"], report["elapsed_seconds"])
+
+@app.on_event("shutdown")
+async def shutdown_log_listener():
+    # Ultimo hook registrato: i log degli hook precedenti passano ancora dalla coda
+    shutdown_logging()
@@ -0,0 +1,228 @@
+import os
+import sys
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import List, Optional, Tuple
+
+from models.message import Message
+from services.memory_budget import budget_from_env, deep_sizeof, memory
+from services.metrics import metrics
+from services.triage import detect_red_flags, mentions_symptoms
+
+logger = logging.getLogger(__name__)
+
+# Priorità dei turni: valori più bassi vengono serviti prima
+PRIORITY_HIGH = 0
+PRIORITY_MEDIUM = 1
+PRIORITY_LOW = 2
+
+# Costo per voce della tabella hash e della lista doppiamente collegata di OrderedDict (CPython 64 bit, circa)
+_ORDERED_DICT_ENTRY_BYTES = 100
+
+
+class AdmissionRejected(Exception):
+    """Richiesta rifiutata prima di raggiungere il modello; retry_after in secondi"""
+
+    def __init__(self, reason: str, retry_after: float, status_code: int = 503):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+    def headers(self) -> dict:
+        return {"Retry-After": str(max(1, int(self.retry_after + 0.999)))}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def try_take(self, now: float) -> Tuple[bool, float]:
+        """Consuma un token se disponibile; altrimenti restituisce i secondi da attendere"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True, 0.0
+        return False, (1 - self.tokens) / self.rate if self.rate else 60.0
+
+
+class _BucketMap:
+    """Token bucket per chiave con numero massimo di chiavi: le meno recenti vengono scartate"""
+
+    def __init__(self, rate: float, burst: float, max_keys: int, max_bytes: Optional[int] = None):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.max_bytes = max_bytes
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        # Tutti i bucket hanno la stessa forma: la stima si fa una volta, la chiave si misura a parte
+        self._bucket_bytes = deep_sizeof(TokenBucket(rate, burst)) + _ORDERED_DICT_ENTRY_BYTES
+        self._bytes = sys.getsizeof(self._buckets)
+
+    def _entry_bytes(self, key: str) -> int:
+        return self._bucket_bytes + sys.getsizeof(key)
+
+    def memory_usage(self) -> dict:
+        return {"bytes": self._bytes, "entries": len(self._buckets), "budget_bytes": self.max_bytes}
+
+    def try_take(self, key: str, now: float) -> Tuple[bool, float]:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            self._bytes += self._entry_bytes(key)
+            while len(self._buckets) > self.max_keys or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                evicted, _ = self._buckets.popitem(last=False)
+                self._bytes -= self._entry_bytes(evicted)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.try_take(now)
+
+
+def estimate_priority(user_message: str, session_urgency: Optional[str] = None,
+                      conversation_history: Optional[List[Message]] = None) -> int:
+    """Stima a basso costo dell'urgenza del turno, prima di chiamare il modello"""
+    if detect_red_flags(user_message) or session_urgency == "high":
+        return PRIORITY_HIGH
+    if any(msg.urgency_level == "high" for msg in (conversation_history or [])):
+        return PRIORITY_HIGH
+    if session_urgency == "medium" or mentions_symptoms(user_message):
+        return PRIORITY_MEDIUM
+    return PRIORITY_LOW
+
+
+class AdmissionController:
+    """Limita i turni diretti al modello: token bucket per IP e per sessione, concorrenza massima
+    e coda con priorità. Quando la coda è piena o l'attesa supera max_wait la richiesta viene
+    rifiutata subito con un Retry-After, invece di accumularsi senza limite."""
+
+    def __init__(self, max_concurrency: int = 32, max_queue: int = 100, max_wait: float = 10.0,
+                 ip_rate: float = 2.0, ip_burst: float = 20.0, session_rate: float = 0.5, session_burst: float = 5.0,
+                 max_tracked_keys: int = 10000, max_tracked_bytes: Optional[int] = None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._ip_buckets = _BucketMap(ip_rate, ip_burst, max_tracked_keys, max_tracked_bytes)
+        self._session_buckets = _BucketMap(session_rate, session_burst, max_tracked_keys, max_tracked_bytes)
+        memory.register("admission.ip_buckets", self._ip_buckets)
+        memory.register("admission.session_buckets", self._session_buckets)
+
+        self._active = 0
+        self._queued = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+
+        self._admitted = metrics.counter("admission.admitted")
+        self._queue_wait = metrics.histogram("admission.queue_wait_seconds")
+        self._service_time = metrics.histogram("admission.service_seconds")
+        metrics.gauge("admission.queue_depth", lambda: self._queued)
+        metrics.gauge("admission.active", lambda: self._active)
+
+    def _shed(self, reason: str, retry_after: float, status_code: int = 503) -> AdmissionRejected:
+        metrics.counter(f"admission.shed.{reason}").inc()
+        return AdmissionRejected(reason, retry_after, status_code)
+
+    def check_rate(self, client_ip: Optional[str], session_id: str):
+        """Token bucket per IP e per sessione; i limiti superati rispondono 429"""
+        now = time.monotonic()
+        if client_ip:
+            allowed, wait = self._ip_buckets.try_take(client_ip, now)
+            if not allowed:
+                raise self._shed("ip_rate", wait, status_code=429)
+        allowed, wait = self._session_buckets.try_take(session_id, now)
+        if not allowed:
+            raise self._shed("session_rate", wait, status_code=429)
+
+    def has_spare_capacity(self, fraction: float) -> bool:
+        """Vero se nessun turno è in coda e gli slot occupati sono sotto la frazione indicata"""
+        return not self._queued and self._active < self.max_concurrency * fraction
+
+    def _estimated_wait(self) -> float:
+        avg = self._service_time.snapshot()["avg"] or 1.0
+        return avg * (self._queued + 1) / self.max_concurrency
+
+    async def _acquire(self, priority: int):
+        if self._active < self.max_concurrency and not self._queued:
+            self._active += 1
+            return
+        if self._queued >= self.max_queue:
+            raise self._shed("queue_full", self._estimated_wait())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._queued += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            raise self._shed("queue_timeout", self._estimated_wait())
+        except BaseException:
+            # Annullata dopo aver ricevuto lo slot: va restituito, altrimenti la capacità si perde
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+        finally:
+            if not future.done() or future.cancelled():
+                # Timeout o richiesta annullata: la voce resta nell'heap e viene scartata al rilascio
+                self._queued -= 1
+            self._queue_wait.observe(time.perf_counter() - start)
+
+    def _release(self):
+        # Lo slot passa direttamente al prossimo in attesa con priorità migliore
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._queued -= 1
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_LOW):
+        await self._acquire(priority)
+        self._admitted.inc()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._service_time.observe(time.perf_counter() - start)
+            self._release()
+
+
+_controller: Optional[AdmissionController] = None
+
+
+def get_admission_controller() -> Optional[AdmissionController]:
+    """Controller condiviso, creato al primo uso; None se non abilitato con ADMISSION_ENABLED=true"""
+    global _controller
+    if os.environ.get('ADMISSION_ENABLED', 'false').lower() != 'true':
+        return None
+    if _controller is None:
+        _controller = AdmissionController(
+            max_concurrency=int(os.environ.get('ADMISSION_MAX_CONCURRENCY', '32')),
+            max_queue=int(os.environ.get('ADMISSION_MAX_QUEUE', '100')),
+            max_wait=float(os.environ.get('ADMISSION_MAX_WAIT', '10')),
+            ip_rate=float(os.environ.get('ADMISSION_IP_RATE', '2')),
+            ip_burst=float(os.environ.get('ADMISSION_IP_BURST', '20')),
+            session_rate=float(os.environ.get('ADMISSION_SESSION_RATE', '0.5')),
+            session_burst=float(os.environ.get('ADMISSION_SESSION_BURST', '5')),
+            max_tracked_bytes=budget_from_env('ADMISSION_MAX_TRACKED_MB', 8)
+        )
+    return _controller
+
+
+def client_ip(headers, client) -> Optional[str]:
+    """IP del chiamante; X-Forwarded-For solo se il proxy davanti al backend è fidato"""
+    if os.environ.get('ADMISSION_TRUST_PROXY', 'false').lower() == 'true':
+        forwarded = headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return client.host if client else None
@@ -1,15 +1,35 @@
 import os
 import asyncio
 import logging
-from typing import List, Dict, Optional, Tuple
-from emergentintegrations.llm.chat import LlmChat, UserMessage
+from typing import TYPE_CHECKING, List, Dict, Optional, Tuple
 from models.user_profile import UserProfile
 from models.message import Message
+from services.llm_router import LlmRouter, ModelTier, get_llm_router
+from services.conversation_state import ConversationStore, estimate_tokens, get_conversation_store
+from services.knowledge_index import FaqMatch, FaqResolver, get_faq_resolver
+from services.triage import (
+    detect_red_flags, HIGH_URGENCY_KEYWORDS, MEDIUM_URGENCY_KEYWORDS, USER_MEDIUM_URGENCY_KEYWORDS,
+    SUGGESTED_QUESTION_RULES, GENERIC_QUESTIONS
+)
+
+if TYPE_CHECKING:
+    from emergentintegrations.llm.chat import LlmChat
+    from services.similarity_cache import SimilarityCache
 
 logger = logging.getLogger(__name__)
 
+
+def _shared_similarity_cache() -> Optional["SimilarityCache"]:
+    # numpy viene importato solo se la cache è attiva
+    if os.environ.get('SIMILARITY_CACHE_ENABLED', 'false').lower() != 'true':
+        return None
+    from services.similarity_cache import get_similarity_cache
+    return get_similarity_cache()
+
 class AIService:
-    def __init__(self):
+    def __init__(self, router: Optional[LlmRouter] = None, faq_resolver: Optional[FaqResolver] = None,
+                 similarity_cache: Optional["SimilarityCache"] = None,
+                 conversation_store: Optional[ConversationStore] = None):
         self.api_key = os.environ.get('GEMINI_API_KEY')
         if not self.api_key:
             raise ValueError("GEMINI_API_KEY environment variable is required")
@@ -17,6 +37,19 @@ class AIService:
         # Inizializza il sistema di prompt per MedAgent
         self.system_prompt = self._create_system_prompt()
         
+        # Routing per tier di modello e hedging delle chiamate lente
+        self.router = router or get_llm_router()
+        
+        # Indice locale delle domande frequenti (None se disabilitato)
+        self.faq_resolver = faq_resolver or get_faq_resolver()
+        
+        # Cache delle risposte a domande quasi identiche (None se disabilitata)
+        self.similarity_cache = similarity_cache if similarity_cache is not None else _shared_similarity_cache()
+        
+        # Conversazioni incrementali per sessione (None se disabilitate): letto ad ogni turno perché
+        # lo store condiviso nasce all'avvio dell'app, dopo questo servizio
+        self._conversation_store = conversation_store
+        
     def _create_system_prompt(self) -> str:
         return """Sei MedAgent, un assistente sanitario AI specializzato nell'orientamento e supporto cognitivo per la salute.
 
@@ -51,18 +84,34 @@ EMERGENZE - Raccomanda IMMEDIATAMENTE di chiamare il 118 per:
 
 Ricorda: Il tuo obiettivo è guidare l'utente verso decisioni informate sulla propria salute, non sostituire il parere medico professionale."""
 
-    async def create_chat_session(self, session_id: str) -> LlmChat:
-        """Crea una nuova sessione di chat con Gemini"""
+    async def warm_up(self):
+        """Carica l'SDK e costruisce un client per ogni tier, così il primo turno non ne paga il costo"""
+        for tier in self.router.tiers.values():
+            await self.create_chat_session("warmup", tier)
+
+    @property
+    def conversation_store(self) -> Optional[ConversationStore]:
+        return self._conversation_store or get_conversation_store()
+
+    async def create_chat_session(self, session_id: str, tier: Optional[ModelTier] = None,
+                                  system_message: Optional[str] = None,
+                                  initial_messages: Optional[List[Dict]] = None) -> "LlmChat":
+        """Crea una nuova sessione di chat con il modello del tier indicato (standard se assente)"""
+        # SDK importato al primo uso e non all'avvio: è la dipendenza più lenta da caricare
+        from emergentintegrations.llm.chat import LlmChat
+        tier = tier or self.router.tiers["standard"]
         try:
+            options = {"initial_messages": initial_messages} if initial_messages else {}
             chat = LlmChat(
                 api_key=self.api_key,
                 session_id=session_id,
-                system_message=self.system_prompt
-            ).with_model("gemini", "gemini-2.0-flash").with_max_tokens(1500)
+                system_message=system_message or self.system_prompt,
+                **options
+            ).with_model(tier.provider, tier.model).with_max_tokens(tier.max_tokens)
             
             return chat
         except Exception as e:
-            logger.error(f"Errore creazione sessione chat: {e}")
+            logger.error("Errore creazione sessione chat: %s", e)
             raise
 
     async def generate_response(
@@ -75,31 +124,50 @@ Ricorda: Il tuo obiettivo è guidare l'utente verso decisioni informate sulla pr
         """Genera una risposta AI basata sul messaggio utente e contesto"""
         
         try:
-            # Crea sessione chat
-            chat = await self.create_chat_session(session_id)
+            # Domande educative frequenti: risposta diretta dall'indice locale, senza chiamare il modello
+            faq_match = self._lookup_faq(user_message, conversation_history)
+            if faq_match and self.faq_resolver.is_direct(faq_match, user_message, user_profile, conversation_history):
+                urgency_level, next_questions = self._analyze_response("", user_message)
+                return faq_match.entry.answer, urgency_level, faq_match.entry.next_questions[:3] or next_questions
             
-            # Costruisci il contesto se disponibile
-            context_message = self._build_context_message(user_profile, conversation_history)
+            # Parafrasi di domande già risposte: solo primi turni senza dati personali e senza segnali di emergenza
+            cacheable = self.similarity_cache is not None and self.similarity_cache.is_cacheable(
+                user_message, user_profile, conversation_history
+            )
+            # La risposta vale solo per lo stesso contesto che arriva al prompt (profilo, benvenuto)
+            cache_context = self._build_context_message(user_profile, conversation_history) if cacheable else ""
+            if cacheable:
+                cached = self.similarity_cache.get(user_message, context=cache_context)
+                if cached:
+                    return cached.response, cached.urgency_level, cached.next_questions
             
-            # Prepara il messaggio finale
-            if context_message:
-                full_message = f"{context_message}\n\nUtente: {user_message}"
-            else:
-                full_message = user_message
+            # Sceglie il tier del modello per questo turno
+            tier = self.router.select_tier(user_message, user_profile, conversation_history)
             
-            # Crea il messaggio utente
-            user_msg = UserMessage(text=full_message)
+            store = self.conversation_store
+            if store is not None:
+                response = await self._send_incremental(store, session_id, user_message, user_profile, tier, faq_match)
+                urgency_level, next_questions = self._analyze_response(response, user_message)
+                if cacheable and urgency_level != "high":
+                    self.similarity_cache.put(user_message, response, urgency_level, next_questions,
+                                              context=cache_context)
+                return response, urgency_level, next_questions
             
-            # Ottieni la risposta da Gemini
-            response = await chat.send_message(user_msg)
+            response = await self._send_stateless(session_id, user_message, user_profile, conversation_history,
+                                                  tier, faq_match)
             
             # Analizza la risposta per estrarre urgenza e domande
             urgency_level, next_questions = self._analyze_response(response, user_message)
             
+            # Le risposte ad urgenza alta non vengono mai riusate
+            if cacheable and urgency_level != "high":
+                self.similarity_cache.put(user_message, response, urgency_level, next_questions,
+                                          context=cache_context)
+            
             return response, urgency_level, next_questions
             
         except Exception as e:
-            logger.error(f"Errore generazione risposta AI: {e}")
+            logger.error("Errore generazione risposta AI: %s", e)
             # Fallback response
             return (
                 "Mi dispiace, sto avendo difficoltà tecniche. Per favore riprova o contatta un medico se hai sintomi preoccupanti.",
@@ -107,6 +175,119 @@ Ricorda: Il tuo obiettivo è guidare l'utente verso decisioni informate sulla pr
                 ["Puoi ripetere la tua domanda?", "Hai altri sintomi da riferire?"]
             )
 
+    async def generate_speculative_response(
+        self,
+        session_id: str,
+        user_message: str,
+        user_profile: Optional[UserProfile],
+        conversation_history: List[Message],
+        usage: Dict[str, int]
+    ) -> Tuple[str, str, List[str]]:
+        """Risposta anticipata a una domanda suggerita, generata in background.
+
+        Stesso contesto di un turno normale ma senza hedging, cache di similarità e conversazione
+        incrementale: la risposta potrebbe non essere mai servita. Gli errori vengono propagati
+        invece di diventare la risposta di fallback; usage riceve i token stimati.
+        """
+        faq_match = self._lookup_faq(user_message, conversation_history)
+        if faq_match and self.faq_resolver.is_direct(faq_match, user_message, user_profile, conversation_history):
+            urgency_level, next_questions = self._analyze_response("", user_message)
+            return faq_match.entry.answer, urgency_level, faq_match.entry.next_questions[:3] or next_questions
+        
+        tier = self.router.select_tier(user_message, user_profile, conversation_history)
+        response = await self._send_stateless(f"{session_id}-speculative", user_message, user_profile,
+                                              conversation_history, tier, faq_match, hedge=False, usage=usage)
+        urgency_level, next_questions = self._analyze_response(response, user_message)
+        return response, urgency_level, next_questions
+
+    async def _send_stateless(
+        self,
+        session_id: str,
+        user_message: str,
+        user_profile: Optional[UserProfile],
+        conversation_history: Optional[List[Message]],
+        tier: ModelTier,
+        faq_match: Optional[FaqMatch],
+        hedge: bool = True,
+        usage: Optional[Dict[str, int]] = None
+    ) -> str:
+        """Invia profilo e storia ricostruiti in un unico messaggio insieme a quello dell'utente"""
+        # Costruisci il contesto se disponibile
+        context_message = self._build_context_message(user_profile, conversation_history)
+        
+        # Match a media confidenza: la risposta della FAQ diventa un riferimento per il modello
+        if faq_match:
+            reference = f"INFORMAZIONI DI RIFERIMENTO:\n{faq_match.entry.answer}"
+            context_message = f"{reference}\n\n{context_message}" if context_message else reference
+        
+        # Prepara il messaggio finale
+        if context_message:
+            full_message = f"{context_message}\n\nUtente: {user_message}"
+        else:
+            full_message = user_message
+        
+        # Crea il messaggio utente
+        from emergentintegrations.llm.chat import UserMessage
+        user_msg = UserMessage(text=full_message)
+        
+        if usage is not None:
+            usage["input_tokens"] = estimate_tokens(self.system_prompt) + estimate_tokens(full_message)
+        
+        # Ottieni la risposta dal modello, con richiesta di backup se la prima tarda
+        response = await self.router.send(
+            tier,
+            lambda: self.create_chat_session(session_id, tier),
+            user_msg,
+            make_backup_chat=lambda: self.create_chat_session(f"{session_id}-hedge", tier),
+            hedge=hedge
+        )
+        if usage is not None:
+            usage["output_tokens"] = estimate_tokens(response)
+        return response
+
+    async def _send_incremental(
+        self,
+        store: ConversationStore,
+        session_id: str,
+        user_message: str,
+        user_profile: Optional[UserProfile],
+        tier: ModelTier,
+        faq_match: Optional[FaqMatch]
+    ) -> str:
+        """Invia solo il nuovo messaggio in coda alla conversazione della sessione.
+
+        Profilo nel messaggio di sistema e turni precedenti come messaggi separati: il prefisso
+        della richiesta è identico a quello del turno prima, quindi riutilizzabile dalla cache
+        dei prefissi del provider, e il contesto non viene riserializzato in un unico messaggio.
+        """
+        profile_context = self._build_context_message(user_profile, None)
+        state = await store.prepare(session_id, user_message, profile_context)
+        system_message = f"{self.system_prompt}\n\n{profile_context}" if profile_context else self.system_prompt
+        
+        # Il riferimento FAQ vale solo per questo turno: non entra nella trascrizione salvata
+        text = user_message
+        if faq_match:
+            text = f"INFORMAZIONI DI RIFERIMENTO:\n{faq_match.entry.answer}\n\nUtente: {user_message}"
+        
+        from emergentintegrations.llm.chat import UserMessage
+        initial_messages = list(state.transcript)
+        response = await self.router.send(
+            tier,
+            lambda: self.create_chat_session(session_id, tier, system_message, initial_messages),
+            UserMessage(text=text),
+            make_backup_chat=lambda: self.create_chat_session(f"{session_id}-hedge", tier, system_message, initial_messages)
+        )
+        store.append(state, user_message, response)
+        return response
+
+    def _lookup_faq(self, user_message: str, conversation_history: Optional[List[Message]]) -> Optional[FaqMatch]:
+        """Consulta l'indice FAQ solo per turni senza segnali di emergenza"""
+        if not self.faq_resolver or detect_red_flags(user_message):
+            return None
+        if any(msg.urgency_level == "high" for msg in (conversation_history or [])):
+            return None
+        return self.faq_resolver.lookup(user_message)
+
     def _build_context_message(
         self, 
         user_profile: Optional[UserProfile], 
@@ -159,24 +340,12 @@ Ricorda: Il tuo obiettivo è guidare l'utente verso decisioni informate sulla pr
         # Determina livello di urgenza
         urgency_level = "low"
         
-        # Parole chiave per alta urgenza
-        high_urgency_keywords = [
-            "118", "emergenza", "pronto soccorso", "immediatamente", "urgente",
-            "dolore toracico", "difficoltà respiratorie", "perdita coscienza"
-        ]
-        
-        # Parole chiave per media urgenza  
-        medium_urgency_keywords = [
-            "medico", "contatta", "febbre alta", "persistente", "preoccupante",
-            "valutazione", "controllo medico"
-        ]
-        
         # Analizza urgenza
-        if any(keyword in response_lower for keyword in high_urgency_keywords):
+        if any(keyword in response_lower for keyword in HIGH_URGENCY_KEYWORDS):
             urgency_level = "high"
-        elif any(keyword in response_lower for keyword in medium_urgency_keywords):
+        elif any(keyword in response_lower for keyword in MEDIUM_URGENCY_KEYWORDS):
             urgency_level = "medium"
-        elif any(keyword in user_message_lower for keyword in ["dolore", "febbre", "male"]):
+        elif any(keyword in user_message_lower for keyword in USER_MEDIUM_URGENCY_KEYWORDS):
             urgency_level = "medium"
         
         # Genera domande suggerite basate sul contenuto
@@ -190,41 +359,13 @@ Ricorda: Il tuo obiettivo è guidare l'utente verso decisioni informate sulla pr
         questions = []
         
         # Domande basate sui sintomi menzionati
-        if "febbre" in user_message:
-            questions.extend([
-                "Hai misurato la temperatura di recente?",
-                "Hai brividi o sudorazione?",
-                "Hai preso farmaci per la febbre?"
-            ])
-        
-        if "dolore" in user_message:
-            questions.extend([
-                "Puoi descrivere meglio il tipo di dolore?",
-                "Il dolore è costante o va e viene?",
-                "Cosa peggiora o migliora il dolore?"
-            ])
-        
-        if "mal di testa" in user_message:
-            questions.extend([
-                "Hai sensibilità alla luce?",
-                "Il mal di testa è accompagnato da nausea?",
-                "Dove è localizzato il dolore?"
-            ])
-        
-        if "tosse" in user_message:
-            questions.extend([
-                "La tosse è secca o con catarro?",
-                "Hai difficoltà a respirare?",
-                "Da quanto tempo hai la tosse?"
-            ])
+        for trigger, trigger_questions in SUGGESTED_QUESTION_RULES:
+            if trigger in user_message:
+                questions.extend(trigger_questions)
         
         # Domande generiche se non match specifici
         if not questions:
-            questions.extend([
-                "Puoi descrivere altri sintomi?",
-                "Come ti senti in generale?",
-                "C'è qualcos'altro che ti preoccupa?"
-            ])
+            questions.extend(GENERIC_QUESTIONS)
         
         # Ritorna massimo 3 domande
         return questions[:3]
@@ -251,4 +392,15 @@ Ricorda: Il tuo obiettivo è guidare l'utente verso decisioni informate sulla pr
             "Come descrivi l'intensità del disturbo?"
         ]
         
-        return welcome_message, "low", initial_questions
\ No newline at end of file
+        return welcome_message, "low", initial_questions
+
+
+_ai_service: Optional[AIService] = None
+
+
+def get_ai_service() -> AIService:
+    """Istanza condivisa: prompt di sistema, router e cache costruiti una sola volta per processo"""
+    global _ai_service
+    if _ai_service is None:
+        _ai_service = AIService()
+    return _ai_service
@@ -0,0 +1,245 @@
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReplaceOne
+
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = ("hour", "day")
+URGENCY_LEVELS = ("low", "medium", "high")
+
+
+def _hour_bucket_expr(field: str) -> Dict:
+    # $dateFromParts invece di $dateTrunc per restare compatibili con MongoDB < 5.0
+    return {"$dateFromParts": {
+        "year": {"$year": field},
+        "month": {"$month": field},
+        "day": {"$dayOfMonth": field},
+        "hour": {"$hour": field}
+    }}
+
+
+def _truncate(value: datetime, granularity: str) -> datetime:
+    value = value.replace(minute=0, second=0, microsecond=0)
+    return value.replace(hour=0) if granularity == "day" else value
+
+
+def _empty_rollup(granularity: str, bucket: datetime) -> Dict:
+    return {
+        "_id": f"{granularity}:{bucket.isoformat()}",
+        "granularity": granularity,
+        "bucket": bucket,
+        "sessions_started": 0,
+        "sessions_by_urgency": {level: 0 for level in URGENCY_LEVELS},
+        "messages_by_type": {"user": 0, "assistant": 0},
+        "symptoms": []
+    }
+
+
+class AnalyticsService:
+    """Rollup orari e giornalieri calcolati con pipeline di aggregazione; le query leggono solo i rollup"""
+
+    def __init__(self, db: AsyncIOMotorDatabase, lookback_hours: int = 6):
+        self.db = db
+        self.rollups = db.analytics_rollups
+        self.state = db.analytics_state
+        # Le sessioni cambiano urgenza dopo l'avvio: le ultime ore vengono ricalcolate ad ogni giro
+        self.lookback_hours = lookback_hours
+
+    async def ensure_indexes(self):
+        await self.rollups.create_index([("granularity", 1), ("bucket", 1)])
+        await self.db.chat_sessions.create_index("start_time")
+        await self.db.user_profiles.create_index("created_at")
+        await self.db.messages.create_index("timestamp")
+
+    async def _aggregate_hours(self, start: datetime, end: datetime) -> Dict[datetime, Dict]:
+        """Calcola i rollup orari di [start, end) con tre pipeline lato server"""
+        rollups: Dict[datetime, Dict] = {}
+        hour = start
+        while hour < end:
+            rollups[hour] = _empty_rollup("hour", hour)
+            hour += timedelta(hours=1)
+
+        sessions = self.db.chat_sessions.aggregate([
+            {"$match": {"start_time": {"$gte": start, "$lt": end}}},
+            {"$group": {
+                "_id": {"bucket": _hour_bucket_expr("$start_time"), "urgency": "$current_urgency_level"},
+                "count": {"$sum": 1}
+            }}
+        ])
+        async for row in sessions:
+            rollup = rollups.get(row["_id"]["bucket"])
+            if rollup is None:
+                continue
+            rollup["sessions_started"] += row["count"]
+            urgency = row["_id"]["urgency"] or "low"
+            rollup["sessions_by_urgency"][urgency] = rollup["sessions_by_urgency"].get(urgency, 0) + row["count"]
+
+        profiles = self.db.user_profiles.aggregate([
+            {"$match": {"created_at": {"$gte": start, "$lt": end}, "sintomo_principale": {"$nin": [None, ""]}}},
+            {"$group": {
+                "_id": {
+                    "bucket": _hour_bucket_expr("$created_at"),
+                    "symptom": {"$toLower": {"$trim": {"input": "$sintomo_principale"}}}
+                },
+                "count": {"$sum": 1}
+            }}
+        ])
+        async for row in profiles:
+            rollup = rollups.get(row["_id"]["bucket"])
+            if rollup is not None:
+                rollup["symptoms"].append({"name": row["_id"]["symptom"], "count": row["count"]})
+
+        messages = self.db.messages.aggregate([
+            {"$match": {"timestamp": {"$gte": start, "$lt": end}}},
+            {"$group": {
+                "_id": {"bucket": _hour_bucket_expr("$timestamp"), "type": "$message_type"},
+                "count": {"$sum": 1}
+            }}
+        ])
+        async for row in messages:
+            rollup = rollups.get(row["_id"]["bucket"])
+            if rollup is not None:
+                message_type = row["_id"]["type"] or "unknown"
+                rollup["messages_by_type"][message_type] = rollup["messages_by_type"].get(message_type, 0) + row["count"]
+
+        return rollups
+
+    async def _rebuild_days(self, days: List[datetime]):
+        """I rollup giornalieri si ricavano dai 24 rollup orari, senza rileggere i dati grezzi"""
+        operations = []
+        for day in days:
+            daily = _empty_rollup("day", day)
+            symptoms: Dict[str, int] = {}
+            async for hourly in self.rollups.find({
+                "granularity": "hour",
+                "bucket": {"$gte": day, "$lt": day + timedelta(days=1)}
+            }):
+                daily["sessions_started"] += hourly["sessions_started"]
+                for level, count in hourly["sessions_by_urgency"].items():
+                    daily["sessions_by_urgency"][level] = daily["sessions_by_urgency"].get(level, 0) + count
+                for message_type, count in hourly["messages_by_type"].items():
+                    daily["messages_by_type"][message_type] = daily["messages_by_type"].get(message_type, 0) + count
+                for symptom in hourly["symptoms"]:
+                    symptoms[symptom["name"]] = symptoms.get(symptom["name"], 0) + symptom["count"]
+            daily["symptoms"] = [{"name": name, "count": count} for name, count in symptoms.items()]
+            daily["updated_at"] = datetime.utcnow()
+            operations.append(ReplaceOne({"_id": daily["_id"]}, daily, upsert=True))
+        if operations:
+            await self.rollups.bulk_write(operations, ordered=False)
+
+    async def refresh(self, now: Optional[datetime] = None, max_window: timedelta = timedelta(days=7)) -> int:
+        """Aggiorna i rollup dall'ultimo watermark; idempotente, quindi sicuro anche con più worker"""
+        now = now or datetime.utcnow()
+        end = _truncate(now, "hour") + timedelta(hours=1)
+
+        state = await self.state.find_one({"_id": "rollups"})
+        if state and state.get("watermark"):
+            start = min(state["watermark"], end) - timedelta(hours=self.lookback_hours)
+        else:
+            first = await self.db.chat_sessions.find_one({}, {"start_time": 1}, sort=[("start_time", 1)])
+            start = _truncate(first["start_time"], "hour") if first else end - timedelta(hours=self.lookback_hours)
+
+        buckets_written = 0
+        window_start = start
+        while window_start < end:
+            window_end = min(end, window_start + max_window)
+            rollups = await self._aggregate_hours(window_start, window_end)
+            now_ts = datetime.utcnow()
+            operations = []
+            for rollup in rollups.values():
+                rollup["updated_at"] = now_ts
+                operations.append(ReplaceOne({"_id": rollup["_id"]}, rollup, upsert=True))
+            if operations:
+                await self.rollups.bulk_write(operations, ordered=False)
+            days = sorted({_truncate(bucket, "day") for bucket in rollups})
+            await self._rebuild_days(days)
+            buckets_written += len(operations) + len(days)
+
+            await self.state.update_one({"_id": "rollups"}, {"$set": {"watermark": window_end}}, upsert=True)
+            window_start = window_end
+
+        return buckets_written
+
+    async def get_rollups(self, granularity: str, start: datetime, end: datetime) -> List[Dict]:
+        cursor = self.rollups.find(
+            {"granularity": granularity, "bucket": {"$gte": _truncate(start, granularity), "$lt": end}},
+            {"_id": 0}
+        ).sort("bucket", 1)
+        return await cursor.to_list(None)
+
+    async def urgency_series(self, granularity: str, start: datetime, end: datetime) -> List[Dict]:
+        """Sessioni avviate per bucket, divise per livello di urgenza"""
+        return [
+            {
+                "bucket": rollup["bucket"],
+                "sessions_started": rollup["sessions_started"],
+                "sessions_by_urgency": rollup["sessions_by_urgency"]
+            }
+            for rollup in await self.get_rollups(granularity, start, end)
+        ]
+
+    async def top_symptoms(self, granularity: str, start: datetime, end: datetime, top: int = 10) -> List[Dict]:
+        """Sintomi principali più frequenti nell'intervallo, sommando i rollup"""
+        totals: Dict[str, int] = {}
+        for rollup in await self.get_rollups(granularity, start, end):
+            for symptom in rollup["symptoms"]:
+                totals[symptom["name"]] = totals.get(symptom["name"], 0) + symptom["count"]
+        ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+        return [{"sintomo_principale": name, "count": count} for name, count in ranked]
+
+
+class RollupJob:
+    """Job in background che aggiorna periodicamente i rollup"""
+
+    def __init__(self, analytics_service: AnalyticsService, interval: float = 300.0):
+        self.analytics_service = analytics_service
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await self.analytics_service.ensure_indexes()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            try:
+                written = await self.analytics_service.refresh()
+                metrics.counter("analytics.rollups_written").inc(written)
+                metrics.histogram("analytics.refresh_seconds").observe(time.perf_counter() - start)
+            except Exception as e:
+                metrics.counter("analytics.refresh_errors").inc()
+                logger.error("Errore aggiornamento rollup analytics: %s", e)
+            await asyncio.sleep(self.interval)
+
+
+_rollup_job: Optional[RollupJob] = None
+
+
+async def init_rollup_job(db: AsyncIOMotorDatabase, interval: float = 300.0) -> RollupJob:
+    global _rollup_job
+    _rollup_job = RollupJob(AnalyticsService(db), interval=interval)
+    await _rollup_job.start()
+    return _rollup_job
+
+
+async def shutdown_rollup_job():
+    global _rollup_job
+    if _rollup_job:
+        await _rollup_job.stop()
+        _rollup_job = None
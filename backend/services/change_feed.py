@@ -0,0 +1,283 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, Optional, Set
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import OperationFailure, PyMongoError
+
+from services.memory_budget import deep_sizeof, memory
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+WATCHED_COLLECTIONS = ["messages", "chat_sessions"]
+
+_MESSAGE_FIELDS = ("id", "session_id", "message_type", "content", "urgency_level", "next_questions", "timestamp")
+_SESSION_FIELDS = ("session_id", "status", "current_urgency_level", "message_count", "updated_at", "end_time")
+
+# Segnale di chiusura inserito nelle code degli iscritti durante il drain
+_CLOSED = {"type": "closed"}
+
+
+def _change_pipeline(session_id: Optional[str] = None) -> List[Dict]:
+    match = {
+        "ns.coll": {"$in": WATCHED_COLLECTIONS},
+        "operationType": {"$in": ["insert", "update", "replace"]}
+    }
+    if session_id:
+        match["fullDocument.session_id"] = session_id
+    # Solo i campi inoltrati ai client: documenti più piccoli sul cursore condiviso
+    projection = {"_id": 1, "ns.coll": 1}
+    projection.update({f"fullDocument.{field}": 1 for field in set(_MESSAGE_FIELDS + _SESSION_FIELDS)})
+    return [{"$match": match}, {"$project": projection}]
+
+
+def to_event(change: Dict) -> Optional[Dict]:
+    """Evento per i client: id = resume token del change stream, usabile per riprendere dopo una disconnessione"""
+    document = change.get("fullDocument")
+    if not document or not document.get("session_id"):
+        return None
+    if change["ns"]["coll"] == "messages":
+        event_type, fields = "message", _MESSAGE_FIELDS
+    else:
+        event_type, fields = "session", _SESSION_FIELDS
+    return {
+        "id": change["_id"]["_data"],
+        "type": event_type,
+        "session_id": document["session_id"],
+        "data": {field: document.get(field) for field in fields}
+    }
+
+
+class _Subscriber:
+    def __init__(self, max_queue: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.overflowed = False
+
+
+class ChangeFeed:
+    """Un solo change stream Mongo per processo su messages e chat_sessions, distribuito in memoria
+    agli iscritti di ciascuna sessione.
+
+    Il cursore condiviso è aperto solo finché ci sono iscritti (più idle_timeout). Alla riconnessione
+    con l'ultimo id ricevuto, e per un iscritto lento che ha riempito la coda, gli eventi mancanti
+    arrivano da un change stream dedicato, filtrato sulla sessione; se il token non è più valido
+    il client riceve un evento "reset" e ricarica la cronologia.
+    Richiede un replica set (anche a nodo singolo): su un mongod standalone watch() fallisce.
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase, max_queue: int = 256, idle_timeout: float = 60.0,
+                 retry_delay: float = 1.0, max_retry_delay: float = 30.0):
+        self.db = db
+        self.max_queue = max_queue
+        self.idle_timeout = idle_timeout
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._subscribers: Dict[str, Set[_Subscriber]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._idle_handle: Optional[asyncio.TimerHandle] = None
+        self._ready = asyncio.Event()
+        self._closing = False
+
+        self._events = metrics.counter("change_feed.events")
+        self._delivered = metrics.counter("change_feed.delivered")
+        self._overflows = metrics.counter("change_feed.overflows")
+        self._errors = metrics.counter("change_feed.errors")
+        metrics.gauge("change_feed.subscribers", lambda: sum(len(subs) for subs in self._subscribers.values()))
+        memory.register("change_feed", self)
+
+    def memory_usage(self) -> dict:
+        # Limitata da max_queue eventi per iscritto
+        return {
+            "bytes": deep_sizeof(self._subscribers),
+            "entries": sum(len(subs) for subs in self._subscribers.values()),
+            "budget_bytes": None
+        }
+
+    def _dispatch(self, change: Dict):
+        event = to_event(change)
+        if not event:
+            return
+        self._events.inc()
+        for subscriber in list(self._subscribers.get(event["session_id"], ())):
+            if subscriber.overflowed:
+                continue
+            try:
+                subscriber.queue.put_nowait(event)
+                self._delivered.inc()
+            except asyncio.QueueFull:
+                # Non si blocca il cursore condiviso per un client lento
+                subscriber.overflowed = True
+                self._overflows.inc()
+
+    async def _watch(self):
+        token = None
+        delay = self.retry_delay
+        while True:
+            try:
+                async with self.db.watch(_change_pipeline(), full_document="updateLookup",
+                                         resume_after=token) as stream:
+                    self._ready.set()
+                    delay = self.retry_delay
+                    async for change in stream:
+                        token = change["_id"]
+                        self._dispatch(change)
+            except asyncio.CancelledError:
+                raise
+            except PyMongoError as e:
+                self._ready.clear()
+                self._errors.inc()
+                logger.error("Errore change stream condiviso: %s", e)
+                if isinstance(e, OperationFailure) and e.code == 286:
+                    # Storia persa (oplog superato): si riparte da adesso, gli iscritti ricevono un reset
+                    token = None
+                    for subscribers in self._subscribers.values():
+                        for subscriber in subscribers:
+                            subscriber.overflowed = True
+                await asyncio.sleep(delay)
+                delay = min(self.max_retry_delay, delay * 2)
+
+    def _ensure_watching(self):
+        if self._idle_handle:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._watch())
+
+    def _stop_if_idle(self):
+        self._idle_handle = None
+        if not self._subscribers and self._task:
+            self._task.cancel()
+            self._task = None
+            self._ready.clear()
+
+    def _add(self, session_id: str) -> _Subscriber:
+        subscriber = _Subscriber(self.max_queue)
+        self._subscribers.setdefault(session_id, set()).add(subscriber)
+        self._ensure_watching()
+        return subscriber
+
+    def _remove(self, session_id: str, subscriber: _Subscriber):
+        subscribers = self._subscribers.get(session_id)
+        if subscribers:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[session_id]
+        if not self._subscribers and self._task and not self._idle_handle:
+            self._idle_handle = asyncio.get_running_loop().call_later(self.idle_timeout, self._stop_if_idle)
+
+    async def _catch_up(self, session_id: str, resume_after: str) -> AsyncIterator[Dict]:
+        """Eventi della sessione dal resume token fino ad ora, da un change stream dedicato"""
+        async with self.db.watch(_change_pipeline(session_id), full_document="updateLookup",
+                                 resume_after={"_data": resume_after}) as stream:
+            while True:
+                change = await stream.try_next()
+                if change is None:
+                    return
+                event = to_event(change)
+                if event:
+                    yield event
+
+    async def subscribe(self, session_id: str, resume_after: Optional[str] = None,
+                        keepalive: float = 15.0) -> AsyncIterator[Optional[Dict]]:
+        """Eventi della sessione; None ogni `keepalive` secondi senza eventi.
+
+        L'iscrizione al flusso condiviso precede il recupero, quindi nessun evento cade tra i due:
+        i doppioni sono scartati confrontando gli id. Se la coda dell'iscritto trabocca, gli eventi
+        persi si recuperano allo stesso modo dall'ultimo id consegnato.
+        """
+        subscriber = self._add(session_id)
+        last_id = resume_after
+        try:
+            # Con il cursore condiviso appena avviato, il recupero parte solo quando è aperto
+            await self.wait_ready(timeout=5.0)
+            caught_up: Set[str] = set()
+            needs_catch_up = bool(resume_after)
+            while not self._closing:
+                if needs_catch_up:
+                    needs_catch_up = False
+                    try:
+                        async for event in self._catch_up(session_id, last_id):
+                            caught_up.add(event["id"])
+                            last_id = event["id"]
+                            yield event
+                    except OperationFailure as e:
+                        # Token scaduto o non valido: il client deve ricaricare la cronologia
+                        logger.warning("Resume token non utilizzabile per %s: %s", session_id, e)
+                        caught_up.clear()
+                        yield {"type": "reset", "session_id": session_id}
+
+                if subscriber.overflowed and subscriber.queue.empty():
+                    subscriber.overflowed = False
+                    if last_id:
+                        needs_catch_up = True
+                    else:
+                        yield {"type": "reset", "session_id": session_id}
+                    continue
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if event is _CLOSED:
+                    return
+                if caught_up:
+                    if event["id"] in caught_up:
+                        continue
+                    # Il primo evento nuovo chiude la sovrapposizione con il recupero
+                    caught_up.clear()
+                last_id = event["id"]
+                yield event
+        finally:
+            self._remove(session_id, subscriber)
+
+    def close_subscribers(self):
+        """Termina gli stream aperti e rifiuta i nuovi: usato dal drain prima dello spegnimento"""
+        self._closing = True
+        for subscribers in self._subscribers.values():
+            for subscriber in subscribers:
+                try:
+                    subscriber.queue.put_nowait(_CLOSED)
+                except asyncio.QueueFull:
+                    # La coda piena viene svuotata dall'iscritto, che poi vede _closing
+                    pass
+
+    async def wait_ready(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def stop(self):
+        if self._idle_handle:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+_feed: Optional[ChangeFeed] = None
+
+
+def get_change_feed() -> Optional[ChangeFeed]:
+    return _feed
+
+
+def init_change_feed(db: AsyncIOMotorDatabase, max_queue: int = 256, idle_timeout: float = 60.0) -> ChangeFeed:
+    global _feed
+    _feed = ChangeFeed(db, max_queue=max_queue, idle_timeout=idle_timeout)
+    logger.info("Change feed attivo su %s", ", ".join(WATCHED_COLLECTIONS))
+    return _feed
+
+
+async def shutdown_change_feed():
+    global _feed
+    if _feed:
+        await _feed.stop()
+        memory.unregister("change_feed")
+        _feed = None
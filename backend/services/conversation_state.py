@@ -0,0 +1,216 @@
+import os
+import sys
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from services.memory_budget import budget_from_env, memory
+from services.metrics import metrics
+from services.write_behind import get_write_behind
+
+logger = logging.getLogger(__name__)
+
+# Costo fisso per messaggio della trascrizione (dizionario e stringa del ruolo), CPython 64 bit circa
+_MESSAGE_OVERHEAD_BYTES = 300
+_STATE_OVERHEAD_BYTES = 600
+
+_ROLES = {"user": "user", "assistant": "assistant"}
+
+
+def estimate_tokens(text: str) -> int:
+    """Stima grossolana per testo italiano: circa 4 caratteri per token"""
+    return (len(text) + 3) // 4
+
+
+def window_start(total: int, max_messages: int, keep_messages: int) -> int:
+    """Indice del primo messaggio della sessione incluso nella trascrizione.
+
+    Dipende solo dal numero di messaggi: la finestra cresce fino a max_messages e poi scorre a
+    scatti di (max_messages - keep_messages), così il prefisso inviato al modello resta identico
+    per più turni di fila e qualunque worker, ricostruendo da Mongo, ottiene la stessa trascrizione.
+    """
+    if total <= max_messages:
+        return 0
+    step = max_messages - keep_messages
+    return (total - keep_messages) // step * step
+
+
+class ConversationState:
+    """Trascrizione di una sessione così come la vede il modello: profilo nel messaggio di sistema,
+    poi i turni, in sola aggiunta tra uno scorrimento della finestra e il successivo"""
+
+    __slots__ = ("session_id", "profile_context", "transcript", "start", "total", "size_bytes")
+
+    def __init__(self, session_id: str, profile_context: str, transcript: List[Dict], start: int, total: int):
+        self.session_id = session_id
+        self.profile_context = profile_context
+        self.transcript = transcript
+        self.start = start
+        self.total = total
+        self.size_bytes = 0
+
+    def matches(self, last_message: Optional[Dict]) -> bool:
+        """Vero se l'ultimo messaggio salvato è anche l'ultimo della trascrizione"""
+        if not self.transcript:
+            return last_message is None
+        if last_message is None:
+            return False
+        last = self.transcript[-1]
+        return last["role"] == _ROLES.get(last_message["message_type"]) and last["content"] == last_message["content"]
+
+
+class ConversationStore:
+    """Conversazioni in memoria per sessione (LRU con budget), ricostruibili da Mongo.
+
+    Ad ogni turno si verifica con una lettura indicizzata che l'ultimo messaggio salvato coincida
+    con la trascrizione in memoria: se un altro worker, il benvenuto o una risposta FAQ hanno
+    aggiunto messaggi, o la sessione era stata sfrattata, la trascrizione viene ricostruita.
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase, max_messages: int = 12, keep_messages: int = 4,
+                 max_sessions: int = 10000, max_bytes: Optional[int] = None):
+        if not 0 < keep_messages < max_messages:
+            raise ValueError("keep_messages deve essere minore di max_messages")
+        self.messages = db.messages
+        self.max_messages = max_messages
+        self.keep_messages = keep_messages
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._states: "OrderedDict[str, ConversationState]" = OrderedDict()
+        self._bytes = 0
+
+        self._hits = metrics.counter("conversations.hits")
+        self._rehydrated = metrics.counter("conversations.rehydrated")
+        self._evicted = metrics.counter("conversations.evicted")
+        metrics.gauge("conversations.sessions", lambda: len(self._states))
+
+    def memory_usage(self) -> dict:
+        return {"bytes": self._bytes, "entries": len(self._states), "budget_bytes": self.max_bytes}
+
+    def _size(self, state: ConversationState) -> int:
+        return (_STATE_OVERHEAD_BYTES + sys.getsizeof(state.profile_context)
+                + sum(_MESSAGE_OVERHEAD_BYTES + sys.getsizeof(message["content"]) for message in state.transcript))
+
+    def _store(self, state: ConversationState):
+        previous = self._states.pop(state.session_id, None)
+        if previous is not None:
+            self._bytes -= previous.size_bytes
+        state.size_bytes = self._size(state)
+        self._states[state.session_id] = state
+        self._bytes += state.size_bytes
+        while self._states and (len(self._states) > self.max_sessions
+                                or (self.max_bytes and self._bytes > self.max_bytes)):
+            _, evicted = self._states.popitem(last=False)
+            self._bytes -= evicted.size_bytes
+            self._evicted.inc()
+
+    def discard(self, session_id: str):
+        state = self._states.pop(session_id, None)
+        if state is not None:
+            self._bytes -= state.size_bytes
+
+    async def _recent_messages(self, session_id: str, limit: int) -> List[Dict]:
+        """Ultimi messaggi salvati, dal più recente, inclusi quelli ancora nel write-behind"""
+        cursor = self.messages.find(
+            {"session_id": session_id}, {"_id": 0, "id": 1, "message_type": 1, "content": 1, "timestamp": 1}
+        ).sort("timestamp", -1).limit(limit)
+        recent = await cursor.to_list(length=limit)
+        write_behind = get_write_behind()
+        pending = write_behind.pending_messages(session_id) if write_behind else []
+        if pending:
+            known_ids = {message["id"] for message in recent}
+            recent.extend(doc for doc in pending if doc["id"] not in known_ids)
+            recent.sort(key=lambda message: message["timestamp"], reverse=True)
+            del recent[limit:]
+        return recent
+
+    async def _window_messages(self, session_id: str, start: int, end: int, stored: int,
+                               pending: List[Dict]) -> List[Dict]:
+        """Messaggi della sessione dalla posizione start a end esclusa, in ordine cronologico.
+
+        I messaggi ancora nel write-behind sono i più recenti: seguono tutti gli stored già su Mongo.
+        """
+        window = []
+        if start < stored:
+            cursor = self.messages.find(
+                {"session_id": session_id}, {"_id": 0, "id": 1, "message_type": 1, "content": 1}
+            ).sort("timestamp", 1).skip(start).limit(end - start)
+            window = await cursor.to_list(length=end - start)
+        window.extend(pending[max(0, start - stored):])
+        return window[:end - start]
+
+    async def prepare(self, session_id: str, user_message: str, profile_context: str) -> ConversationState:
+        """Trascrizione dei messaggi precedenti al turno corrente, dalla memoria o ricostruita da Mongo.
+
+        Il messaggio utente del turno può essere già stato salvato (come fa la route) oppure no:
+        in entrambi i casi non fa parte della trascrizione restituita.
+        """
+        recent = await self._recent_messages(session_id, 2)
+        current_saved = bool(recent) and recent[0]["message_type"] == "user" and recent[0]["content"] == user_message
+        last_previous = recent[1 if current_saved else 0] if len(recent) > int(current_saved) else None
+
+        state = self._states.get(session_id)
+        if state is not None and state.profile_context == profile_context and state.matches(last_previous):
+            self._states.move_to_end(session_id)
+            self._hits.inc()
+            return state
+
+        stored = await self.messages.count_documents({"session_id": session_id})
+        write_behind = get_write_behind()
+        pending = write_behind.pending_messages(session_id) if write_behind else []
+        # Durante un flush del write-behind un messaggio può contare due volte: al più la finestra si sposta di uno
+        total = stored + len(pending) - int(current_saved)
+        start = window_start(total, self.max_messages, self.keep_messages)
+        transcript = []
+        if total > start:
+            # Il messaggio del turno corrente, se già salvato, è in posizione total e resta fuori
+            for message in await self._window_messages(session_id, start, total, stored, pending):
+                role = _ROLES.get(message.get("message_type"))
+                if role:
+                    transcript.append({"role": role, "content": message["content"]})
+        state = ConversationState(session_id, profile_context, transcript, start, total)
+        self._store(state)
+        self._rehydrated.inc()
+        return state
+
+    def append(self, state: ConversationState, user_message: str, reply: str):
+        """Aggiunge il turno concluso; la finestra scorre solo quando supera max_messages"""
+        state.transcript.append({"role": "user", "content": user_message})
+        state.transcript.append({"role": "assistant", "content": reply})
+        state.total += 2
+        start = window_start(state.total, self.max_messages, self.keep_messages)
+        if start > state.start:
+            del state.transcript[:start - state.start]
+            state.start = start
+        if self._states.get(state.session_id) is state:
+            self._store(state)
+
+
+_store: Optional[ConversationStore] = None
+
+
+def get_conversation_store() -> Optional[ConversationStore]:
+    """Store condiviso se la modalità conversazionale è attiva"""
+    return _store
+
+
+def init_conversation_store(db: AsyncIOMotorDatabase) -> ConversationStore:
+    global _store
+    _store = ConversationStore(
+        db,
+        max_messages=int(os.environ.get('CONVERSATION_WINDOW_MAX', '12')),
+        keep_messages=int(os.environ.get('CONVERSATION_WINDOW_KEEP', '4')),
+        max_sessions=int(os.environ.get('CONVERSATION_MAX_SESSIONS', '10000')),
+        max_bytes=budget_from_env('CONVERSATION_STATE_MAX_MB', 32)
+    )
+    memory.register("conversations", _store)
+    logger.info("Conversazioni incrementali attive: finestra %d-%d messaggi", _store.keep_messages, _store.max_messages)
+    return _store
+
+
+def shutdown_conversation_store():
+    global _store
+    if _store:
+        memory.unregister("conversations")
+        _store = None
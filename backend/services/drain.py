@@ -0,0 +1,102 @@
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Set
+
+from services.admission import AdmissionRejected
+from services.change_feed import get_change_feed
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DrainController:
+    """Modalità drain per i rilasci: i nuovi turni vengono rifiutati con 503 e Retry-After, quelli
+    in corso (chiamata LLM e salvataggi) hanno tempo fino alla scadenza per concludersi.
+
+    La readiness diventa negativa appena inizia il drain, così il bilanciatore smette di inviare
+    traffico al worker mentre le risposte già in attesa del modello vengono completate.
+    """
+
+    def __init__(self, retry_after: float = 5.0):
+        self.retry_after = retry_after
+        self.draining = False
+        self.started_at: Optional[float] = None
+        self._inflight: Set[asyncio.Task] = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+        self._rejected = metrics.counter("drain.rejected_turns")
+        self._drained = metrics.counter("drain.drained_turns")
+        self._cut = metrics.counter("drain.cut_turns")
+        metrics.gauge("drain.inflight_turns", lambda: len(self._inflight))
+        metrics.gauge("drain.draining", lambda: 1.0 if self.draining else 0.0)
+
+    @asynccontextmanager
+    async def turn(self):
+        """Traccia un turno diretto al modello; durante il drain il turno non parte"""
+        if self.draining:
+            self._rejected.inc()
+            raise AdmissionRejected("draining", self.retry_after)
+        task = asyncio.current_task()
+        self._inflight.add(task)
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self._inflight.discard(task)
+            if not self._inflight:
+                self._idle.set()
+
+    def begin(self):
+        if self.draining:
+            return
+        self.draining = True
+        self.started_at = time.monotonic()
+        logger.info("Drain avviato: %d turni in corso", len(self._inflight))
+        # Gli stream SSE non finiscono da soli: chiusi subito, il client si riconnette a un altro worker
+        feed = get_change_feed()
+        if feed:
+            feed.close_subscribers()
+
+    async def drain(self, timeout: float, cancel: bool = True) -> Dict:
+        """Attende i turni in corso fino a timeout secondi; con cancel=True quelli ancora aperti vengono interrotti"""
+        self.begin()
+        pending = len(self._inflight)
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        remaining = set(self._inflight)
+        drained = pending - len(remaining)
+        self._drained.inc(drained)
+        cut = 0
+        if cancel and remaining:
+            for task in remaining:
+                task.cancel()
+            await asyncio.gather(*remaining, return_exceptions=True)
+            cut = len(remaining)
+            self._cut.inc(cut)
+        return {
+            "draining": True,
+            "drained": drained,
+            "cut": cut,
+            "inflight": len(self._inflight),
+            "elapsed_seconds": time.monotonic() - self.started_at
+        }
+
+
+_controller: Optional[DrainController] = None
+
+
+def get_drain_controller() -> DrainController:
+    global _controller
+    if _controller is None:
+        _controller = DrainController()
+    return _controller
+
+
+def is_draining() -> bool:
+    return _controller is not None and _controller.draining
@@ -0,0 +1,129 @@
+import json
+import logging
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+logger = logging.getLogger(__name__)
+
+# Colonne della tabella piatta (una riga per messaggio) usata per l'export colonnare
+FLAT_COLUMNS = [
+    "session_id", "session_status", "session_start_time", "session_end_time", "current_urgency_level",
+    "eta", "genere", "sintomo_principale", "durata", "intensita", "sintomi_associati", "condizioni_note",
+    "message_id", "message_type", "content", "urgency_level", "timestamp"
+]
+
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Tipo non serializzabile: {type(value)}")
+
+
+def to_ndjson_line(document: Dict) -> str:
+    return json.dumps(document, default=json_default, ensure_ascii=False) + "\n"
+
+
+def flatten_session(document: Dict) -> List[Dict]:
+    """Una riga per messaggio con i campi di sessione e profilo ripetuti"""
+    profile = document.get("profile") or {}
+    base = {
+        "session_id": document["session_id"],
+        "session_status": document.get("status"),
+        "session_start_time": document.get("start_time"),
+        "session_end_time": document.get("end_time"),
+        "current_urgency_level": document.get("current_urgency_level"),
+        "eta": profile.get("eta"),
+        "genere": profile.get("genere"),
+        "sintomo_principale": profile.get("sintomo_principale"),
+        "durata": profile.get("durata"),
+        "intensita": (profile.get("intensita") or [None])[0],
+        "sintomi_associati": ", ".join(profile.get("sintomi_associati") or []),
+        "condizioni_note": ", ".join(profile.get("condizioni_note") or [])
+    }
+    rows = []
+    for message in document.get("messages") or []:
+        rows.append({
+            **base,
+            "message_id": message.get("id"),
+            "message_type": message.get("message_type"),
+            "content": message.get("content"),
+            "urgency_level": message.get("urgency_level"),
+            "timestamp": message.get("timestamp")
+        })
+    if not rows:
+        rows.append({**base, **{column: None for column in FLAT_COLUMNS if column not in base}})
+    return rows
+
+
+class ExportService:
+    """Export in streaming delle conversazioni: sessioni unite a profilo e messaggi lato server"""
+
+    def __init__(self, db: AsyncIOMotorDatabase, batch_size: int = 200):
+        self.db = db
+        self.batch_size = batch_size
+
+    def build_pipeline(
+        self,
+        after_session_id: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None
+    ) -> List[Dict]:
+        match: Dict = {}
+        if after_session_id:
+            match["session_id"] = {"$gt": after_session_id}
+        if since or until:
+            match["start_time"] = {}
+            if since:
+                match["start_time"]["$gte"] = since
+            if until:
+                match["start_time"]["$lt"] = until
+
+        return [
+            {"$match": match},
+            # Ordinamento per session_id: il checkpoint è l'ultimo session_id esportato
+            {"$sort": {"session_id": 1}},
+            # localField/foreignField: il join usa l'indice su session_id delle collezioni unite
+            {"$lookup": {
+                "from": "user_profiles",
+                "localField": "session_id",
+                "foreignField": "session_id",
+                "as": "profile"
+            }},
+            {"$lookup": {
+                "from": "messages",
+                "localField": "session_id",
+                "foreignField": "session_id",
+                "as": "messages"
+            }},
+            {"$addFields": {"profile": {"$arrayElemAt": ["$profile", 0]}}},
+            {"$project": {
+                "_id": 0,
+                "wb_applied": 0,
+                "profile._id": 0,
+                "messages._id": 0,
+                "messages.session_id": 0
+            }}
+        ]
+
+    async def iter_sessions(
+        self,
+        after_session_id: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        limit: Optional[int] = None
+    ) -> AsyncIterator[Dict]:
+        """Itera le sessioni complete; la memoria dipende dal batch del cursore, non dal dataset"""
+        pipeline = self.build_pipeline(after_session_id, since, until)
+        if limit:
+            pipeline.insert(2, {"$limit": limit})
+
+        cursor = self.db.chat_sessions.aggregate(pipeline, allowDiskUse=True, batchSize=self.batch_size)
+        async for document in cursor:
+            # Ordine cronologico dei messaggi garantito qui: $lookup non assicura l'ordine
+            document["messages"].sort(key=lambda message: message["timestamp"])
+            yield document
+
+    async def iter_ndjson(self, **kwargs) -> AsyncIterator[str]:
+        async for document in self.iter_sessions(**kwargs):
+            yield to_ndjson_line(document)
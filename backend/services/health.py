@@ -0,0 +1,226 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import monitoring
+
+from services.metrics import metrics
+from services.llm_router import get_llm_router
+from services.drain import is_draining
+
+logger = logging.getLogger(__name__)
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """Conta le connessioni in uso e in attesa per ogni server; gli eventi arrivano dai thread di pymongo"""
+
+    def __init__(self, max_pool_size: int):
+        self.max_pool_size = max_pool_size
+        self._lock = threading.Lock()
+        self._checked_out: Dict[str, int] = {}
+        self._waiting: Dict[str, int] = {}
+
+    def _add(self, counters: Dict[str, int], address, delta: int):
+        key = f"{address[0]}:{address[1]}"
+        with self._lock:
+            counters[key] = max(0, counters.get(key, 0) + delta)
+
+    def connection_check_out_started(self, event):
+        self._add(self._waiting, event.address, 1)
+
+    def connection_check_out_failed(self, event):
+        self._add(self._waiting, event.address, -1)
+
+    def connection_checked_out(self, event):
+        self._add(self._waiting, event.address, -1)
+        self._add(self._checked_out, event.address, 1)
+
+    def connection_checked_in(self, event):
+        self._add(self._checked_out, event.address, -1)
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._checked_out.pop(f"{event.address[0]}:{event.address[1]}", None)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            checked_out = max(self._checked_out.values(), default=0)
+            waiting = max(self._waiting.values(), default=0)
+        return {
+            "max_pool_size": self.max_pool_size,
+            "checked_out": checked_out,
+            "waiting": waiting,
+            "saturation": checked_out / self.max_pool_size if self.max_pool_size else 0.0
+        }
+
+
+pool_monitor = PoolMonitor(max_pool_size=int(os.environ.get('MONGO_MAX_POOL_SIZE', '100')))
+
+
+class HealthProber:
+    """Aggiorna in background lo stato di salute; le probe HTTP leggono solo lo stato in memoria"""
+
+    def __init__(self, db: AsyncIOMotorDatabase, interval: float = 2.0, ping_timeout: float = 1.0,
+                 max_loop_lag: float = 0.5):
+        self.db = db
+        self.interval = interval
+        self.ping_timeout = ping_timeout
+        self.max_loop_lag = max_loop_lag
+        self.started_at = time.time()
+        self._task: Optional[asyncio.Task] = None
+        self._state: Dict = {
+            "database": "unknown",
+            "database_error": None,
+            "ping_ms": None,
+            "last_probe": None,
+            "loop_lag_ms": 0.0
+        }
+        self._last_probe_monotonic = 0.0
+        # Falso finché il warm-up di avvio non è terminato: il pod non riceve traffico prima
+        self.warmed_up = False
+        self.warmup_seconds: Optional[float] = None
+
+        metrics.gauge("health.loop_lag_seconds", lambda: self._state["loop_lag_ms"] / 1000)
+        metrics.gauge("health.pool_saturation", lambda: pool_monitor.snapshot()["saturation"])
+
+    async def start(self):
+        await self.probe_once()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            # Il ritardo con cui il loop ci risveglia rispetto all'intervallo atteso è il lag dell'event loop
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            self._state["loop_lag_ms"] = max(0.0, (time.perf_counter() - expected) * 1000)
+            try:
+                await self.probe_once()
+            except Exception as e:
+                logger.error("Errore probe di salute: %s", e)
+
+    async def probe_once(self):
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.db.command("ping"), timeout=self.ping_timeout)
+            self._state["database"] = "connected"
+            self._state["database_error"] = None
+            self._state["ping_ms"] = (time.perf_counter() - start) * 1000
+        except asyncio.TimeoutError:
+            self._state["database"] = "timeout"
+            self._state["database_error"] = f"ping oltre {self.ping_timeout}s"
+            self._state["ping_ms"] = None
+        except Exception as e:
+            self._state["database"] = "disconnected"
+            self._state["database_error"] = str(e)
+            self._state["ping_ms"] = None
+        self._state["last_probe"] = datetime.utcnow()
+        self._last_probe_monotonic = time.monotonic()
+
+    def mark_warmed_up(self, seconds: float):
+        self.warmed_up = True
+        self.warmup_seconds = seconds
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self._last_probe_monotonic > self.interval * 3
+
+    def liveness(self) -> Dict:
+        """Il processo risponde; il lag del loop è riportato ma non rende il pod non vivo"""
+        return {
+            "status": "alive",
+            "uptime_seconds": time.time() - self.started_at,
+            "loop_lag_ms": self._state["loop_lag_ms"]
+        }
+
+    def readiness(self) -> Tuple[bool, Dict]:
+        router = get_llm_router()
+        pool = pool_monitor.snapshot()
+        reasons = []
+        if self._state["database"] != "connected":
+            reasons.append("database")
+        if self.is_stale():
+            reasons.append("stale_probe")
+        if not self.warmed_up:
+            reasons.append("warming_up")
+        if is_draining():
+            reasons.append("draining")
+
+        degraded = []
+        if router.breaker_state != "closed":
+            degraded.append("llm_breaker")
+        if pool["saturation"] >= 1.0:
+            degraded.append("pool_saturated")
+        if self._state["loop_lag_ms"] > self.max_loop_lag * 1000:
+            degraded.append("loop_lag")
+
+        return not reasons, {
+            "ready": not reasons,
+            "not_ready_reasons": reasons,
+            "degraded": degraded,
+            "warmed_up": self.warmed_up,
+            "draining": is_draining(),
+            "warmup_seconds": self.warmup_seconds,
+            "database": self._state["database"],
+            "database_error": self._state["database_error"],
+            "ping_ms": self._state["ping_ms"],
+            "last_probe": self._state["last_probe"],
+            "pool": pool,
+            "llm_breaker": router.breaker_state,
+            "llm_breakers": {name: breaker.state for name, breaker in router.breakers.items()},
+            "loop_lag_ms": self._state["loop_lag_ms"]
+        }
+
+
+_prober: Optional[HealthProber] = None
+
+
+def get_health_prober() -> Optional[HealthProber]:
+    return _prober
+
+
+async def init_health_prober(db: AsyncIOMotorDatabase) -> HealthProber:
+    global _prober
+    _prober = HealthProber(
+        db,
+        interval=float(os.environ.get('HEALTH_PROBE_INTERVAL', '2.0')),
+        ping_timeout=float(os.environ.get('HEALTH_PING_TIMEOUT', '1.0'))
+    )
+    await _prober.start()
+    return _prober
+
+
+async def shutdown_health_prober():
+    global _prober
+    if _prober:
+        await _prober.stop()
+        _prober = None
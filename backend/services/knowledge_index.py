@@ -0,0 +1,268 @@
+import os
+import json
+import math
+import time
+import logging
+import unicodedata
+import re
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from models.message import Message
+from models.user_profile import UserProfile
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONTENT_PATH = Path(__file__).parent.parent / "data" / "faq_it.json"
+
+# Solo parole funzionali: "cosa", "fare", "quando" restano perché distinguono l'intento della domanda
+STOPWORDS = {
+    "a", "ad", "al", "alla", "alle", "allo", "ai", "agli", "c", "che", "ci", "con", "da", "dal", "dalla",
+    "dei", "del", "della", "delle", "dello", "degli", "di", "e", "ed", "gli", "ha", "hai", "ho", "i",
+    "il", "in", "l", "la", "le", "lo", "mi", "ne", "nel", "nella", "o", "per", "si", "sono", "su",
+    "sul", "sulla", "ti", "tra", "un", "una", "uno", "è"
+}
+
+# Parole interrogative (senza accenti): bastano in qualunque punto della frase
+QUESTION_WORDS = {
+    "cosa", "come", "quando", "perche", "quanto", "quanta", "quanti", "quante", "quale", "quali", "dove", "chi"
+}
+# Verbi che rendono domanda la frase solo in apertura: "posso prendere..." sì, "non posso dormire" no
+QUESTION_OPENERS = {"posso", "devo", "bisogna", "serve", "servono", "conviene", "occorre", "e"}
+
+# Campi del profilo che rendono la risposta personale: con uno di questi valorizzato il turno non è riusabile
+PERSONAL_PROFILE_FIELDS = ("eta", "sintomo_principale", "durata", "intensita", "sintomi_associati",
+                           "condizioni_note", "familiarita")
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def _strip_accents(text: str) -> str:
+    return "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+
+
+def tokenize(text: str) -> List[str]:
+    """Tokenizzazione con stemming leggero: minuscole, senza accenti, senza vocale finale"""
+    tokens = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        token = _strip_accents(token)
+        if len(token) > 4 and token[-1] in "aeio":
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def is_question(text: str) -> bool:
+    """Domanda esplicita: punto interrogativo, parola interrogativa o verbo modale in apertura"""
+    if "?" in text:
+        return True
+    words = [_strip_accents(word) for word in _TOKEN_RE.findall(text.lower())]
+    if not words:
+        return False
+    return words[0] in QUESTION_OPENERS or any(word in QUESTION_WORDS for word in words)
+
+
+def is_profile_light(user_profile: Optional[UserProfile], conversation_history: Optional[List[Message]]) -> bool:
+    """Primo turno utente senza dati personali nel profilo.
+
+    Il resto del contesto che arriva al prompt (genere, benvenuto e altri messaggi dell'assistente)
+    entra nella chiave della cache di similarità tramite il parametro context di get/put.
+    """
+    if any(msg.message_type == "user" for msg in (conversation_history or [])):
+        return False
+    if user_profile and any(getattr(user_profile, field) for field in PERSONAL_PROFILE_FIELDS):
+        return False
+    return True
+
+
+@dataclass
+class FaqEntry:
+    id: str
+    topic: str
+    questions: List[str]
+    keywords: List[str]
+    answer: str
+    next_questions: List[str]
+
+
+@dataclass
+class FaqMatch:
+    entry: FaqEntry
+    score: float
+    confidence: float
+    coverage: float
+
+
+class KnowledgeIndex:
+    """Indice invertito BM25 sulle domande frequenti; ogni formulazione è un documento"""
+
+    def __init__(self, entries: List[FaqEntry], k1: float = 1.5, b: float = 0.75):
+        self.entries = entries
+        self.k1 = k1
+        self.b = b
+
+        self._doc_entries: List[FaqEntry] = []
+        self._doc_lengths: List[int] = []
+        self._doc_terms: List[set] = []
+        self._doc_question_terms: List[set] = []
+        self._postings: Dict[str, List[tuple]] = {}
+        for entry in entries:
+            for question in entry.questions:
+                terms = Counter(tokenize(question) + tokenize(" ".join(entry.keywords)))
+                doc_id = len(self._doc_entries)
+                self._doc_entries.append(entry)
+                self._doc_lengths.append(sum(terms.values()))
+                self._doc_terms.append(set(terms))
+                self._doc_question_terms.append(set(tokenize(question)))
+                for term, freq in terms.items():
+                    self._postings.setdefault(term, []).append((doc_id, freq))
+
+        n_docs = max(1, len(self._doc_entries))
+        self._avg_length = sum(self._doc_lengths) / n_docs if self._doc_lengths else 0.0
+        self._idf = {
+            term: math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self._postings.items()
+        }
+        # Un termine mai visto pesa come il più raro: abbassa la confidenza delle domande fuori tema
+        self._unseen_idf = max(self._idf.values(), default=1.0)
+
+    @classmethod
+    def from_file(cls, path: Path) -> "KnowledgeIndex":
+        with open(path, encoding="utf-8") as f:
+            raw_entries = json.load(f)
+        entries = [
+            FaqEntry(
+                id=item["id"],
+                topic=item.get("topic", ""),
+                questions=item["questions"],
+                keywords=item.get("keywords", []),
+                answer=item["answer"],
+                next_questions=item.get("next_questions", [])
+            )
+            for item in raw_entries
+        ]
+        return cls(entries)
+
+    def search(self, query: str) -> Optional[FaqMatch]:
+        """Miglior risultato BM25.
+
+        confidence è la quota del peso IDF della domanda utente coperta dal documento, coverage la quota
+        del peso IDF della formulazione FAQ presente nella domanda: "ho la febbre" ha confidence piena
+        ma copre solo una parte di "ho la febbre cosa devo fare".
+        """
+        query_terms = set(tokenize(query))
+        if not query_terms:
+            return None
+
+        scores: Dict[int, float] = {}
+        for term in query_terms:
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for doc_id, freq in self._postings[term]:
+                length_norm = 1 - self.b + self.b * self._doc_lengths[doc_id] / self._avg_length
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * freq * (self.k1 + 1) / (freq + self.k1 * length_norm)
+
+        if not scores:
+            return None
+
+        best_doc = max(scores, key=scores.get)
+        doc_terms = self._doc_terms[best_doc]
+        total_weight = sum(self._idf.get(term, self._unseen_idf) for term in query_terms)
+        matched_weight = sum(self._idf[term] for term in query_terms if term in doc_terms)
+        question_terms = self._doc_question_terms[best_doc]
+        question_weight = sum(self._idf[term] for term in question_terms)
+        covered_weight = sum(self._idf[term] for term in question_terms if term in query_terms)
+        return FaqMatch(
+            entry=self._doc_entries[best_doc],
+            score=scores[best_doc],
+            confidence=matched_weight / total_weight,
+            coverage=covered_weight / question_weight if question_weight else 0.0
+        )
+
+
+class FaqResolver:
+    """Decide se una domanda può avere risposta diretta dall'indice o va arricchita con un riferimento"""
+
+    def __init__(self, index: KnowledgeIndex, direct_threshold: float = 0.9, grounded_threshold: float = 0.6,
+                 direct_coverage: float = 0.75, direct_max_words: int = 12):
+        self.index = index
+        self.direct_threshold = direct_threshold
+        self.direct_coverage = direct_coverage
+        self.grounded_threshold = grounded_threshold
+        self.direct_max_words = direct_max_words
+
+        self._lookups = metrics.counter("faq.lookups")
+        self._direct_hits = metrics.counter("faq.direct_hits")
+        self._grounded_hits = metrics.counter("faq.grounded_hits")
+        self._misses = metrics.counter("faq.misses")
+        metrics.gauge("faq.hit_rate", self.hit_rate)
+
+    def hit_rate(self) -> float:
+        if not self._lookups.value:
+            return 0.0
+        return (self._direct_hits.value + self._grounded_hits.value) / self._lookups.value
+
+    def lookup(self, user_message: str) -> Optional[FaqMatch]:
+        self._lookups.inc()
+        with metrics.timer("faq.lookup_seconds"):
+            match = self.index.search(user_message)
+        if not match or match.confidence < self.grounded_threshold:
+            self._misses.inc()
+            return None
+        return match
+
+    def is_direct(
+        self,
+        match: FaqMatch,
+        user_message: str,
+        user_profile: Optional[UserProfile] = None,
+        conversation_history: Optional[List[Message]] = None
+    ) -> bool:
+        """Risposta diretta solo a domande esplicite che ricalcano una formulazione FAQ, al primo turno
+        e senza dati personali: "ho la febbre" resta un sintomo da approfondire con il modello"""
+        direct = (
+            match.confidence >= self.direct_threshold
+            and match.coverage >= self.direct_coverage
+            and len(user_message.split()) <= self.direct_max_words
+            and is_question(user_message)
+            and is_profile_light(user_profile, conversation_history)
+        )
+        if direct:
+            self._direct_hits.inc()
+        else:
+            self._grounded_hits.inc()
+        return direct
+
+
+_resolver: Optional[FaqResolver] = None
+
+
+def get_faq_resolver() -> Optional[FaqResolver]:
+    """Resolver condiviso, costruito al primo uso dal file di contenuti; None se disabilitato"""
+    global _resolver
+    if os.environ.get('FAQ_INDEX_ENABLED', 'false').lower() != 'true':
+        return None
+    if _resolver is None:
+        init_faq_resolver()
+    return _resolver
+
+
+def init_faq_resolver() -> FaqResolver:
+    global _resolver
+    path = Path(os.environ.get('FAQ_CONTENT_PATH', str(DEFAULT_CONTENT_PATH)))
+    start = time.perf_counter()
+    index = KnowledgeIndex.from_file(path)
+    _resolver = FaqResolver(
+        index,
+        direct_threshold=float(os.environ.get('FAQ_DIRECT_THRESHOLD', '0.9')),
+        grounded_threshold=float(os.environ.get('FAQ_GROUNDED_THRESHOLD', '0.6')),
+        direct_coverage=float(os.environ.get('FAQ_DIRECT_COVERAGE', '0.75'))
+    )
+    logger.info("Indice FAQ costruito: %d voci in %.1f ms", len(index.entries), (time.perf_counter() - start) * 1000)
+    return _resolver
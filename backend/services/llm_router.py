@@ -0,0 +1,256 @@
+import os
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from models.user_profile import UserProfile
+from models.message import Message
+from services.metrics import metrics
+from services.triage import detect_red_flags, mentions_symptoms, word_count
+from services.traffic_capture import record_llm_call
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ModelTier:
+    name: str
+    provider: str
+    model: str
+    max_tokens: int
+
+
+def _tier_from_env(name: str, model: str, max_tokens: int) -> ModelTier:
+    prefix = f"LLM_TIER_{name.upper()}"
+    return ModelTier(
+        name=name,
+        provider=os.environ.get(f"{prefix}_PROVIDER", "gemini"),
+        model=os.environ.get(f"{prefix}_MODEL", model),
+        max_tokens=int(os.environ.get(f"{prefix}_MAX_TOKENS", str(max_tokens)))
+    )
+
+
+def default_tiers() -> Dict[str, ModelTier]:
+    """Tier configurabili via LLM_TIER_<NOME>_MODEL / _PROVIDER / _MAX_TOKENS"""
+    return {
+        "fast": _tier_from_env("fast", "gemini-2.0-flash-lite", 600),
+        "standard": _tier_from_env("standard", "gemini-2.0-flash", 1500),
+        "strong": _tier_from_env("strong", "gemini-2.5-pro", 2000)
+    }
+
+
+class CircuitOpenError(Exception):
+    """Il circuito verso il provider LLM è aperto: la chiamata non viene tentata"""
+
+
+class CircuitBreaker:
+    """Apre il circuito dopo N errori consecutivi; dopo il cooldown le chiamate di prova lo richiudono o riaprono"""
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        return self.state != "open"
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning("Circuito LLM aperto dopo %d errori consecutivi", self.consecutive_failures)
+            self.opened_at = time.monotonic()
+
+
+class LlmRouter:
+    """Sceglie il tier del modello per ogni turno e applica l'hedging delle richieste lente"""
+
+    # Sotto questa soglia di parole un messaggio senza sintomi è trattato come conversazione semplice
+    SMALL_TALK_MAX_WORDS = 8
+
+    def __init__(
+        self,
+        tiers: Optional[Dict[str, ModelTier]] = None,
+        hedging_enabled: bool = True,
+        hedge_percentile: float = 0.95,
+        hedge_default_delay: float = 4.0,
+        hedge_min_delay: float = 0.5,
+        hedge_max_delay: float = 15.0,
+        hedge_min_samples: int = 20,
+        breaker_threshold: int = 5,
+        breaker_cooldown: float = 30.0
+    ):
+        self.tiers = tiers or default_tiers()
+        self.hedging_enabled = hedging_enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.hedge_min_samples = hedge_min_samples
+        # Un circuito per tier: se un modello è giù si ripiega sul tier più vicino ancora disponibile
+        self.breakers = {
+            name: CircuitBreaker(breaker_threshold, breaker_cooldown) for name in self.tiers
+        }
+
+        self._hedges_fired = metrics.counter("llm.hedge.fired")
+        self._hedges_won = metrics.counter("llm.hedge.won")
+
+    def select_tier(
+        self,
+        user_message: str,
+        user_profile: Optional[UserProfile] = None,
+        conversation_history: Optional[List[Message]] = None
+    ) -> ModelTier:
+        """Modello più forte se scatta un red flag, più veloce per la conversazione semplice"""
+        if detect_red_flags(user_message):
+            tier = self.tiers["strong"]
+        elif (
+            word_count(user_message) <= self.SMALL_TALK_MAX_WORDS
+            and not mentions_symptoms(user_message)
+            and not any(msg.urgency_level in ("medium", "high") for msg in (conversation_history or [])[-4:])
+        ):
+            tier = self.tiers["fast"]
+        else:
+            tier = self.tiers["standard"]
+
+        if not self.breakers[tier.name].allow():
+            fallback = next(
+                (self.tiers[name] for name in self._fallback_order(tier.name) if self.breakers[name].allow()),
+                None
+            )
+            if fallback is not None:
+                logger.info("Circuito del tier %s aperto, ripiego su %s", tier.name, fallback.name)
+                metrics.counter("llm.tier.fallback").inc()
+                tier = fallback
+
+        metrics.counter(f"llm.tier.{tier.name}").inc()
+        return tier
+
+    def _fallback_order(self, name: str) -> List[str]:
+        """Tier alternativi dal più vicino al più lontano; a pari distanza prima il più forte"""
+        names = list(self.tiers)
+        index = names.index(name)
+        others = [other for other in names if other != name]
+        return sorted(others, key=lambda other: (abs(names.index(other) - index), -names.index(other)))
+
+    @property
+    def breaker_state(self) -> str:
+        """closed se tutti i tier sono disponibili, open se nessuno lo è, altrimenti degraded"""
+        states = [breaker.state for breaker in self.breakers.values()]
+        if all(state == "closed" for state in states):
+            return "closed"
+        if all(state == "open" for state in states):
+            return "open"
+        return "degraded"
+
+    def hedge_delay(self, tier: ModelTier) -> float:
+        """Ritardo prima della richiesta di backup: percentile osservato della latenza del tier"""
+        histogram = metrics.histogram(f"llm.latency_seconds.{tier.name}")
+        if histogram.count < self.hedge_min_samples:
+            return self.hedge_default_delay
+        delay = histogram.percentile(self.hedge_percentile) or self.hedge_default_delay
+        return min(self.hedge_max_delay, max(self.hedge_min_delay, delay))
+
+    async def _timed_call(self, tier: ModelTier, make_chat: Callable[[], Awaitable[Any]], message: Any) -> str:
+        start = time.perf_counter()
+        try:
+            chat = await make_chat()
+            return await chat.send_message(message)
+        finally:
+            # Anche le chiamate annullate dall'hedging contano (come limite inferiore) per il percentile
+            elapsed = time.perf_counter() - start
+            metrics.histogram(f"llm.latency_seconds.{tier.name}").observe(elapsed)
+            record_llm_call(tier.name, elapsed)
+
+    async def send(
+        self,
+        tier: ModelTier,
+        make_chat: Callable[[], Awaitable[Any]],
+        message: Any,
+        make_backup_chat: Optional[Callable[[], Awaitable[Any]]] = None,
+        hedge: bool = True
+    ) -> str:
+        """Invia il messaggio; se la risposta tarda oltre il ritardo di hedging lancia una seconda richiesta
+        e restituisce la prima risposta valida (hedge=False per le chiamate non urgenti)"""
+        breaker = self.breakers[tier.name]
+        if not breaker.allow():
+            metrics.counter("llm.breaker.rejected").inc()
+            raise CircuitOpenError(f"Circuito LLM aperto per il tier {tier.name}")
+
+        try:
+            response = await self._send(tier, make_chat, message, make_backup_chat, hedge)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return response
+
+    async def _send(
+        self,
+        tier: ModelTier,
+        make_chat: Callable[[], Awaitable[Any]],
+        message: Any,
+        make_backup_chat: Optional[Callable[[], Awaitable[Any]]],
+        hedge: bool
+    ) -> str:
+        if not self.hedging_enabled or not hedge:
+            return await self._timed_call(tier, make_chat, message)
+
+        primary = asyncio.create_task(self._timed_call(tier, make_chat, message))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay(tier))
+            if done and not primary.exception():
+                return primary.result()
+
+            self._hedges_fired.inc()
+            backup = asyncio.create_task(self._timed_call(tier, make_backup_chat or make_chat, message))
+            tasks.add(backup)
+            pending = set(tasks)
+            last_error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception():
+                        last_error = task.exception()
+                        continue
+                    if task is backup:
+                        self._hedges_won.inc()
+                    return task.result()
+            raise last_error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+
+_router: Optional[LlmRouter] = None
+
+
+def get_llm_router() -> LlmRouter:
+    """Router condiviso dal processo, così le statistiche di latenza sono comuni a tutte le richieste"""
+    global _router
+    if _router is None:
+        _router = LlmRouter(
+            hedging_enabled=os.environ.get('LLM_HEDGING_ENABLED', 'true').lower() == 'true',
+            hedge_percentile=float(os.environ.get('LLM_HEDGE_PERCENTILE', '0.95')),
+            hedge_default_delay=float(os.environ.get('LLM_HEDGE_DEFAULT_DELAY', '4.0'))
+        )
+    return _router
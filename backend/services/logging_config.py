@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import queue
+import uuid
+import random
+import logging
+import logging.handlers
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+
+# Identificativo della richiesta corrente, propagato ai log emessi durante la sua gestione
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+
+# Attributi standard di LogRecord: tutto il resto passato con extra= finisce nel JSON
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "request_id", "sample_rate"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Una riga JSON per record, con request_id e campi extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        request_id = getattr(record, "request_id", "-")
+        if request_id != "-":
+            entry["request_id"] = request_id
+        sample_rate = getattr(record, "sample_rate", None)
+        if sample_rate is not None:
+            entry["sample_rate"] = sample_rate
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class InfoSampler(logging.Filter):
+    """Tiene solo una frazione dei log INFO e DEBUG dei logger rumorosi; warning ed errori passano sempre"""
+
+    def __init__(self, rate: float, loggers: Optional[set] = None):
+        super().__init__()
+        self.rate = rate
+        self.loggers = loggers
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate >= 1.0:
+            return True
+        if self.loggers is not None and record.name not in self.loggers:
+            return True
+        if random.random() >= self.rate:
+            return False
+        record.sample_rate = self.rate
+        return True
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Accoda il record senza formattarlo: sul loop restano solo la copia del request_id e il put.
+
+    La formattazione lazy (msg % args) avviene nel thread del listener, quindi gli argomenti
+    devono essere valori immutabili (stringhe, numeri), come nei log dei servizi.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Il ContextVar va letto qui: il thread del listener non vede il contesto della richiesta
+        record.request_id = request_id_var.get() or "-"
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def configure_logging(stream=None) -> Optional[logging.handlers.QueueListener]:
+    """Installa sul root logger un QueueHandler; la scrittura su stderr avviene in un thread dedicato.
+
+    LOG_FORMAT: "json" (default) o "text"; LOG_LEVEL; LOG_INFO_SAMPLE_RATE (0-1) con
+    LOG_SAMPLED_LOGGERS (elenco separato da virgole, vuoto = tutti i logger).
+    """
+    global _listener
+    shutdown_logging()
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    if os.environ.get('LOG_FORMAT', 'json').lower() == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    handler = ContextQueueHandler(log_queue)
+    sample_rate = float(os.environ.get('LOG_INFO_SAMPLE_RATE', '1.0'))
+    if sample_rate < 1.0:
+        sampled = {name.strip() for name in os.environ.get('LOG_SAMPLED_LOGGERS', '').split(",") if name.strip()}
+        handler.addFilter(InfoSampler(sample_rate, sampled or None))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+class _RequestIdFilter(logging.Filter):
+    """Aggiunge il request_id ai record scritti senza passare dalla coda"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get() or "-"
+        return True
+
+
+def shutdown_logging():
+    """Svuota la coda e ferma il thread del listener.
+
+    I log emessi dopo (hook e task chiusi più tardi, uvicorn) vengono scritti in modo sincrono
+    dagli stessi handler di output invece di restare in una coda che nessuno legge.
+    """
+    global _listener
+    if _listener:
+        _listener.stop()
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            if isinstance(existing, ContextQueueHandler):
+                root.removeHandler(existing)
+        for output in _listener.handlers:
+            output.addFilter(_RequestIdFilter())
+            root.addHandler(output)
+        _listener = None
+
+
+class RequestIdMiddleware:
+    """Middleware ASGI: usa X-Request-ID in ingresso o ne genera uno, e lo restituisce nella risposta"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers") or []:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:128]
+                break
+        request_id = request_id or uuid.uuid4().hex
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        token = request_id_var.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
@@ -0,0 +1,130 @@
+import os
+import sys
+import types
+import asyncio
+import logging
+import threading
+from collections import deque
+from itertools import islice
+from typing import Dict, Optional
+
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Oggetti condivisi dal processo: non appartengono alla struttura che li referenzia
+_SHARED_TYPES = (
+    type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType,
+    asyncio.AbstractEventLoop, logging.Logger, type(threading.Lock())
+)
+_LEAF_TYPES = (str, bytes, bytearray, int, float, complex, bool, type(None), range)
+
+
+def deep_sizeof(obj, sample: int = 100, max_objects: int = 100_000) -> int:
+    """Stima della memoria raggiungibile da obj, condivisa esclusa.
+
+    I contenitori con più di `sample` elementi vengono misurati su un campione e il risultato
+    è riportato alla dimensione intera: il costo resta limitato anche su cache da milioni di voci.
+    Gli array numpy contano per intero tramite sys.getsizeof (dati inclusi se posseduti).
+    """
+    seen = set()
+    total = 0.0
+    visited = 0
+    stack = [(obj, 1.0)]
+    while stack and visited < max_objects:
+        item, weight = stack.pop()
+        if id(item) in seen or isinstance(item, _SHARED_TYPES):
+            continue
+        seen.add(id(item))
+        visited += 1
+        total += sys.getsizeof(item) * weight
+        if isinstance(item, _LEAF_TYPES) or hasattr(item, "dtype"):
+            continue
+
+        if isinstance(item, dict):
+            size = len(item)
+            children = (child for pair in item.items() for child in pair)
+            limit = sample * 2
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            size = len(item)
+            children = iter(item)
+            limit = sample
+        else:
+            size = 0
+            attributes = []
+            instance_dict = getattr(item, "__dict__", None)
+            if isinstance(instance_dict, dict) and id(instance_dict) not in seen:
+                # I nomi degli attributi sono stringhe internate condivise: contano solo i valori
+                seen.add(id(instance_dict))
+                total += sys.getsizeof(instance_dict) * weight
+                attributes.extend(instance_dict.values())
+            for cls in type(item).__mro__:
+                for name in getattr(cls, "__slots__", ()):
+                    if name not in ("__dict__", "__weakref__") and hasattr(item, name):
+                        attributes.append(getattr(item, name))
+            children = iter(attributes)
+            limit = len(attributes)
+
+        child_weight = weight * (size / sample) if size > sample else weight
+        stack.extend((child, child_weight) for child in islice(children, limit))
+    return int(total)
+
+
+class MemoryRegistry:
+    """Registro delle strutture in memoria del processo (cache, registri per sessione), esposto da /api/admin/memory.
+
+    Ogni struttura registrata implementa memory_usage() e restituisce almeno "bytes", "entries"
+    e "budget_bytes" (None se è limitata da altro, ad esempio dalla concorrenza); le strutture con
+    budget applicano da sole lo sfratto all'inserimento.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._structures: Dict[str, object] = {}
+
+    def register(self, name: str, structure):
+        with self._lock:
+            self._structures[name] = structure
+        metrics.gauge(f"memory.{name}.bytes", lambda: structure.memory_usage()["bytes"])
+
+    def unregister(self, name: str):
+        with self._lock:
+            self._structures.pop(name, None)
+
+    def report(self) -> Dict:
+        with self._lock:
+            structures = dict(self._structures)
+        usage = {}
+        for name, structure in sorted(structures.items()):
+            try:
+                entry = dict(structure.memory_usage())
+            except Exception as e:
+                logger.error("Errore stima memoria %s: %s", name, e)
+                continue
+            budget = entry.get("budget_bytes")
+            entry["utilization"] = entry["bytes"] / budget if budget else None
+            usage[name] = entry
+        return {
+            "structures": usage,
+            "accounted_bytes": sum(entry["bytes"] for entry in usage.values()),
+            "rss_bytes": process_rss_bytes()
+        }
+
+
+def process_rss_bytes() -> Optional[int]:
+    """RSS corrente del processo (Linux), None se non disponibile"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def budget_from_env(name: str, default_mb: float) -> Optional[int]:
+    """Budget in byte da una variabile in MB; 0 disattiva il limite"""
+    value = float(os.environ.get(name, str(default_mb)))
+    return int(value * 1024 * 1024) if value > 0 else None
+
+
+memory = MemoryRegistry()
+memory.register("metrics", metrics)
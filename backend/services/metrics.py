@@ -0,0 +1,129 @@
+import time
+import threading
+from collections import deque
+from typing import Callable, Dict, Optional
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+
+class Gauge:
+    def __init__(self, fn: Optional[Callable[[], float]] = None):
+        self.value = 0.0
+        self._fn = fn
+
+    def set(self, value: float):
+        self.value = value
+
+    def get(self) -> float:
+        return self._fn() if self._fn else self.value
+
+
+class Histogram:
+    """Istogramma leggero: contatori aggregati più un campione delle ultime osservazioni per i percentili"""
+
+    def __init__(self, window: int = 1024):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._samples = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self._samples.append(value)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+        return ordered[index]
+
+    def snapshot(self) -> Dict:
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.percentile(0.50),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99)
+        }
+
+
+class Timer:
+    """Context manager che registra la durata in secondi in un istogramma"""
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class MetricsRegistry:
+    """Registro in-process delle metriche, esposto da /api/metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Counter] = {}
+        self._gauges: Dict[str, Gauge] = {}
+        self._histograms: Dict[str, Histogram] = {}
+
+    def counter(self, name: str) -> Counter:
+        with self._lock:
+            return self._counters.setdefault(name, Counter())
+
+    def gauge(self, name: str, fn: Optional[Callable[[], float]] = None) -> Gauge:
+        with self._lock:
+            gauge = self._gauges.get(name)
+            if gauge is None or fn is not None:
+                gauge = Gauge(fn)
+                self._gauges[name] = gauge
+            return gauge
+
+    def histogram(self, name: str) -> Histogram:
+        with self._lock:
+            return self._histograms.setdefault(name, Histogram())
+
+    def timer(self, name: str) -> Timer:
+        return Timer(self.histogram(name))
+
+    def memory_usage(self) -> Dict:
+        from services.memory_budget import deep_sizeof
+        with self._lock:
+            histograms = list(self._histograms.values())
+        # Limitata dalla finestra degli istogrammi: il campione di una finestra vale per tutte
+        per_histogram = deep_sizeof(histograms[0]) if histograms else 0
+        return {
+            "bytes": per_histogram * len(histograms) + deep_sizeof((self._counters, self._gauges)),
+            "entries": len(histograms) + len(self._counters) + len(self._gauges),
+            "budget_bytes": None
+        }
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = dict(self._histograms)
+        return {
+            "counters": {name: c.value for name, c in sorted(counters.items())},
+            "gauges": {name: g.get() for name, g in sorted(gauges.items())},
+            "histograms": {name: h.snapshot() for name, h in sorted(histograms.items())}
+        }
+
+
+metrics = MetricsRegistry()
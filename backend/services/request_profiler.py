@@ -0,0 +1,344 @@
+import os
+import sys
+import hmac
+import time
+import uuid
+import random
+import asyncio
+import logging
+import threading
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b"x-profile-request"
+PROFILE_ID_HEADER = b"x-profile-id"
+
+BACKEND_DIR = str(Path(__file__).resolve().parent.parent) + os.sep
+
+# Profilo della richiesta corrente: i task creati durante la richiesta lo ereditano col contesto
+active_profile_var: ContextVar[Optional["RequestProfile"]] = ContextVar("active_profile", default=None)
+
+# Frame del backend raggruppati per componente nel riepilogo
+_COMPONENTS = (
+    ("routes/", "route"),
+    ("services/session_service.py", "session_service"),
+    ("services/ai_service.py", "ai_service"),
+    ("services/llm_router.py", "ai_service"),
+    ("services/", "services")
+)
+
+
+def _component(frames: List[str]) -> str:
+    """Componente del frame del backend più interno dello stack"""
+    for frame in reversed(frames):
+        for prefix, component in _COMPONENTS:
+            if f"({prefix}" in frame:
+                return component
+    return "other"
+
+
+def _frame_label(code) -> str:
+    filename = code.co_filename
+    if filename.startswith(BACKEND_DIR):
+        filename = filename[len(BACKEND_DIR):]
+    else:
+        # Librerie: percorso dal pacchetto in poi; stdlib: solo il nome del file
+        parts = filename.split(os.sep)
+        filename = "/".join(parts[parts.index("site-packages") + 1:]) if "site-packages" in parts else parts[-1]
+    return f"{code.co_qualname} ({filename}:{code.co_firstlineno})"
+
+
+def _coroutine_stack(task: asyncio.Task) -> List:
+    """Catena dei frame di un task sospeso, seguendo cr_await fino al punto di attesa"""
+    codes = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            break
+        codes.append(frame.f_code)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+    return codes
+
+
+def _running_stack(frame, root) -> List:
+    """Stack del thread dell'event loop, tagliato al frame della coroutine radice del task"""
+    codes = []
+    while frame is not None:
+        codes.append(frame.f_code)
+        if frame is root:
+            break
+        frame = frame.f_back
+    codes.reverse()
+    return codes
+
+
+class RequestProfile:
+    """Campioni di una singola richiesta: stack piegati (formato flamegraph) distinti tra CPU e attesa"""
+
+    def __init__(self, method: str, path: str, trigger: str, loop: asyncio.AbstractEventLoop, thread_id: int):
+        self.profile_id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.trigger = trigger
+        self.loop = loop
+        self.thread_id = thread_id
+        self.tasks: Set[asyncio.Task] = set()
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.cpu_samples = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.created_at = datetime.utcnow()
+
+    def add_sample(self, codes: List, on_cpu: bool):
+        if not codes:
+            return
+        # Foglia marcata: nel flamegraph l'attesa (Mongo, LLM) si distingue dal tempo di CPU sul loop
+        stack = ";".join(_frame_label(code) for code in codes) + (";[cpu]" if on_cpu else ";[await]")
+        with self.lock:
+            if self.closed:
+                return
+            self.samples += 1
+            self.cpu_samples += int(on_cpu)
+            self.stacks[stack] += 1
+
+    def close(self):
+        """Dopo la chiusura il thread di campionamento non scrive più: gli stack si leggono senza lock"""
+        with self.lock:
+            self.closed = True
+
+    def folded(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+    def summary(self, interval: float, top: int = 25) -> Dict:
+        self_counts: Counter = Counter()
+        total_counts: Counter = Counter()
+        components: Counter = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[:-1]
+            self_counts[frames[-1]] += count
+            for frame in set(frames):
+                total_counts[frame] += count
+            components[_component(frames)] += count
+        return {
+            "samples": self.samples,
+            "cpu_samples": self.cpu_samples,
+            "interval_ms": interval * 1000,
+            "by_component": dict(components),
+            "top_self": self_counts.most_common(top),
+            "top_total": total_counts.most_common(top)
+        }
+
+
+class _Sampler(threading.Thread):
+    """Thread di campionamento: gira solo finché c'è almeno un profilo attivo"""
+
+    def __init__(self, profiler: "RequestProfiler"):
+        super().__init__(name="request-profiler", daemon=True)
+        self.profiler = profiler
+        self.wake = threading.Event()
+
+    def run(self):
+        while True:
+            self.wake.wait()
+            profiles = list(self.profiler.active.values())
+            if not profiles:
+                self.wake.clear()
+                # Un profilo avviato tra la lettura e il clear riattiva subito il thread
+                if self.profiler.active:
+                    self.wake.set()
+                continue
+            frames = sys._current_frames()
+            for profile in profiles:
+                if time.perf_counter() - profile.started > self.profiler.max_seconds:
+                    continue
+                running = asyncio.current_task(profile.loop)
+                for task in list(profile.tasks):
+                    if task.done():
+                        profile.tasks.discard(task)
+                    elif task is running:
+                        coro = task.get_coro()
+                        profile.add_sample(_running_stack(frames.get(profile.thread_id), getattr(coro, "cr_frame", None)), True)
+                    else:
+                        profile.add_sample(_coroutine_stack(task), False)
+            time.sleep(self.profiler.interval)
+
+
+class RequestProfiler:
+    """Profiler a campionamento per singola richiesta, attivato da header amministrativo o a campione.
+
+    I campioni sono attribuiti per task (il task della richiesta e quelli che crea), quindi
+    richieste profilate in parallelo non si mescolano. Oltre al tempo di CPU sul loop registra
+    anche dove il task è in attesa, che per una /chat/message lenta è la parte interessante.
+    Senza profili attivi il thread dorme e la task factory non è installata.
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase, sample_rate: float = 0.0, sampled_paths: tuple = ("/api/chat/message",),
+                 interval: float = 0.005, max_seconds: float = 60.0, retention: timedelta = timedelta(days=3)):
+        self.db = db
+        self.collection = db.request_profiles
+        self.sample_rate = sample_rate
+        self.sampled_paths = sampled_paths
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.retention = retention
+        self.active: Dict[str, RequestProfile] = {}
+        self._sampler: Optional[_Sampler] = None
+        self._saves: Set[asyncio.Task] = set()
+        self._previous_factory = None
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("profile_id", unique=True)
+        await self.collection.create_index("created_at", expireAfterSeconds=int(self.retention.total_seconds()))
+
+    def should_profile(self, path: str, headers: Dict[bytes, bytes]) -> Optional[str]:
+        """Motivo della profilazione ("header" o "sampled"), None se la richiesta non va profilata"""
+        if PROFILE_HEADER in headers:
+            expected = os.environ.get('ADMIN_API_TOKEN')
+            token = headers.get(b"x-admin-token", b"").decode("latin-1")
+            if expected and token and hmac.compare_digest(token, expected):
+                return "header"
+        if self.sample_rate and path.startswith(self.sampled_paths) and random.random() < self.sample_rate:
+            return "sampled"
+        return None
+
+    def _task_factory(self, loop, coro, **kwargs):
+        if self._previous_factory:
+            task = self._previous_factory(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        profile = active_profile_var.get()
+        if profile is not None:
+            profile.tasks.add(task)
+        return task
+
+    def start(self, method: str, path: str, trigger: str) -> RequestProfile:
+        loop = asyncio.get_running_loop()
+        profile = RequestProfile(method, path, trigger, loop, threading.get_ident())
+        profile.tasks.add(asyncio.current_task())
+        if not self.active:
+            self._previous_factory = loop.get_task_factory()
+            loop.set_task_factory(self._task_factory)
+        self.active[profile.profile_id] = profile
+        if self._sampler is None:
+            self._sampler = _Sampler(self)
+            self._sampler.start()
+        self._sampler.wake.set()
+        metrics.counter(f"profiler.started.{trigger}").inc()
+        return profile
+
+    def finish(self, profile: RequestProfile, status: int, duration: float):
+        self.active.pop(profile.profile_id, None)
+        profile.close()
+        if not self.active and profile.loop.get_task_factory() == self._task_factory:
+            profile.loop.set_task_factory(self._previous_factory)
+            self._previous_factory = None
+        # Salvataggio fuori dalla richiesta: la risposta è già partita
+        task = asyncio.create_task(self._save(profile, status, duration))
+        self._saves.add(task)
+        task.add_done_callback(self._saves.discard)
+
+    async def _save(self, profile: RequestProfile, status: int, duration: float):
+        try:
+            await self.collection.insert_one({
+                "profile_id": profile.profile_id,
+                "created_at": profile.created_at,
+                "method": profile.method,
+                "path": profile.path,
+                "trigger": profile.trigger,
+                "status": status,
+                "duration_ms": round(duration * 1000, 2),
+                "summary": profile.summary(self.interval),
+                "folded": profile.folded()
+            })
+            logger.info("Profilo richiesta salvato: %s (%s %s, %.0f ms)", profile.profile_id, profile.method,
+                        profile.path, duration * 1000)
+        except Exception as e:
+            metrics.counter("profiler.errors").inc()
+            logger.error("Errore salvataggio profilo %s: %s", profile.profile_id, e)
+
+    async def list_profiles(self, limit: int = 50) -> List[Dict]:
+        cursor = self.collection.find({}, {"_id": 0, "folded": 0, "summary.top_self": 0, "summary.top_total": 0})
+        return await cursor.sort("created_at", -1).limit(limit).to_list(limit)
+
+    async def get_profile(self, profile_id: str) -> Optional[Dict]:
+        return await self.collection.find_one({"profile_id": profile_id}, {"_id": 0})
+
+    async def stop(self):
+        if self._saves:
+            await asyncio.gather(*self._saves, return_exceptions=True)
+
+
+class ProfilingMiddleware:
+    """Middleware ASGI: profila la richiesta se lo chiede un amministratore o se estratta a campione"""
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trigger = self.profiler.should_profile(scope["path"], dict(scope.get("headers") or []))
+        if not trigger:
+            await self.app(scope, receive, send)
+            return
+
+        profile = self.profiler.start(scope["method"], scope["path"], trigger)
+        status = 500
+
+        async def send_with_profile_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(PROFILE_ID_HEADER, profile.profile_id.encode())]
+            await send(message)
+
+        token = active_profile_var.set(profile)
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            active_profile_var.reset(token)
+            self.profiler.finish(profile, status, time.perf_counter() - profile.started)
+
+
+_profiler: Optional[RequestProfiler] = None
+
+
+def init_request_profiler(db: AsyncIOMotorDatabase) -> Optional[RequestProfiler]:
+    """Profiler del processo se PROFILING_ENABLED=true; None altrimenti (nessun middleware installato)"""
+    global _profiler
+    if os.environ.get('PROFILING_ENABLED', 'false').lower() != 'true':
+        return None
+    sampled_paths = tuple(
+        path.strip() for path in os.environ.get('PROFILING_SAMPLED_PATHS', '/api/chat/message').split(",") if path.strip()
+    )
+    _profiler = RequestProfiler(
+        db,
+        sample_rate=float(os.environ.get('PROFILING_SAMPLE_RATE', '0')),
+        sampled_paths=sampled_paths,
+        interval=float(os.environ.get('PROFILING_INTERVAL_MS', '5')) / 1000,
+        max_seconds=float(os.environ.get('PROFILING_MAX_SECONDS', '60')),
+        retention=timedelta(hours=float(os.environ.get('PROFILING_RETENTION_HOURS', '72')))
+    )
+    return _profiler
+
+
+def get_request_profiler() -> Optional[RequestProfiler]:
+    return _profiler
+
+
+async def shutdown_request_profiler():
+    if _profiler:
+        await _profiler.stop()
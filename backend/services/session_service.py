@@ -1,10 +1,14 @@
+import asyncio
 import logging
 from typing import List, Optional, Dict
 from datetime import datetime
 from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
 from models.chat_session import ChatSession, ChatSessionCreate, ChatSessionUpdate
 from models.user_profile import UserProfile, UserProfileCreate
 from models.message import Message, MessageCreate
+from services.session_sweeper import reactivation
+from services.write_behind import get_write_behind
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +19,12 @@ class SessionService:
         self.profiles_collection = db.user_profiles
         self.messages_collection = db.messages
 
+    async def ensure_indexes(self):
+        """Indici usati da lookup per sessione, storia ordinata ed export"""
+        await self.sessions_collection.create_index("session_id")
+        await self.profiles_collection.create_index("session_id")
+        await self.messages_collection.create_index([("session_id", 1), ("timestamp", 1)])
+
     async def create_session(self, session_data: ChatSessionCreate) -> ChatSession:
         """Crea una nuova sessione di chat"""
         try:
@@ -24,10 +34,10 @@ class SessionService:
             result = await self.sessions_collection.insert_one(session_dict)
             session_dict["_id"] = result.inserted_id
             
-            logger.info(f"Sessione creata: {session.session_id}")
+            logger.info("Sessione creata: %s", session.session_id)
             return session
         except Exception as e:
-            logger.error(f"Errore creazione sessione: {e}")
+            logger.error("Errore creazione sessione: %s", e)
             raise
 
     async def get_session(self, session_id: str) -> Optional[ChatSession]:
@@ -39,7 +49,7 @@ class SessionService:
                 return ChatSession(**session_data)
             return None
         except Exception as e:
-            logger.error(f"Errore recupero sessione {session_id}: {e}")
+            logger.error("Errore recupero sessione %s: %s", session_id, e)
             return None
 
     async def update_session(self, session_id: str, update_data: ChatSessionUpdate) -> Optional[ChatSession]:
@@ -58,7 +68,7 @@ class SessionService:
                 return await self.get_session(session_id)
             return None
         except Exception as e:
-            logger.error(f"Errore aggiornamento sessione {session_id}: {e}")
+            logger.error("Errore aggiornamento sessione %s: %s", session_id, e)
             return None
 
     async def create_user_profile(self, session_id: str, profile_data: UserProfileCreate) -> UserProfile:
@@ -88,10 +98,10 @@ class SessionService:
                 result = await self.profiles_collection.insert_one(profile_dict)
                 profile_dict["_id"] = result.inserted_id
                 
-                logger.info(f"Profilo utente creato per sessione: {session_id}")
+                logger.info("Profilo utente creato per sessione: %s", session_id)
                 return profile
         except Exception as e:
-            logger.error(f"Errore gestione profilo utente: {e}")
+            logger.error("Errore gestione profilo utente: %s", e)
             raise
 
     async def get_user_profile(self, session_id: str) -> Optional[UserProfile]:
@@ -103,7 +113,7 @@ class SessionService:
                 return UserProfile(**profile_data)
             return None
         except Exception as e:
-            logger.error(f"Errore recupero profilo utente {session_id}: {e}")
+            logger.error("Errore recupero profilo utente %s: %s", session_id, e)
             return None
 
     async def save_message(self, session_id: str, message_data: MessageCreate, 
@@ -122,21 +132,31 @@ class SessionService:
             )
             
             message_dict = message.dict()
+            
+            # Modalità write-behind: il messaggio è durevole nel journal locale, Mongo viene aggiornato in background
+            write_behind = get_write_behind()
+            if write_behind:
+                await write_behind.enqueue_message(message_dict)
+                return message
+            
             result = await self.messages_collection.insert_one(message_dict)
             message_dict["_id"] = result.inserted_id
             
-            # Aggiorna il contatore messaggi nella sessione
-            await self.sessions_collection.update_one(
-                {"session_id": session_id},
-                {
-                    "$inc": {"message_count": 1},
-                    "$set": {"updated_at": datetime.utcnow()}
-                }
-            )
+            # Aggiorna il contatore messaggi nella sessione e la riattiva se era stata abbandonata
+            await self.sessions_collection.bulk_write([
+                UpdateOne(
+                    {"session_id": session_id},
+                    {
+                        "$inc": {"message_count": 1},
+                        "$set": {"updated_at": datetime.utcnow()}
+                    }
+                ),
+                reactivation(session_id)
+            ])
             
             return message
         except Exception as e:
-            logger.error(f"Errore salvataggio messaggio: {e}")
+            logger.error("Errore salvataggio messaggio: %s", e)
             raise
 
     async def get_conversation_history(self, session_id: str, limit: int = 50) -> List[Message]:
@@ -151,11 +171,146 @@ class SessionService:
                 message_data.pop("_id", None)
                 messages.append(Message(**message_data))
             
+            # Include i messaggi accettati ma non ancora scritti dal write-behind
+            write_behind = get_write_behind()
+            pending = write_behind.pending_messages(session_id) if write_behind else []
+            if pending:
+                known_ids = {msg.id for msg in messages}
+                messages.extend(Message(**doc) for doc in pending if doc["id"] not in known_ids)
+                messages.sort(key=lambda msg: msg.timestamp)
+                messages = messages[:limit]
+            
             return messages
         except Exception as e:
-            logger.error(f"Errore recupero conversazione {session_id}: {e}")
+            logger.error("Errore recupero conversazione %s: %s", session_id, e)
             return []
 
+    async def get_recent_history(self, session_id: str, limit: int) -> List[Message]:
+        """Ultimi `limit` messaggi in ordine cronologico: il contesto passato all'AI ad ogni turno"""
+        try:
+            cursor = self.messages_collection.find(
+                {"session_id": session_id}
+            ).sort("timestamp", -1).limit(limit)
+            
+            messages = []
+            async for message_data in cursor:
+                message_data.pop("_id", None)
+                messages.append(Message(**message_data))
+            
+            # I messaggi ancora nel write-behind sono i più recenti
+            write_behind = get_write_behind()
+            pending = write_behind.pending_messages(session_id) if write_behind else []
+            if pending:
+                known_ids = {msg.id for msg in messages}
+                messages.extend(Message(**doc) for doc in pending if doc["id"] not in known_ids)
+            messages.sort(key=lambda msg: msg.timestamp)
+            return messages[-limit:]
+        except Exception as e:
+            logger.error("Errore recupero conversazione %s: %s", session_id, e)
+            return []
+
+    async def get_last_message_id(self, session_id: str) -> Optional[str]:
+        """ID dell'ultimo messaggio della sessione, inclusi quelli ancora nel write-behind"""
+        last = await self.messages_collection.find_one(
+            {"session_id": session_id}, {"_id": 0, "id": 1, "timestamp": 1}, sort=[("timestamp", -1)]
+        )
+        write_behind = get_write_behind()
+        pending = write_behind.pending_messages(session_id) if write_behind else []
+        if pending and (last is None or pending[-1]["timestamp"] >= last["timestamp"]):
+            last = pending[-1]
+        return last["id"] if last else None
+
+    async def get_sessions(self, session_ids: List[str]) -> Dict[str, ChatSession]:
+        """Recupera più sessioni con una sola query $in, indicizzate per session_id"""
+        sessions = {}
+        async for session_data in self.sessions_collection.find({"session_id": {"$in": session_ids}}):
+            session_data.pop("_id", None)
+            sessions[session_data["session_id"]] = ChatSession(**session_data)
+        return sessions
+
+    async def get_user_profiles(self, session_ids: List[str]) -> Dict[str, UserProfile]:
+        """Recupera i profili di più sessioni con una sola query $in"""
+        profiles = {}
+        async for profile_data in self.profiles_collection.find({"session_id": {"$in": session_ids}}):
+            profile_data.pop("_id", None)
+            profiles[profile_data["session_id"]] = UserProfile(**profile_data)
+        return profiles
+
+    def _histories_pipeline(self, session_ids: List[str], limit: int) -> List[Dict]:
+        """Primi `limit` messaggi di ogni sessione con una sola aggregazione, solo i campi del riassunto.
+
+        Un $lookup per sessione con $limit sull'indice (session_id, timestamp): nessun array
+        intermedio con tutti i messaggi della sessione, come farebbe $group con $push.
+        """
+        return [
+            {"$match": {"session_id": {"$in": session_ids}}},
+            {"$project": {"_id": 0, "session_id": 1}},
+            {"$lookup": {
+                "from": self.messages_collection.name,
+                "let": {"session_id": "$session_id"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$eq": ["$session_id", "$$session_id"]}}},
+                    {"$sort": {"timestamp": 1}},
+                    {"$limit": limit},
+                    {"$project": {"_id": 0, "id": 1, "session_id": 1, "message_type": 1, "urgency_level": 1,
+                                  "timestamp": 1}}
+                ],
+                "as": "messages"
+            }}
+        ]
+
+    async def _get_histories(self, session_ids: List[str], limit: int) -> Dict[str, List[Message]]:
+        histories: Dict[str, List[Message]] = {}
+        async for row in self.sessions_collection.aggregate(self._histories_pipeline(session_ids, limit)):
+            # Documenti parziali già validati in scrittura: nessuna validazione pydantic
+            if row["messages"]:
+                histories[row["session_id"]] = [Message.model_construct(**doc) for doc in row["messages"]]
+
+        write_behind = get_write_behind()
+        if write_behind:
+            for session_id in session_ids:
+                pending = write_behind.pending_messages(session_id)
+                if not pending:
+                    continue
+                messages = histories.setdefault(session_id, [])
+                known_ids = {msg.id for msg in messages}
+                messages.extend(Message(**doc) for doc in pending if doc["id"] not in known_ids)
+                messages.sort(key=lambda msg: msg.timestamp)
+                del messages[limit:]
+        return histories
+
+    def _build_summary(self, session: ChatSession, profile: Optional[UserProfile], messages: List[Message]) -> Dict:
+        # Analizza i messaggi per estrarre informazioni
+        user_messages = [msg for msg in messages if msg.message_type == "user"]
+        assistant_messages = [msg for msg in messages if msg.message_type == "assistant"]
+        
+        # Trova il livello di urgenza più alto
+        urgency_levels = [msg.urgency_level for msg in assistant_messages if msg.urgency_level]
+        max_urgency = "low"
+        if "high" in urgency_levels:
+            max_urgency = "high"
+        elif "medium" in urgency_levels:
+            max_urgency = "medium"
+        
+        # Estrai sintomi menzionati
+        symptoms_mentioned = []
+        if profile and profile.sintomo_principale:
+            symptoms_mentioned.append(profile.sintomo_principale)
+        if profile and profile.sintomi_associati:
+            symptoms_mentioned.extend(profile.sintomi_associati)
+        
+        return {
+            "session_id": session.session_id,
+            "start_time": session.start_time,
+            "end_time": session.end_time or datetime.utcnow(),
+            "message_count": len(messages),
+            "user_profile": profile.dict() if profile else None,
+            "symptoms_mentioned": list(set(symptoms_mentioned)),
+            "max_urgency_level": max_urgency,
+            "conversation_length": len(user_messages),
+            "last_message_time": messages[-1].timestamp if messages else session.start_time
+        }
+
     async def get_session_summary(self, session_id: str) -> Optional[Dict]:
         """Genera un riassunto della sessione per i risultati"""
         try:
@@ -165,43 +320,30 @@ class SessionService:
             
             profile = await self.get_user_profile(session_id)
             messages = await self.get_conversation_history(session_id)
-            
-            # Analizza i messaggi per estrarre informazioni
-            user_messages = [msg for msg in messages if msg.message_type == "user"]
-            assistant_messages = [msg for msg in messages if msg.message_type == "assistant"]
-            
-            # Trova il livello di urgenza più alto
-            urgency_levels = [msg.urgency_level for msg in assistant_messages if msg.urgency_level]
-            max_urgency = "low"
-            if "high" in urgency_levels:
-                max_urgency = "high"
-            elif "medium" in urgency_levels:
-                max_urgency = "medium"
-            
-            # Estrai sintomi menzionati
-            symptoms_mentioned = []
-            if profile and profile.sintomo_principale:
-                symptoms_mentioned.append(profile.sintomo_principale)
-            if profile and profile.sintomi_associati:
-                symptoms_mentioned.extend(profile.sintomi_associati)
-            
-            summary = {
-                "session_id": session_id,
-                "start_time": session.start_time,
-                "end_time": session.end_time or datetime.utcnow(),
-                "message_count": len(messages),
-                "user_profile": profile.dict() if profile else None,
-                "symptoms_mentioned": list(set(symptoms_mentioned)),
-                "max_urgency_level": max_urgency,
-                "conversation_length": len(user_messages),
-                "last_message_time": messages[-1].timestamp if messages else session.start_time
-            }
-            
-            return summary
+            return self._build_summary(session, profile, messages)
         except Exception as e:
-            logger.error(f"Errore generazione riassunto sessione {session_id}: {e}")
+            logger.error("Errore generazione riassunto sessione %s: %s", session_id, e)
             return None
 
+    async def get_session_summaries(self, session_ids: List[str], history_limit: int = 50) -> Dict[str, Dict]:
+        """Riassunti di più sessioni con tre query in totale, indipendentemente dal numero di sessioni.
+
+        Stesso contenuto di get_session_summary (calcolato sui primi history_limit messaggi);
+        le sessioni inesistenti non compaiono nel risultato.
+        """
+        sessions = await self.get_sessions(session_ids)
+        if not sessions:
+            return {}
+        found_ids = list(sessions)
+        profiles, histories = await asyncio.gather(
+            self.get_user_profiles(found_ids),
+            self._get_histories(found_ids, history_limit)
+        )
+        return {
+            session_id: self._build_summary(session, profiles.get(session_id), histories.get(session_id, []))
+            for session_id, session in sessions.items()
+        }
+
     async def close_session(self, session_id: str) -> bool:
         """Chiude una sessione attiva"""
         try:
@@ -218,7 +360,7 @@ class SessionService:
             
             return update_result.modified_count > 0
         except Exception as e:
-            logger.error(f"Errore chiusura sessione {session_id}: {e}")
+            logger.error("Errore chiusura sessione %s: %s", session_id, e)
             return False
 
     async def cleanup_old_sessions(self, days_old: int = 30) -> int:
@@ -248,9 +390,9 @@ class SessionService:
                 sessions_result.deleted_count
             )
             
-            logger.info(f"Pulizia completata: {total_deleted} documenti eliminati")
+            logger.info("Pulizia completata: %s documenti eliminati", total_deleted)
             return total_deleted
             
         except Exception as e:
-            logger.error(f"Errore pulizia sessioni vecchie: {e}")
+            logger.error("Errore pulizia sessioni vecchie: %s", e)
             return 0
\ No newline at end of file
@@ -0,0 +1,148 @@
+import time
+import random
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+from services.metrics import metrics
+from services.turn_coordinator import MongoLeaseLockBackend
+
+logger = logging.getLogger(__name__)
+
+SWEEPER_LEASE_KEY = "sweeper:abandoned_sessions"
+
+
+def reactivation(session_id: str) -> UpdateOne:
+    """Operazione che riporta attiva una sessione abbandonata quando riceve un nuovo messaggio"""
+    return UpdateOne(
+        {"session_id": session_id, "status": "abandoned"},
+        {"$set": {"status": "active"}, "$unset": {"end_time": ""}}
+    )
+
+
+class SessionSweeper:
+    """Porta in stato "abandoned" le sessioni attive senza attività da più di idle_after.
+
+    Ogni giro lavora a lotti limitati: le sessioni candidate arrivano dall'indice (status, updated_at),
+    la transizione è un update_many che ricontrolla la condizione, quindi una sessione tornata attiva
+    nel frattempo non viene toccata. Con più worker solo chi ottiene la lease Mongo esegue il giro.
+    Un nuovo messaggio riporta la sessione attiva (vedi reactivation).
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase, idle_after: timedelta = timedelta(hours=1),
+                 interval: float = 300.0, jitter: float = 0.2, batch_size: int = 500, max_batches: int = 20):
+        self.db = db
+        self.sessions = db.chat_sessions
+        self.idle_after = idle_after
+        self.interval = interval
+        self.jitter = jitter
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.lease = MongoLeaseLockBackend(db)
+        self._task: Optional[asyncio.Task] = None
+        self._backlog = 0
+        self._throughput = 0.0
+
+        self._abandoned = metrics.counter("sweeper.sessions_abandoned")
+        self._batch_seconds = metrics.histogram("sweeper.batch_seconds")
+        metrics.gauge("sweeper.backlog", lambda: self._backlog)
+        metrics.gauge("sweeper.throughput_per_second", lambda: self._throughput)
+
+    async def ensure_indexes(self):
+        await self.sessions.create_index([("status", 1), ("updated_at", 1)])
+        await self.lease.ensure_indexes()
+
+    def _stale_filter(self, cutoff: datetime) -> Dict:
+        return {"status": "active", "updated_at": {"$lt": cutoff}}
+
+    async def sweep_batch(self, cutoff: datetime) -> int:
+        """Un lotto: candidati dall'indice, transizione con update_many che ricontrolla la condizione"""
+        cursor = self.sessions.find(self._stale_filter(cutoff), {"session_id": 1, "_id": 0})
+        candidates = await cursor.sort("updated_at", 1).limit(self.batch_size).to_list(self.batch_size)
+        session_ids = [doc["session_id"] for doc in candidates]
+        if not session_ids:
+            return 0
+
+        # Pipeline di update: end_time prende l'ultima attività del documento stesso, non l'ora dello sweep.
+        # Il riepilogo non viene salvato: gli endpoint lo calcolano dai messaggi, che possono ancora arrivare
+        result = await self.sessions.update_many(
+            {"session_id": {"$in": session_ids}, **self._stale_filter(cutoff)},
+            [{"$set": {"status": "abandoned", "end_time": "$updated_at"}}]
+        )
+        return result.modified_count
+
+    async def sweep_once(self) -> int:
+        """Esegue fino a max_batches lotti se questo worker ottiene la lease; restituisce le sessioni chiuse"""
+        token = await self.lease.try_acquire(SWEEPER_LEASE_KEY, lease_seconds=self.interval)
+        if not token:
+            metrics.counter("sweeper.lease_skipped").inc()
+            return 0
+
+        start = time.perf_counter()
+        total = 0
+        cutoff = datetime.utcnow() - self.idle_after
+        try:
+            for _ in range(self.max_batches):
+                batch_start = time.perf_counter()
+                moved = await self.sweep_batch(cutoff)
+                self._batch_seconds.observe(time.perf_counter() - batch_start)
+                total += moved
+                self._abandoned.inc(moved)
+                if moved < self.batch_size:
+                    break
+            # Arretrato residuo limitato a un conteggio sull'indice, senza leggere i documenti
+            self._backlog = await self.sessions.count_documents(
+                self._stale_filter(cutoff), limit=self.batch_size * self.max_batches
+            )
+        finally:
+            await self.lease.release(SWEEPER_LEASE_KEY, token)
+
+        elapsed = time.perf_counter() - start
+        self._throughput = total / elapsed if elapsed > 0 else 0.0
+        if total:
+            logger.info("Sessioni abbandonate: %s in %.2f s, arretrato %s", total, elapsed, self._backlog)
+        return total
+
+    async def start(self):
+        await self.ensure_indexes()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            # Jitter: i worker avviati insieme non si contendono la lease allo stesso istante
+            await asyncio.sleep(self.interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+            try:
+                await self.sweep_once()
+            except Exception as e:
+                metrics.counter("sweeper.errors").inc()
+                logger.error("Errore sweep sessioni abbandonate: %s", e)
+
+
+_sweeper: Optional[SessionSweeper] = None
+
+
+async def init_session_sweeper(db: AsyncIOMotorDatabase, idle_minutes: float = 60.0, interval: float = 300.0,
+                               batch_size: int = 500) -> SessionSweeper:
+    global _sweeper
+    _sweeper = SessionSweeper(db, idle_after=timedelta(minutes=idle_minutes), interval=interval, batch_size=batch_size)
+    await _sweeper.start()
+    return _sweeper
+
+
+async def shutdown_session_sweeper():
+    global _sweeper
+    if _sweeper:
+        await _sweeper.stop()
+        _sweeper = None
@@ -0,0 +1,255 @@
+import os
+import sys
+import time
+import zlib
+import logging
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from models.message import Message
+from models.user_profile import UserProfile
+from services.knowledge_index import is_profile_light, tokenize
+from services.memory_budget import budget_from_env, deep_sizeof, memory
+from services.metrics import metrics
+from services.triage import detect_red_flags
+
+logger = logging.getLogger(__name__)
+
+# Primo numero primo oltre 2^32: gli hash universali (a * x + b) mod P restano in uint64 senza overflow
+_PRIME = np.uint64(4294967311)
+_MAX_HASH = np.uint32(0xFFFFFFFF)
+
+# Token (già normalizzati da tokenize) che cambiano il senso della frase: devono coincidere esattamente
+NEGATION_TOKENS = {"non", "senz", "mai", "nessun", "nient", "neanch", "nemmen"}
+
+
+def shingles(tokens: List[str], n: int = 3) -> List[bytes]:
+    """N-grammi di caratteri dei token normalizzati; l'insieme non dipende dall'ordine delle parole"""
+    grams = set()
+    for token in tokens:
+        padded = f" {token} "
+        for i in range(max(1, len(padded) - n + 1)):
+            grams.add(padded[i:i + n])
+    return [gram.encode("utf-8") for gram in grams]
+
+
+def guard_key(tokens: List[str], context: str = "") -> int:
+    """Hash di negazioni, numeri e contesto del prompt: "febbre a 38" e "febbre a 40" non devono mai
+    condividere la risposta, né due turni con profilo o messaggi precedenti diversi"""
+    guarded = sorted(token for token in tokens if token in NEGATION_TOKENS or token.isdigit())
+    return zlib.crc32(f"{' '.join(guarded)}\x00{context}".encode("utf-8"))
+
+
+@dataclass
+class CachedAnswer:
+    response: str
+    urgency_level: str
+    next_questions: List[str]
+    similarity: float
+
+
+class SimilarityCache:
+    """Cache approssimata delle risposte basata su MinHash/LSH.
+
+    Memoria fissa: le firme stanno in una matrice preallocata (capacity x num_perm) e ogni banda LSH
+    è una tabella ad accesso diretto (chiave troncata -> slot) che si sovrascrive in caso di collisione,
+    quindi nessuna struttura cresce con il traffico. I candidati vengono verificati stimando la
+    similarità di Jaccard dalle firme; lo sfratto usa l'algoritmo CLOCK sugli slot.
+    """
+
+    def __init__(self, capacity: int = 100_000, threshold: float = 0.7, num_perm: int = 32, bands: int = 8,
+                 ttl: float = 86400.0, min_tokens: int = 2, seed: int = 1, max_bytes: Optional[int] = None):
+        if num_perm % bands:
+            raise ValueError("num_perm deve essere multiplo di bands")
+        self.capacity = capacity
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.max_bytes = max_bytes
+
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2 ** 31, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 2 ** 31, size=num_perm, dtype=np.uint64)
+
+        self._signatures = np.zeros((capacity, num_perm), dtype=np.uint32)
+        self._guards = np.zeros(capacity, dtype=np.uint32)
+        self._stored_at = np.zeros(capacity, dtype=np.float64)
+        self._referenced = np.zeros(capacity, dtype=bool)
+        self._answers: List[Optional[Tuple[str, str, List[str]]]] = [None] * capacity
+        self._answer_sizes = np.zeros(capacity, dtype=np.uint32)
+        self._answer_bytes = 0
+        self._size = 0
+        self._hand = 0
+
+        # Due posizioni per slot per banda tengono basso il tasso di sovrascrittura
+        table_size = 1 << max(4, (2 * capacity - 1).bit_length())
+        self._table_mask = table_size - 1
+        self._band_keys = np.zeros((bands, table_size), dtype=np.uint32)
+        self._band_slots = np.full((bands, table_size), -1, dtype=np.int32)
+        # Parte fissa preallocata; le risposte sono la parte variabile, misurata all'inserimento
+        self._fixed_bytes = sum(array.nbytes for array in (
+            self._signatures, self._guards, self._stored_at, self._referenced, self._answer_sizes,
+            self._band_keys, self._band_slots
+        )) + sys.getsizeof(self._answers)
+        if max_bytes is not None and self._fixed_bytes > max_bytes:
+            raise ValueError(f"max_bytes ({max_bytes}) inferiore alla parte preallocata ({self._fixed_bytes})")
+
+        self._lookups = metrics.counter("similarity_cache.lookups")
+        self._hits = metrics.counter("similarity_cache.hits")
+        self._skipped = metrics.counter("similarity_cache.skipped")
+        self._evictions = metrics.counter("similarity_cache.evictions")
+        metrics.gauge("similarity_cache.entries", lambda: self._size)
+        metrics.gauge("similarity_cache.hit_rate", self.hit_rate)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def memory_usage(self) -> dict:
+        return {"bytes": self._fixed_bytes + self._answer_bytes, "entries": self._size, "budget_bytes": self.max_bytes}
+
+    def _clear_slot(self, slot: int):
+        self._answer_bytes -= int(self._answer_sizes[slot])
+        self._answer_sizes[slot] = 0
+        self._answers[slot] = None
+
+    def _evict_over_budget(self, keep: int):
+        """Svuota slot in ordine CLOCK finché le risposte rientrano nel budget; lo slot keep resta"""
+        budget = self.max_bytes - self._fixed_bytes
+        for _ in range(2 * self.capacity):
+            if self._answer_bytes <= budget:
+                return
+            slot = self._hand
+            self._hand = (self._hand + 1) % self._size
+            if slot == keep or self._answers[slot] is None:
+                continue
+            if self._referenced[slot]:
+                self._referenced[slot] = False
+                continue
+            self._clear_slot(slot)
+            self._evictions.inc()
+
+    def hit_rate(self) -> float:
+        return self._hits.value / self._lookups.value if self._lookups.value else 0.0
+
+    def signature(self, tokens: List[str]) -> Optional[np.ndarray]:
+        if len(tokens) < self.min_tokens:
+            return None
+        grams = shingles(tokens)
+        base = np.fromiter((zlib.crc32(gram) for gram in grams), dtype=np.uint64, count=len(grams))
+        hashed = (self._a[:, None] * base[None, :] + self._b[:, None]) % _PRIME
+        return np.minimum(hashed.min(axis=1), _MAX_HASH).astype(np.uint32)
+
+    def _band_positions(self, signature: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Per ogni banda: chiave a 32 bit delle sue righe e posizione nella tabella"""
+        keys = np.array(
+            [zlib.crc32(signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)],
+            dtype=np.uint32
+        )
+        return keys, keys & self._table_mask
+
+    def get(self, text: str, now: Optional[float] = None, context: str = "") -> Optional[CachedAnswer]:
+        self._lookups.inc()
+        tokens = tokenize(text)
+        signature = self.signature(tokens)
+        if signature is None:
+            return None
+        now = now or time.time()
+        guard = guard_key(tokens, context)
+        keys, positions = self._band_positions(signature)
+        band_index = np.arange(self.bands)
+        candidates = self._band_slots[band_index, positions]
+        candidates = np.unique(candidates[(candidates >= 0) & (self._band_keys[band_index, positions] == keys)])
+
+        best_slot, best_similarity = -1, 0.0
+        for slot in candidates:
+            if self._answers[slot] is None or now - self._stored_at[slot] > self.ttl or self._guards[slot] != guard:
+                continue
+            similarity = float(np.count_nonzero(self._signatures[slot] == signature)) / self.num_perm
+            if similarity > best_similarity:
+                best_slot, best_similarity = int(slot), similarity
+
+        if best_slot < 0 or best_similarity < self.threshold:
+            return None
+        self._hits.inc()
+        self._referenced[best_slot] = True
+        response, urgency_level, next_questions = self._answers[best_slot]
+        return CachedAnswer(response, urgency_level, list(next_questions), best_similarity)
+
+    def _next_slot(self) -> int:
+        if self._size < self.capacity:
+            self._size += 1
+            return self._size - 1
+        # CLOCK: gli slot usati di recente ottengono una seconda possibilità prima di essere sfrattati
+        while self._referenced[self._hand]:
+            self._referenced[self._hand] = False
+            self._hand = (self._hand + 1) % self.capacity
+        slot = self._hand
+        self._hand = (self._hand + 1) % self.capacity
+        self._evictions.inc()
+        return slot
+
+    def put(self, text: str, response: str, urgency_level: str, next_questions: List[str],
+            now: Optional[float] = None, context: str = "") -> bool:
+        tokens = tokenize(text)
+        signature = self.signature(tokens)
+        if signature is None:
+            return False
+        slot = self._next_slot()
+        self._signatures[slot] = signature
+        self._guards[slot] = guard_key(tokens, context)
+        self._stored_at[slot] = now or time.time()
+        self._referenced[slot] = False
+        self._clear_slot(slot)
+        answer = (response, urgency_level, list(next_questions))
+        self._answers[slot] = answer
+        self._answer_sizes[slot] = deep_sizeof(answer)
+        self._answer_bytes += int(self._answer_sizes[slot])
+        if self.max_bytes is not None and self._fixed_bytes + self._answer_bytes > self.max_bytes:
+            self._evict_over_budget(keep=slot)
+        # Le voci delle bande che puntano ancora allo slot sfrattato falliscono la verifica sulla firma
+        keys, positions = self._band_positions(signature)
+        band_index = np.arange(self.bands)
+        self._band_keys[band_index, positions] = keys
+        self._band_slots[band_index, positions] = slot
+        return True
+
+    def is_cacheable(
+        self,
+        user_message: str,
+        user_profile: Optional[UserProfile],
+        conversation_history: Optional[List[Message]]
+    ) -> bool:
+        """Esclusioni di sicurezza: segnali di emergenza, urgenza alta pregressa, contesto personale"""
+        cacheable = (
+            not detect_red_flags(user_message)
+            and not any(msg.urgency_level == "high" for msg in (conversation_history or []))
+            and is_profile_light(user_profile, conversation_history)
+        )
+        if not cacheable:
+            self._skipped.inc()
+        return cacheable
+
+
+_cache: Optional[SimilarityCache] = None
+
+
+def get_similarity_cache() -> Optional[SimilarityCache]:
+    """Cache condivisa, creata al primo uso; None se disabilitata"""
+    global _cache
+    if os.environ.get('SIMILARITY_CACHE_ENABLED', 'false').lower() != 'true':
+        return None
+    if _cache is None:
+        _cache = SimilarityCache(
+            capacity=int(os.environ.get('SIMILARITY_CACHE_MAX_ENTRIES', '100000')),
+            threshold=float(os.environ.get('SIMILARITY_CACHE_THRESHOLD', '0.7')),
+            ttl=float(os.environ.get('SIMILARITY_CACHE_TTL', '86400')),
+            max_bytes=budget_from_env('SIMILARITY_CACHE_MAX_MB', 64)
+        )
+        memory.register("similarity_cache", _cache)
+        logger.info("Cache per similarità attiva: %d voci, soglia %s", _cache.capacity, _cache.threshold)
+    return _cache
@@ -0,0 +1,309 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from models.message import Message
+from models.user_profile import UserProfile
+from services.admission import get_admission_controller
+from services.drain import is_draining
+from services.memory_budget import deep_sizeof, memory
+from services.metrics import metrics
+from services.request_profiler import active_profile_var
+from services.traffic_capture import llm_calls_var
+
+if TYPE_CHECKING:
+    from services.ai_service import AIService
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(text: str) -> str:
+    """Chiave di confronto tra domanda suggerita e messaggio inviato dal tap"""
+    return " ".join(text.lower().split())
+
+
+class _Speculation:
+    """Risposta anticipata a una domanda suggerita: in corso, pronta, servita o sprecata"""
+
+    __slots__ = ("question", "task", "result", "usage", "outcome", "accounted")
+
+    def __init__(self, question: str):
+        self.question = question
+        self.task: Optional[asyncio.Task] = None
+        self.result: Optional[Tuple[str, str, List[str]]] = None
+        self.usage: Dict[str, int] = {}
+        self.outcome: Optional[str] = None
+        self.accounted = False
+
+    @property
+    def tokens(self) -> int:
+        return self.usage.get("input_tokens", 0) + self.usage.get("output_tokens", 0)
+
+
+class _SessionSpeculations:
+    """Speculazioni di una sessione, valide solo finché l'ultimo messaggio è base_message_id"""
+
+    __slots__ = ("base_message_id", "entries", "created")
+
+    def __init__(self, base_message_id: str):
+        self.base_message_id = base_message_id
+        self.entries: Dict[str, _Speculation] = {}
+        self.created = time.monotonic()
+
+
+class SpeculativeResponder:
+    """Pre-genera in background le risposte alle domande suggerite con l'ultima risposta.
+
+    Parte solo con capacità LLM libera (admission senza coda e sotto idle_fraction degli slot),
+    entro un budget di token per sessione e uno globale per minuto, con al più max_inflight
+    chiamate contemporanee. Se il turno successivo è il tap su una domanda suggerita la risposta
+    viene servita da qui (attendendo la chiamata se ancora in corso); qualunque altro messaggio,
+    un aggiornamento del profilo o la chiusura annullano le speculazioni della sessione.
+    """
+
+    def __init__(self, max_per_turn: int = 3, max_inflight: int = 4, session_token_budget: int = 8000,
+                 global_tokens_per_minute: int = 60000, idle_fraction: float = 0.5, ttl: float = 600.0,
+                 max_sessions: int = 5000):
+        self.max_per_turn = max_per_turn
+        self.max_inflight = max_inflight
+        self.session_token_budget = session_token_budget
+        self.global_tokens_per_minute = global_tokens_per_minute
+        self.idle_fraction = idle_fraction
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, _SessionSpeculations]" = OrderedDict()
+        self._spent: "OrderedDict[str, int]" = OrderedDict()
+        self._inflight = 0
+        self._window_started = time.monotonic()
+        self._window_tokens = 0
+
+        self._launched = metrics.counter("speculation.launched")
+        self._hits = metrics.counter("speculation.hits")
+        self._misses = metrics.counter("speculation.misses")
+        self._errors = metrics.counter("speculation.errors")
+        self._tokens_generated = metrics.counter("speculation.tokens_generated")
+        self._tokens_served = metrics.counter("speculation.tokens_served")
+        self._tokens_wasted = metrics.counter("speculation.tokens_wasted")
+        self._wait = metrics.histogram("speculation.hit_wait_seconds")
+        metrics.gauge("speculation.hit_rate", self.hit_rate)
+        metrics.gauge("speculation.wasted_token_ratio", self.wasted_token_ratio)
+        metrics.gauge("speculation.inflight", lambda: self._inflight)
+        metrics.gauge("speculation.sessions", lambda: len(self._sessions))
+
+    def hit_rate(self) -> float:
+        """Turni serviti da una speculazione sui turni arrivati mentre la sessione ne aveva"""
+        total = self._hits.value + self._misses.value
+        return self._hits.value / total if total else 0.0
+
+    def wasted_token_ratio(self) -> float:
+        """Token stimati delle speculazioni mai servite sul totale dei token speculativi conclusi"""
+        settled = self._tokens_served.value + self._tokens_wasted.value
+        return self._tokens_wasted.value / settled if settled else 0.0
+
+    def memory_usage(self) -> dict:
+        # Limitata da max_sessions e dalla durata ttl
+        return {
+            "bytes": deep_sizeof((self._sessions, self._spent)),
+            "entries": len(self._sessions),
+            "budget_bytes": None
+        }
+
+    def has_pending(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def _refill_window(self, now: float):
+        if now - self._window_started >= 60.0:
+            self._window_started = now
+            self._window_tokens = 0
+
+    def _skip_reason(self, session_id: str) -> Optional[str]:
+        if self._inflight >= self.max_inflight:
+            return "busy"
+        admission = get_admission_controller()
+        if admission and not admission.has_spare_capacity(self.idle_fraction):
+            return "busy"
+        if self._spent.get(session_id, 0) >= self.session_token_budget:
+            return "session_budget"
+        self._refill_window(time.monotonic())
+        if self._window_tokens >= self.global_tokens_per_minute:
+            return "global_budget"
+        return None
+
+    def _charge(self, session_id: str, tokens: int):
+        self._refill_window(time.monotonic())
+        self._window_tokens += tokens
+        self._spent[session_id] = self._spent.get(session_id, 0) + tokens
+        self._spent.move_to_end(session_id)
+        while len(self._spent) > self.max_sessions:
+            self._spent.popitem(last=False)
+
+    def _settle(self, speculation: _Speculation):
+        """Conta i token come serviti o sprecati una sola volta, a chiamata conclusa ed esito deciso"""
+        if speculation.accounted or speculation.outcome is None or not speculation.task.done():
+            return
+        speculation.accounted = True
+        if speculation.outcome == "served":
+            self._tokens_served.inc(speculation.tokens)
+        else:
+            self._tokens_wasted.inc(speculation.tokens)
+
+    def _discard(self, pending: _SessionSpeculations):
+        for speculation in pending.entries.values():
+            if speculation.outcome is None:
+                speculation.outcome = "wasted"
+            if not speculation.task.done():
+                # I token già inviati vengono contati dal task alla cancellazione
+                speculation.task.cancel()
+            self._settle(speculation)
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._sessions:
+            session_id, pending = next(iter(self._sessions.items()))
+            if now - pending.created < self.ttl and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[session_id]
+            self._discard(pending)
+
+    def cancel(self, session_id: str):
+        """Annulla le speculazioni della sessione (profilo aggiornato, sessione chiusa)"""
+        pending = self._sessions.pop(session_id, None)
+        if pending:
+            self._discard(pending)
+
+    def schedule(self, ai_service: "AIService", session_id: str, base_message_id: str, questions: List[str],
+                 user_profile: Optional[UserProfile], conversation_history: List[Message]):
+        """Avvia le speculazioni per le domande suggerite dopo il messaggio base_message_id"""
+        self.cancel(session_id)
+        if is_draining() or not questions:
+            return
+
+        pending = _SessionSpeculations(base_message_id)
+        for question in questions[:self.max_per_turn]:
+            key = normalize_question(question)
+            if not key or key in pending.entries:
+                continue
+            reason = self._skip_reason(session_id)
+            if reason:
+                metrics.counter(f"speculation.skipped.{reason}").inc()
+                break
+            speculation = _Speculation(question)
+            speculation.task = asyncio.create_task(
+                self._run(ai_service, session_id, speculation, user_profile, list(conversation_history))
+            )
+            speculation.task.add_done_callback(lambda _, speculation=speculation: self._finished(session_id, speculation))
+            pending.entries[key] = speculation
+            self._inflight += 1
+            self._launched.inc()
+        if pending.entries:
+            self._sessions[session_id] = pending
+        self._expire()
+
+    async def _run(self, ai_service: "AIService", session_id: str, speculation: _Speculation,
+                   user_profile: Optional[UserProfile], conversation_history: List[Message]):
+        # Il task eredita il contesto della richiesta: le sue chiamate LLM non vanno attribuite a quella
+        llm_calls_var.set(None)
+        active_profile_var.set(None)
+        try:
+            speculation.result = await ai_service.generate_speculative_response(
+                session_id, speculation.question, user_profile, conversation_history, speculation.usage
+            )
+        except Exception as e:
+            self._errors.inc()
+            logger.warning("Speculazione fallita per la sessione %s: %s", session_id, e)
+
+    def _finished(self, session_id: str, speculation: _Speculation):
+        # Callback del task: eseguito anche se annullato prima di partire
+        self._inflight -= 1
+        # Una chiamata annullata ha comunque inviato il prompt: conta almeno l'input
+        self._charge(session_id, speculation.tokens)
+        self._tokens_generated.inc(speculation.tokens)
+        self._settle(speculation)
+
+    async def take(self, session_id: str, user_message: str,
+                   last_message_id: Optional[str]) -> Optional[Tuple[str, str, List[str]]]:
+        """Risposta anticipata se il messaggio è il tap su una domanda suggerita, altrimenti None.
+
+        In ogni caso le speculazioni della sessione vengono consumate: quelle non usate sono sprecate.
+        La speculazione vale solo se l'ultimo messaggio salvato è ancora quello da cui è partita.
+        """
+        pending = self._sessions.pop(session_id, None)
+        if pending is None:
+            return None
+        speculation = None
+        if pending.base_message_id == last_message_id and time.monotonic() - pending.created < self.ttl:
+            speculation = pending.entries.pop(normalize_question(user_message), None)
+        self._discard(pending)
+        if speculation is None:
+            self._misses.inc()
+            return None
+
+        start = time.perf_counter()
+        try:
+            # Se il tap arriva prima della fine della chiamata si attende quella già partita
+            await asyncio.shield(speculation.task)
+        except asyncio.CancelledError:
+            # Richiesta annullata durante l'attesa: la risposta non verrà servita
+            speculation.outcome = "wasted"
+            self._settle(speculation)
+            raise
+        finally:
+            self._wait.observe(time.perf_counter() - start)
+        if speculation.result is None:
+            speculation.outcome = "wasted"
+            self._settle(speculation)
+            self._misses.inc()
+            return None
+        speculation.outcome = "served"
+        self._settle(speculation)
+        self._hits.inc()
+        return speculation.result
+
+    async def close(self):
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        tasks = [speculation.task for pending in sessions for speculation in pending.entries.values()]
+        for pending in sessions:
+            self._discard(pending)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+_responder: Optional[SpeculativeResponder] = None
+
+
+def get_speculative_responder() -> Optional[SpeculativeResponder]:
+    """Responder condiviso se LLM_SPECULATION_ENABLED=true e ADMISSION_ENABLED=true"""
+    return _responder
+
+
+def init_speculative_responder() -> Optional[SpeculativeResponder]:
+    """Le speculazioni partono solo con capacità libera: senza admission control non c'è modo di
+    misurarla e il responder non viene creato"""
+    global _responder
+    if get_admission_controller() is None:
+        logger.warning("Risposte speculative non attivate: LLM_SPECULATION_ENABLED richiede ADMISSION_ENABLED=true")
+        return None
+    _responder = SpeculativeResponder(
+        max_per_turn=int(os.environ.get('SPECULATION_MAX_PER_TURN', '3')),
+        max_inflight=int(os.environ.get('SPECULATION_MAX_INFLIGHT', '4')),
+        session_token_budget=int(os.environ.get('SPECULATION_SESSION_TOKEN_BUDGET', '8000')),
+        global_tokens_per_minute=int(os.environ.get('SPECULATION_TOKENS_PER_MINUTE', '60000')),
+        idle_fraction=float(os.environ.get('SPECULATION_IDLE_FRACTION', '0.5')),
+        ttl=float(os.environ.get('SPECULATION_TTL_SECONDS', '600'))
+    )
+    memory.register("speculation", _responder)
+    logger.info("Risposte speculative attive: %d domande per turno, %d chiamate contemporanee",
+                _responder.max_per_turn, _responder.max_inflight)
+    return _responder
+
+
+async def shutdown_speculative_responder():
+    global _responder
+    if _responder:
+        await _responder.close()
+        memory.unregister("speculation")
+        _responder = None
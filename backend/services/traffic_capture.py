@@ -0,0 +1,295 @@
+import os
+import re
+import gzip
+import hmac
+import json
+import time
+import queue
+import hashlib
+import logging
+import threading
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_FORMAT = "medagent-traffic"
+CAPTURE_VERSION = 1
+
+# Chiamate LLM della richiesta in cattura: la lista è condivisa anche dai task dell'hedging
+llm_calls_var: ContextVar[Optional[list]] = ContextVar("llm_calls", default=None)
+
+_SESSION_PATH_RE = re.compile(r"^/api/chat/(session|profile|history|welcome|close|summary)/(?!batch$)([^/]+)$")
+_WORD_RE = re.compile(r"\w+")
+_GENDERS = {"m", "f", "maschio", "femmina", "uomo", "donna", "altro"}
+_SCRUBBED_PROFILE_FIELDS = ("sintomo_principale", "durata", "familiarita")
+_SCRUBBED_PROFILE_LISTS = ("sintomi_associati", "condizioni_note")
+
+
+def record_llm_call(tier: str, seconds: float):
+    """Annotata da LlmRouter per ogni chiamata; nessun costo se la richiesta non è in cattura"""
+    calls = llm_calls_var.get()
+    if calls is not None:
+        calls.append([tier, round(seconds, 4)])
+
+
+class TextScrubber:
+    """Toglie dal testo libero tutto ciò che non appartiene al vocabolario clinico noto.
+
+    Restano le parole che guidano il comportamento del backend (parole chiave di triage,
+    vocabolario FAQ, stopword), così il replay attraversa gli stessi percorsi: tier LLM,
+    red flag, risposte FAQ. Ogni altra parola diventa "x" della stessa lunghezza, ogni cifra "0":
+    nomi, luoghi e numeri di telefono non arrivano mai sul file.
+    """
+
+    def __init__(self, vocabulary: Set[str], prefixes: tuple = ()):
+        self.vocabulary = vocabulary
+        self.prefixes = prefixes
+
+    def _replace(self, match: re.Match) -> str:
+        word = match.group(0)
+        lower = word.lower()
+        if lower in self.vocabulary or (len(lower) > 3 and lower.startswith(self.prefixes)):
+            return word
+        if lower.isdigit():
+            return "0" * len(word)
+        return "x" * len(word)
+
+    def scrub(self, text: str) -> str:
+        return _WORD_RE.sub(self._replace, text)
+
+
+def default_scrubber() -> TextScrubber:
+    """Vocabolario da triage e contenuti FAQ"""
+    from services import triage
+    from services.knowledge_index import QUESTION_OPENERS, QUESTION_WORDS, STOPWORDS, get_faq_resolver
+
+    keywords = (
+        triage.RED_FLAG_KEYWORDS + triage.SYMPTOM_KEYWORDS + triage.HIGH_URGENCY_KEYWORDS
+        + triage.MEDIUM_URGENCY_KEYWORDS + triage.USER_MEDIUM_URGENCY_KEYWORDS
+        + [keyword for keyword, _ in triage.SUGGESTED_QUESTION_RULES]
+    )
+    # Le parole interrogative decidono le risposte FAQ dirette: il replay deve conservarle
+    vocabulary = set(STOPWORDS) | QUESTION_WORDS | QUESTION_OPENERS | {"perché"}
+    prefixes = set()
+    for keyword in keywords:
+        words = _WORD_RE.findall(keyword.lower())
+        vocabulary.update(words)
+        # Parole chiave troncate ("svenut", "sintom") valgono come prefisso
+        if len(words) == 1:
+            prefixes.add(words[0])
+
+    resolver = get_faq_resolver()
+    if resolver:
+        for entry in resolver.index.entries:
+            for text in entry.questions + entry.keywords:
+                vocabulary.update(_WORD_RE.findall(text.lower()))
+    return TextScrubber(vocabulary, tuple(sorted(prefixes)))
+
+
+def sanitize_profile(body: Dict, scrubber: TextScrubber) -> Dict:
+    """Forma del profilo senza dati identificativi: età per decade, testo libero ripulito"""
+    sanitized = {}
+    eta = body.get("eta")
+    if eta:
+        digits = re.match(r"\s*(\d{1,3})", str(eta))
+        # Centro della decade: il replay invia un'età plausibile con la stessa fascia
+        sanitized["eta"] = str(int(digits.group(1)) // 10 * 10 + 5) if digits else scrubber.scrub(str(eta))
+    genere = body.get("genere")
+    if genere:
+        sanitized["genere"] = genere if str(genere).lower() in _GENDERS else "altro"
+    for field in _SCRUBBED_PROFILE_FIELDS:
+        if body.get(field):
+            sanitized[field] = scrubber.scrub(str(body[field]))
+    for field in _SCRUBBED_PROFILE_LISTS:
+        if isinstance(body.get(field), list):
+            sanitized[field] = [scrubber.scrub(str(item)) for item in body[field]]
+    if isinstance(body.get("intensita"), list):
+        sanitized["intensita"] = [value for value in body["intensita"] if isinstance(value, int)]
+    return sanitized
+
+
+class TrafficRecorder:
+    """Scrive su file (NDJSON gzip) le richieste /api/chat/* ripulite, con tempi di risposta e dell'LLM.
+
+    Gli ID di sessione diventano pseudonimi HMAC con un sale casuale mai scritto su disco:
+    le richieste della stessa sessione restano collegate, ma non riconducibili alla sessione reale.
+    Il campionamento è per sessione, quindi una sessione è registrata tutta o per niente.
+    """
+
+    def __init__(self, path: str, sample_rate: float = 1.0, scrubber: Optional[TextScrubber] = None):
+        self.path = path
+        self.sample_rate = sample_rate
+        self._scrubber = scrubber
+        self._salt = os.urandom(16)
+        self._started = time.monotonic()
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self.recorded = 0
+
+    @property
+    def scrubber(self) -> TextScrubber:
+        if self._scrubber is None:
+            self._scrubber = default_scrubber()
+        return self._scrubber
+
+    def pseudonym(self, session_id: str) -> str:
+        return hmac.new(self._salt, session_id.encode(), hashlib.sha256).hexdigest()[:12]
+
+    def sampled(self, pseudonym: str) -> bool:
+        return self.sample_rate >= 1.0 or int(pseudonym[:8], 16) / 0xFFFFFFFF < self.sample_rate
+
+    def start(self):
+        self._started = time.monotonic()
+        self._thread = threading.Thread(target=self._write_loop, name="traffic-capture", daemon=True)
+        self._thread.start()
+        logger.info("Cattura traffico attiva su %s (campionamento %.2f)", self.path, self.sample_rate)
+
+    def stop(self):
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join(timeout=10)
+            self._thread = None
+            logger.info("Cattura traffico chiusa: %s richieste registrate", self.recorded)
+
+    def _write_loop(self):
+        # Un flush per lotto di righe disponibili: il file resta leggibile anche se il processo muore
+        with gzip.open(self.path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps({
+                "format": CAPTURE_FORMAT, "version": CAPTURE_VERSION,
+                "started_at": datetime.utcnow().isoformat(), "sample_rate": self.sample_rate
+            }) + "\n")
+            while True:
+                event = self._queue.get()
+                while event is not None:
+                    f.write(json.dumps(event, separators=(",", ":"), ensure_ascii=False) + "\n")
+                    try:
+                        event = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if event is None:
+                    return
+                f.flush()
+
+    def sanitize_body(self, template: str, body: bytes) -> Optional[Dict]:
+        if not body:
+            return None
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None
+        if not isinstance(data, dict):
+            return None
+        if template == "/api/chat/message":
+            return {"message": self.scrubber.scrub(str(data.get("message", "")))}
+        if template.startswith("/api/chat/profile/"):
+            return sanitize_profile(data, self.scrubber)
+        return None
+
+    def record(self, method: str, template: str, pseudonym: Optional[str], body: Optional[Dict],
+               status: int, started: float, duration: float, llm_calls: List):
+        event = {
+            "t": round(started - self._started, 4),
+            "s": pseudonym,
+            "m": method,
+            "p": template,
+            "st": status,
+            "d": round(duration, 4)
+        }
+        if body:
+            event["b"] = body
+        if llm_calls:
+            event["llm"] = llm_calls
+        self.recorded += 1
+        self._queue.put(event)
+
+
+def route_template(path: str) -> tuple:
+    """Percorso con l'ID di sessione sostituito dal segnaposto, e l'ID stesso"""
+    match = _SESSION_PATH_RE.match(path)
+    if match:
+        return f"/api/chat/{match.group(1)}/{{session_id}}", match.group(2)
+    return path, None
+
+
+class TrafficCaptureMiddleware:
+    """Middleware ASGI: registra solo le richieste HTTP /api/chat/* (il WebSocket non è catturato)"""
+
+    def __init__(self, app, recorder: TrafficRecorder, max_body_bytes: int = 65536):
+        self.app = app
+        self.recorder = recorder
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/api/chat/"):
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        template, session_id = route_template(scope["path"])
+        creates_session = method == "POST" and template == "/api/chat/session"
+        request_body = bytearray()
+        response_body = bytearray()
+        status = 500
+
+        async def capture_receive():
+            message = await receive()
+            if message["type"] == "http.request" and len(request_body) < self.max_body_bytes:
+                request_body.extend(message.get("body", b""))
+            return message
+
+        async def capture_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body" and creates_session:
+                response_body.extend(message.get("body", b""))
+            await send(message)
+
+        llm_calls: list = []
+        token = llm_calls_var.set(llm_calls)
+        started = time.monotonic()
+        try:
+            await self.app(scope, capture_receive, capture_send)
+        finally:
+            duration = time.monotonic() - started
+            llm_calls_var.reset(token)
+            try:
+                self._record(method, template, session_id, creates_session, bytes(request_body),
+                             bytes(response_body), status, started, duration, llm_calls)
+            except Exception as e:
+                logger.error("Errore cattura traffico: %s", e)
+
+    def _record(self, method, template, session_id, creates_session, request_body, response_body,
+                status, started, duration, llm_calls):
+        if creates_session and response_body:
+            session_id = json.loads(response_body).get("session_id")
+        elif template == "/api/chat/message" and request_body:
+            data = json.loads(request_body)
+            session_id = data.get("session_id") if isinstance(data, dict) else None
+
+        pseudonym = self.recorder.pseudonym(session_id) if session_id else None
+        if pseudonym and not self.recorder.sampled(pseudonym):
+            return
+        body = self.recorder.sanitize_body(template, request_body)
+        self.recorder.record(method, template, pseudonym, body, status, started, duration, llm_calls)
+
+
+_recorder: Optional[TrafficRecorder] = None
+
+
+def get_traffic_recorder() -> Optional[TrafficRecorder]:
+    """Recorder del processo se TRAFFIC_CAPTURE_ENABLED=true; il file va in TRAFFIC_CAPTURE_PATH"""
+    global _recorder
+    if _recorder is None and os.environ.get('TRAFFIC_CAPTURE_ENABLED', 'false').lower() == 'true':
+        path = os.environ.get('TRAFFIC_CAPTURE_PATH') or f"traffic-{os.getpid()}-{int(time.time())}.ndjson.gz"
+        _recorder = TrafficRecorder(path, sample_rate=float(os.environ.get('TRAFFIC_CAPTURE_SAMPLE_RATE', '1.0')))
+    return _recorder
+
+
+def shutdown_traffic_recorder():
+    global _recorder
+    if _recorder:
+        _recorder.stop()
+        _recorder = None
@@ -0,0 +1,78 @@
+import re
+from typing import List
+
+# Sintomi per cui il system prompt impone di raccomandare subito il 118
+RED_FLAG_KEYWORDS = [
+    "dolore toracico", "dolore al petto", "non riesco a respirare", "difficoltà respiratorie",
+    "fiato corto", "perdita di coscienza", "perdita coscienza", "svenut", "convulsion",
+    "sanguinamento", "emorragia", "trauma cranico", "colpo alla testa", "paralisi",
+    "parola confusa", "debolezza facciale", "bocca storta", "ictus", "infarto",
+    "suicid", "overdose"
+]
+
+# Parole che indicano un messaggio di contenuto clinico e non di semplice conversazione
+SYMPTOM_KEYWORDS = [
+    "dolore", "male", "febbre", "tosse", "nausea", "vomito", "diarrea", "vertigini",
+    "sangue", "gonfi", "bruciore", "prurito", "sintom", "farmac", "pressione",
+    "respir", "stanchezza", "mal di"
+]
+
+# Regole di urgenza applicate da AIService._analyze_response (risposta del modello e messaggio utente)
+HIGH_URGENCY_KEYWORDS = [
+    "118", "emergenza", "pronto soccorso", "immediatamente", "urgente",
+    "dolore toracico", "difficoltà respiratorie", "perdita coscienza"
+]
+
+MEDIUM_URGENCY_KEYWORDS = [
+    "medico", "contatta", "febbre alta", "persistente", "preoccupante",
+    "valutazione", "controllo medico"
+]
+
+USER_MEDIUM_URGENCY_KEYWORDS = ["dolore", "febbre", "male"]
+
+# Domande suggerite per parola chiave nel messaggio utente, nell'ordine in cui vengono proposte
+SUGGESTED_QUESTION_RULES = [
+    ("febbre", [
+        "Hai misurato la temperatura di recente?",
+        "Hai brividi o sudorazione?",
+        "Hai preso farmaci per la febbre?"
+    ]),
+    ("dolore", [
+        "Puoi descrivere meglio il tipo di dolore?",
+        "Il dolore è costante o va e viene?",
+        "Cosa peggiora o migliora il dolore?"
+    ]),
+    ("mal di testa", [
+        "Hai sensibilità alla luce?",
+        "Il mal di testa è accompagnato da nausea?",
+        "Dove è localizzato il dolore?"
+    ]),
+    ("tosse", [
+        "La tosse è secca o con catarro?",
+        "Hai difficoltà a respirare?",
+        "Da quanto tempo hai la tosse?"
+    ])
+]
+
+GENERIC_QUESTIONS = [
+    "Puoi descrivere altri sintomi?",
+    "Come ti senti in generale?",
+    "C'è qualcos'altro che ti preoccupa?"
+]
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def detect_red_flags(text: str) -> List[str]:
+    """Restituisce le parole chiave di emergenza presenti nel testo"""
+    text_lower = text.lower()
+    return [keyword for keyword in RED_FLAG_KEYWORDS if keyword in text_lower]
+
+
+def mentions_symptoms(text: str) -> bool:
+    text_lower = text.lower()
+    return any(keyword in text_lower for keyword in SYMPTOM_KEYWORDS)
+
+
+def word_count(text: str) -> int:
+    return len(_WORD_RE.findall(text))
@@ -0,0 +1,206 @@
+import time
+import uuid
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import DuplicateKeyError
+
+from services.memory_budget import deep_sizeof, memory
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SessionLockBackend(ABC):
+    """Backend distribuito opzionale per serializzare i turni di una sessione tra più worker"""
+
+    # Intervallo a cui il coordinatore rinnova il lock mentre il turno è in corso
+    renew_interval: float
+
+    @abstractmethod
+    async def acquire(self, session_id: str) -> str:
+        """Attende il lock della sessione e restituisce il token del proprietario"""
+
+    @abstractmethod
+    async def renew(self, session_id: str, token: str) -> bool:
+        """Prolunga il lock; False se nel frattempo è passato a un altro worker"""
+
+    @abstractmethod
+    async def release(self, session_id: str, token: str):
+        """Rilascia il lock solo se è ancora di questo token"""
+
+
+class MongoLeaseLockBackend(SessionLockBackend):
+    """Lease su documenti Mongo: un documento per sessione con owner e scadenza"""
+
+    def __init__(self, db: AsyncIOMotorDatabase, lease_seconds: float = 60.0,
+                 poll_interval: float = 0.05, acquire_timeout: float = 120.0):
+        self.collection = db.session_leases
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.acquire_timeout = acquire_timeout
+        # Tre rinnovi per lease: un rinnovo perso non basta a far scadere il lock
+        self.renew_interval = lease_seconds / 3
+
+    async def ensure_indexes(self):
+        # Le lease scadute e mai rilasciate vengono rimosse dal TTL monitor
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def try_acquire(self, key: str, lease_seconds: Optional[float] = None) -> Optional[str]:
+        """Un solo tentativo: token se la lease è libera o scaduta, None se è di un altro worker"""
+        token = str(uuid.uuid4())
+        now = datetime.utcnow()
+        try:
+            await self.collection.find_one_and_update(
+                {"_id": key, "expires_at": {"$lt": now}},
+                {"$set": {"owner": token, "expires_at": now + timedelta(seconds=lease_seconds or self.lease_seconds)}},
+                upsert=True
+            )
+            return token
+        except DuplicateKeyError:
+            return None
+
+    async def acquire(self, session_id: str) -> str:
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            token = await self.try_acquire(session_id)
+            if token:
+                return token
+            # Lease ancora valida di un altro worker
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Lease della sessione {session_id} non ottenuta")
+            await asyncio.sleep(self.poll_interval)
+
+    async def renew(self, session_id: str, token: str, lease_seconds: Optional[float] = None) -> bool:
+        result = await self.collection.update_one(
+            {"_id": session_id, "owner": token},
+            {"$set": {"expires_at": datetime.utcnow() + timedelta(seconds=lease_seconds or self.lease_seconds)}}
+        )
+        return result.matched_count == 1
+
+    async def release(self, session_id: str, token: str):
+        await self.collection.delete_one({"_id": session_id, "owner": token})
+
+
+class TurnCoordinator:
+    """Ordina i turni della stessa sessione e unisce i messaggi identici già in corso in un'unica esecuzione"""
+
+    def __init__(self, backend: Optional[SessionLockBackend] = None):
+        self.backend = backend
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._lock_users: Dict[str, int] = {}
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+
+        self._lock_wait = metrics.histogram("turns.lock_wait_seconds")
+        self._coalesced = metrics.counter("turns.coalesced")
+        self._executed = metrics.counter("turns.executed")
+        metrics.gauge("turns.inflight", lambda: len(self._inflight))
+        metrics.gauge("turns.locked_sessions", lambda: len(self._locks))
+        memory.register("turn_coordinator", self)
+
+    def memory_usage(self) -> dict:
+        # Nessun budget: le voci esistono solo per i turni in corso, limitati dall'admission control
+        return {
+            "bytes": deep_sizeof((self._locks, self._lock_users, self._inflight)),
+            "entries": len(self._locks) + len(self._inflight),
+            "budget_bytes": None
+        }
+
+    @asynccontextmanager
+    async def session_lock(self, session_id: str):
+        """Lock in-process per sessione, seguito dalla lease distribuita se configurata"""
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = self._locks[session_id] = asyncio.Lock()
+        self._lock_users[session_id] = self._lock_users.get(session_id, 0) + 1
+
+        start = time.perf_counter()
+        token = None
+        renewer = None
+        try:
+            async with lock:
+                if self.backend:
+                    token = await self.backend.acquire(session_id)
+                    # Le risposte LLM lente non devono far scadere la lease a turno ancora in corso
+                    renewer = asyncio.create_task(self._renew_lease(session_id, token))
+                self._lock_wait.observe(time.perf_counter() - start)
+                try:
+                    yield
+                finally:
+                    if renewer:
+                        renewer.cancel()
+                    if token:
+                        await self.backend.release(session_id, token)
+        finally:
+            self._lock_users[session_id] -= 1
+            if not self._lock_users[session_id]:
+                del self._lock_users[session_id]
+                del self._locks[session_id]
+
+    async def _renew_lease(self, session_id: str, token: str):
+        while True:
+            await asyncio.sleep(self.backend.renew_interval)
+            try:
+                if not await self.backend.renew(session_id, token):
+                    logger.warning("Lease della sessione %s persa durante il turno", session_id)
+                    metrics.counter("turns.lease_lost").inc()
+                    return
+            except Exception as e:
+                # Si riprova al prossimo intervallo: la lease ha margine per due rinnovi mancati
+                logger.warning("Rinnovo lease della sessione %s fallito: %s", session_id, e)
+
+    async def run(self, session_id: str, message: str, turn: Callable[[], Awaitable[Any]]) -> Any:
+        """Esegue il turno in ordine rispetto agli altri della sessione.
+
+        Se un messaggio identico per la stessa sessione è già in corso, attende e condivide il suo risultato.
+        """
+        key = (session_id, " ".join(message.lower().split()))
+        existing = self._inflight.get(key)
+        if existing is not None:
+            self._coalesced.inc()
+            return await asyncio.shield(existing)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            async with self.session_lock(session_id):
+                result = await turn()
+            self._executed.inc()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Evita l'avviso "exception never retrieved" quando nessun duplicato era in attesa
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+
+_coordinator: Optional[TurnCoordinator] = None
+
+
+def get_turn_coordinator() -> TurnCoordinator:
+    global _coordinator
+    if _coordinator is None:
+        _coordinator = TurnCoordinator()
+    return _coordinator
+
+
+async def init_turn_coordinator(db: AsyncIOMotorDatabase, backend_name: str = "memory") -> TurnCoordinator:
+    """Configura il coordinatore; backend_name "mongo" aggiunge le lease distribuite"""
+    global _coordinator
+    backend = None
+    if backend_name == "mongo":
+        backend = MongoLeaseLockBackend(db)
+        await backend.ensure_indexes()
+    _coordinator = TurnCoordinator(backend)
+    logger.info("Coordinatore turni attivo con backend: %s", backend_name)
+    return _coordinator
@@ -0,0 +1,295 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+
+from services.memory_budget import deep_sizeof, memory
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+EVENT_TYPES = ("turn", "welcome", "profile", "close")
+
+# Codice Mongo per chiave duplicata: un lotto riprovato dopo un errore parziale
+_DUPLICATE_KEY = 11000
+
+
+class TurnEventLog:
+    """Log append-only di eventi immutabili per turno, letto dai consumatori a partire da un offset.
+
+    Le route chiamano emit(), che accoda in memoria senza attendere Mongo; un task in background
+    scrive a lotti nella collezione turn_events. L'offset è il _id dell'evento: ogni lotto riserva
+    un intervallo contiguo con un solo $inc su turn_event_counters, anche con più worker.
+    Ogni intervallo riservato e non ancora scritto ha una lease in turn_event_reservations, rinnovata
+    a ogni tentativo di scrittura: i lettori saltano un buco solo quando il suo writer l'ha abbandonato.
+    Per ora il solo lettore è l'endpoint admin; rollup analytics ed export leggono ancora
+    chat_sessions e messages, perché gli eventi non coprono creazione e abbandono delle sessioni.
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase, batch_size: int = 200, flush_interval: float = 0.5,
+                 max_buffer: int = 10000, gap_grace: float = 10.0, reservation_lease: float = 30.0):
+        self.events = db.turn_events
+        self.counters = db.turn_event_counters
+        self.reservations = db.turn_event_reservations
+        self.offsets = db.turn_event_offsets
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        # Buco senza riserva registrata (riserva appena fatta e non ancora annotata): atteso per gap_grace
+        self.gap_grace = gap_grace
+        # Più lunga del backoff tra due tentativi di scrittura, così un writer che riprova non la perde
+        self.reservation_lease = reservation_lease
+        # Primo -> ultimo offset degli intervalli riservati da questo processo e non ancora scritti
+        self._reservations: Dict[int, int] = {}
+        self._buffer: deque = deque()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        self._emitted = metrics.counter("turn_events.emitted")
+        self._written = metrics.counter("turn_events.written")
+        self._dropped = metrics.counter("turn_events.dropped")
+        self._errors = metrics.counter("turn_events.flush_errors")
+        metrics.gauge("turn_events.buffered", lambda: len(self._buffer))
+        memory.register("turn_events", self)
+
+    def memory_usage(self) -> dict:
+        # Limitato da max_buffer eventi
+        return {
+            "bytes": deep_sizeof(self._buffer),
+            "entries": len(self._buffer),
+            "budget_bytes": None
+        }
+
+    async def ensure_indexes(self):
+        await self.events.create_index([("session_id", 1), ("_id", 1)])
+        await self.events.create_index([("type", 1), ("_id", 1)])
+        # Le riserve abbandonate servono ai lettori solo finché il buco non è stato saltato
+        await self.reservations.create_index("expires_at", expireAfterSeconds=86400)
+
+    async def start(self):
+        await self.ensure_indexes()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            while self._buffer:
+                await self.flush()
+        except Exception as e:
+            logger.error("Eventi di turno non scritti allo spegnimento: %d (%s)", len(self._buffer), e)
+
+    def emit(self, event_type: str, session_id: str, data: Dict):
+        """Accoda un evento; con il buffer pieno (Mongo lento o giù) l'evento viene scartato e contato"""
+        if len(self._buffer) >= self.max_buffer:
+            self._dropped.inc()
+            return
+        self._buffer.append({"type": event_type, "session_id": session_id, "ts": datetime.utcnow(), "data": data})
+        self._emitted.inc()
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                while self._buffer:
+                    await self.flush()
+            except Exception as e:
+                self._errors.inc()
+                logger.error("Errore scrittura eventi di turno: %s", e)
+                await asyncio.sleep(min(5.0, self.flush_interval * 10))
+
+    async def _reserve(self, count: int) -> int:
+        """Primo offset di un intervallo contiguo di count offset"""
+        counter = await self.counters.find_one_and_update(
+            {"_id": "turn_events"},
+            {"$inc": {"seq": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        first = counter["seq"] - count + 1
+        last = counter["seq"]
+        await self.reservations.insert_one({"_id": first, "last": last, "expires_at": self._lease_expiry()})
+        self._reservations[first] = last
+        return first
+
+    def _lease_expiry(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=self.reservation_lease)
+
+    async def _renew_reservations(self):
+        """Il writer che riprova dopo un errore tiene vivi i propri intervalli"""
+        if self._reservations:
+            await self.reservations.update_many(
+                {"_id": {"$in": list(self._reservations)}},
+                {"$set": {"expires_at": self._lease_expiry()}}
+            )
+
+    async def _release_reservations(self, written_up_to: int):
+        done = [first for first, last in self._reservations.items() if last <= written_up_to]
+        if done:
+            await self.reservations.delete_many({"_id": {"$in": done}})
+            for first in done:
+                del self._reservations[first]
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            if not self._buffer:
+                return 0
+            batch = [self._buffer[i] for i in range(min(self.batch_size, len(self._buffer)))]
+            # Gli offset riservati restano sull'evento: un nuovo tentativo riscrive gli stessi _id
+            unassigned = [event for event in batch if "_id" not in event]
+            if unassigned:
+                first = await self._reserve(len(unassigned))
+                for offset, event in enumerate(unassigned, start=first):
+                    event["_id"] = offset
+            if len(unassigned) < len(batch):
+                await self._renew_reservations()
+            now = datetime.utcnow()
+            for event in batch:
+                event["written_at"] = now
+            try:
+                await self.events.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                if any(error["code"] != _DUPLICATE_KEY for error in e.details.get("writeErrors", [])):
+                    raise
+            for _ in batch:
+                self._buffer.popleft()
+            self._written.inc(len(batch))
+            await self._release_reservations(batch[-1]["_id"])
+            return len(batch)
+
+    async def read(self, after: int = 0, limit: int = 500, session_id: Optional[str] = None,
+                   event_type: Optional[str] = None) -> Tuple[List[Dict], int]:
+        """Eventi con offset > after, in ordine; restituisce anche l'offset da cui riprendere.
+
+        La lettura si ferma prima di un buco negli offset finché il lotto mancante ha una riserva
+        valida (writer ancora attivo, anche se sta riprovando), così un consumatore non salta eventi.
+        I filtri per sessione o tipo rendono gli offset non contigui e disattivano il controllo.
+        """
+        query: Dict = {"_id": {"$gt": after}}
+        if session_id:
+            query["session_id"] = session_id
+        if event_type:
+            query["type"] = event_type
+        contiguous = not session_id and not event_type
+
+        events = []
+        expected = after + 1
+        async for event in self.events.find(query).sort("_id", 1).limit(limit):
+            if contiguous and event["_id"] != expected and not await self._gap_abandoned(expected, event):
+                break
+            events.append(event)
+            expected = event["_id"] + 1
+        return events, events[-1]["_id"] if events else after
+
+    async def _gap_abandoned(self, first_missing: int, next_event: Dict) -> bool:
+        """True se gli offset da first_missing all'evento successivo non verranno più scritti"""
+        last_missing = next_event["_id"] - 1
+        now = datetime.utcnow()
+        covered = 0
+        async for reservation in self.reservations.find(
+            {"_id": {"$lte": last_missing}, "last": {"$gte": first_missing}}
+        ):
+            if reservation["expires_at"] > now:
+                return False
+            covered += min(reservation["last"], last_missing) - max(reservation["_id"], first_missing) + 1
+        if covered == last_missing - first_missing + 1:
+            return True
+        # Parte del buco senza riserva: $inc appena eseguito o riserva già rimossa dal TTL
+        return next_event["written_at"] <= now - timedelta(seconds=self.gap_grace)
+
+    async def latest_offset(self) -> int:
+        counter = await self.counters.find_one({"_id": "turn_events"})
+        return counter["seq"] if counter else 0
+
+    async def consumer_offsets(self) -> List[Dict]:
+        latest = await self.latest_offset()
+        consumers = []
+        async for state in self.offsets.find().sort("_id", 1):
+            consumers.append({
+                "consumer": state["_id"],
+                "offset": state["offset"],
+                "lag": max(0, latest - state["offset"]),
+                "updated_at": state.get("updated_at")
+            })
+        return consumers
+
+
+class TurnEventConsumer:
+    """Consumatore con offset salvato su Mongo: dopo un riavvio riprende dall'ultimo commit"""
+
+    def __init__(self, log: TurnEventLog, name: str):
+        self.log = log
+        self.name = name
+
+    async def offset(self) -> int:
+        state = await self.log.offsets.find_one({"_id": self.name})
+        return state["offset"] if state else 0
+
+    async def poll(self, limit: int = 500) -> Tuple[List[Dict], int]:
+        return await self.log.read(after=await self.offset(), limit=limit)
+
+    async def commit(self, offset: int):
+        # $max: un commit in ritardo non riporta indietro l'offset
+        await self.log.offsets.update_one(
+            {"_id": self.name},
+            {"$max": {"offset": offset}, "$set": {"updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+    async def run_once(self, handler, limit: int = 500) -> int:
+        """Passa al handler il prossimo lotto di eventi e fa commit solo se il handler termina senza errori"""
+        start = time.perf_counter()
+        events, next_offset = await self.poll(limit)
+        if events:
+            await handler(events)
+            await self.commit(next_offset)
+        metrics.histogram(f"turn_events.consumer.{self.name}.batch_seconds").observe(time.perf_counter() - start)
+        return len(events)
+
+
+_log: Optional[TurnEventLog] = None
+
+
+def get_turn_event_log() -> Optional[TurnEventLog]:
+    return _log
+
+
+def emit_turn_event(event_type: str, session_id: str, data: Dict):
+    """Nessun effetto se il log degli eventi è disattivato"""
+    if _log:
+        _log.emit(event_type, session_id, data)
+
+
+async def init_turn_event_log(db: AsyncIOMotorDatabase, batch_size: int = 200, flush_interval: float = 0.5,
+                              max_buffer: int = 10000) -> TurnEventLog:
+    global _log
+    log = TurnEventLog(db, batch_size=batch_size, flush_interval=flush_interval, max_buffer=max_buffer)
+    await log.start()
+    _log = log
+    logger.info("Log eventi di turno attivo")
+    return log
+
+
+async def shutdown_turn_event_log():
+    global _log
+    if _log:
+        await _log.stop()
+        memory.unregister("turn_events")
+        _log = None
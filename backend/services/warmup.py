@@ -0,0 +1,99 @@
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from services.metrics import metrics
+from services.session_service import SessionService
+from services.knowledge_index import get_faq_resolver
+from services.ai_service import get_ai_service
+from services.health import get_health_prober
+
+logger = logging.getLogger(__name__)
+
+
+async def _open_pool(db: AsyncIOMotorDatabase, min_pool_size: int):
+    # Ping concorrenti: ognuno occupa una connessione diversa, quindi il pool arriva a min_pool_size
+    await asyncio.gather(*(db.command("ping") for _ in range(max(1, min_pool_size))))
+
+
+async def _warm_ai_client():
+    # Il GEMINI_API_KEY mancante fa fallire questo passo ma non blocca la readiness
+    await get_ai_service().warm_up()
+
+
+async def _warm_faq_index():
+    resolver = get_faq_resolver()
+    if resolver:
+        # L'indice viene costruito da get_faq_resolver; una ricerca di prova esercita anche il tokenizer
+        resolver.index.search("mal di testa")
+
+
+class WarmUp:
+    """Passi di riscaldamento eseguiti dopo l'avvio; la readiness resta negativa finché non finiscono.
+
+    Un passo che fallisce viene registrato e saltato: un warm-up parziale non deve impedire
+    per sempre al pod di ricevere traffico (il database non raggiungibile è già coperto dalla probe).
+    """
+
+    def __init__(self, steps: Dict[str, Callable[[], Awaitable[None]]]):
+        self.steps = steps
+        self.duration: Optional[float] = None
+        self.step_seconds: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        metrics.gauge("warmup.duration_seconds", lambda: self.duration)
+
+    async def run(self) -> float:
+        start = time.perf_counter()
+        for name, step in self.steps.items():
+            step_start = time.perf_counter()
+            try:
+                await step()
+            except Exception as e:
+                metrics.counter("warmup.errors").inc()
+                logger.error("Errore warm-up %s: %s", name, e)
+            self.step_seconds[name] = time.perf_counter() - step_start
+            metrics.histogram(f"warmup.step_seconds.{name}").observe(self.step_seconds[name])
+
+        self.duration = time.perf_counter() - start
+        prober = get_health_prober()
+        if prober:
+            prober.mark_warmed_up(self.duration)
+        logger.info("Warm-up completato in %.0f ms", self.duration * 1000)
+        return self.duration
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+
+_warmup: Optional[WarmUp] = None
+
+
+def start_warmup(db: AsyncIOMotorDatabase, min_pool_size: int) -> WarmUp:
+    """Avvia il warm-up in background: /health/live risponde subito, /health/ready dopo il warm-up"""
+    global _warmup
+    _warmup = WarmUp({
+        "mongo_pool": lambda: _open_pool(db, min_pool_size),
+        "indexes": lambda: SessionService(db).ensure_indexes(),
+        "ai_client": _warm_ai_client,
+        "faq_index": _warm_faq_index
+    })
+    _warmup.start()
+    return _warmup
+
+
+async def shutdown_warmup():
+    global _warmup
+    if _warmup:
+        await _warmup.stop()
+        _warmup = None
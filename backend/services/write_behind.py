@@ -0,0 +1,356 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import asyncio
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+from services.memory_budget import deep_sizeof, memory
+from services.metrics import metrics
+from services.session_sweeper import reactivation
+
+logger = logging.getLogger(__name__)
+
+# Oltre questa dimensione il journal viene troncato appena tutte le voci sono state scritte su Mongo
+JOURNAL_COMPACT_BYTES = 16 * 1024 * 1024
+
+# Journal disponibili per host: ogni processo (worker uvicorn) ne usa uno in esclusiva
+MAX_JOURNAL_SLOTS = 64
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"Tipo non serializzabile: {type(value)}")
+
+
+def _decode(obj: Dict):
+    if len(obj) == 1 and "$date" in obj:
+        return datetime.fromisoformat(obj["$date"])
+    return obj
+
+
+class WriteBehindJournal:
+    """Journal append-only con fsync: ogni riga è una voce JSON con numero di sequenza crescente.
+
+    Il file è bloccato in esclusiva (flock) finché il processo è vivo. writer_id identifica il journal
+    su Mongo: le sequenze sono confrontabili solo tra voci dello stesso journal.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.checkpoint_path = f"{path}.checkpoint"
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(f"{path}.lock", "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            raise
+        self.writer_id = self._read_writer_id()
+        self.flushed_seq = self._read_checkpoint()
+        self.last_seq = max(self.flushed_seq, self._scan_last_seq())
+        self._file = open(path, "ab")
+
+    def _read_writer_id(self) -> str:
+        writer_path = f"{self.path}.writer"
+        try:
+            with open(writer_path) as f:
+                writer_id = f.read().strip()
+            if writer_id:
+                return writer_id
+        except FileNotFoundError:
+            pass
+        writer_id = uuid.uuid4().hex
+        with open(writer_path, "w") as f:
+            f.write(writer_id)
+            f.flush()
+            os.fsync(f.fileno())
+        return writer_id
+
+    def _read_checkpoint(self) -> int:
+        try:
+            with open(self.checkpoint_path) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _scan_last_seq(self) -> int:
+        last_seq = 0
+        for entry in self._iter_entries():
+            last_seq = max(last_seq, entry["seq"])
+        return last_seq
+
+    def _iter_entries(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    yield json.loads(line, object_hook=_decode)
+                except ValueError:
+                    # Riga troncata da un crash durante la scrittura: viene ignorata
+                    logger.warning("Voce del journal non leggibile ignorata")
+
+    def append(self, entry: Dict) -> int:
+        with self._lock:
+            self.last_seq += 1
+            entry["seq"] = self.last_seq
+            self._file.write(json.dumps(entry, default=_encode).encode() + b"\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            return self.last_seq
+
+    def read_unflushed(self) -> List[Dict]:
+        return [entry for entry in self._iter_entries() if entry["seq"] > self.flushed_seq]
+
+    def mark_flushed(self, seq: int):
+        with self._lock:
+            if seq <= self.flushed_seq:
+                return
+            tmp_path = f"{self.checkpoint_path}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(str(seq))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.checkpoint_path)
+            self.flushed_seq = seq
+
+            if self.flushed_seq == self.last_seq and self._file.tell() > JOURNAL_COMPACT_BYTES:
+                self._file.truncate(0)
+                self._file.seek(0)
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._lock_file.close()
+
+
+def open_journal(path: str, max_slots: int = MAX_JOURNAL_SLOTS) -> WriteBehindJournal:
+    """Primo journal libero tra path, path.1, path.2, ...: un file per processo.
+
+    Un worker riavviato riprende uno slot libero e riproduce le voci lasciate dal processo precedente.
+    """
+    for slot in range(max_slots):
+        try:
+            return WriteBehindJournal(path if slot == 0 else f"{path}.{slot}")
+        except OSError:
+            continue
+    raise RuntimeError(f"Nessun journal write-behind libero ({max_slots} slot in uso per {path})")
+
+
+class WriteBehindQueue:
+    """Coda write-behind: i messaggi vengono resi durevoli nel journal locale e scritti su Mongo a lotti"""
+
+    def __init__(self, db: AsyncIOMotorDatabase, journal: WriteBehindJournal,
+                 batch_size: int = 500, flush_interval: float = 0.05,
+                 flush_attempts: int = 3, retry_delay: float = 1.0):
+        self.db = db
+        self.journal = journal
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Tentativi di flush completo all'avvio e allo spegnimento, prima di rinunciare
+        self.flush_attempts = flush_attempts
+        self.retry_delay = retry_delay
+        self._pending = deque()
+        self._pending_by_session: Dict[str, List[Dict]] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+        self._flushed = metrics.counter("write_behind.flushed_entries")
+        self._flush_errors = metrics.counter("write_behind.flush_errors")
+        self._replayed = metrics.counter("write_behind.replayed_entries")
+        self._batch_sizes = metrics.histogram("write_behind.batch_size")
+        self._lag = metrics.histogram("write_behind.flush_lag_seconds")
+        metrics.gauge("write_behind.pending_entries", lambda: len(self._pending))
+        metrics.gauge("write_behind.oldest_pending_age_seconds", self.oldest_pending_age)
+        memory.register("write_behind", self)
+
+    def memory_usage(self) -> dict:
+        # Nessuno sfratto possibile: le voci in coda sono messaggi non ancora su Mongo
+        return {
+            "bytes": deep_sizeof((self._pending, self._pending_by_session)),
+            "entries": len(self._pending),
+            "budget_bytes": None
+        }
+
+    def oldest_pending_age(self) -> float:
+        if not self._pending:
+            return 0.0
+        return max(0.0, time.time() - self._pending[0]["enqueued_at"])
+
+    async def start(self):
+        """Riporta in coda le voci non ancora scritte su Mongo e avvia il flusher.
+
+        Se Mongo non è raggiungibile l'avvio prosegue: le voci restano in coda e nel journal
+        e il flusher in background continua a riprovare.
+        """
+        unflushed = self.journal.read_unflushed()
+        for entry in unflushed:
+            self._track(entry)
+        if unflushed:
+            self._replayed.inc(len(unflushed))
+            logger.info("Write-behind: %d voci da riprodurre dal journal", len(unflushed))
+            if not await self._flush_with_retries():
+                logger.error("Write-behind: riproduzione del journal rimandata, %d voci ancora in coda",
+                             len(self._pending))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            if not await self._flush_with_retries():
+                # Il checkpoint non avanza: le voci verranno riprodotte dal journal al prossimo avvio
+                logger.error("Write-behind: %d voci non scritte allo spegnimento, restano nel journal",
+                             len(self._pending))
+        finally:
+            self.journal.close()
+
+    async def enqueue_message(self, message_dict: Dict):
+        """Rende durevole un messaggio nel journal; la scrittura su Mongo avviene in background"""
+        entry = {
+            "op": "message",
+            "session_id": message_dict["session_id"],
+            "doc": message_dict,
+            "enqueued_at": time.time()
+        }
+        await asyncio.to_thread(self.journal.append, entry)
+        self._track(entry)
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def _track(self, entry: Dict):
+        self._pending.append(entry)
+        self._pending_by_session.setdefault(entry["session_id"], []).append(entry)
+
+    def pending_messages(self, session_id: str) -> List[Dict]:
+        """Messaggi accettati ma non ancora visibili su Mongo, per garantire read-your-writes"""
+        return [entry["doc"] for entry in self._pending_by_session.get(session_id, [])]
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                self._flush_errors.inc()
+                logger.error("Errore flush write-behind: %s", e)
+                await asyncio.sleep(min(5.0, self.flush_interval * 20))
+
+    async def flush_all(self):
+        while self._pending:
+            await self.flush()
+
+    async def _flush_with_retries(self) -> bool:
+        """flush_all con un numero limitato di tentativi; False se restano voci in coda"""
+        for attempt in range(1, self.flush_attempts + 1):
+            try:
+                await self.flush_all()
+                return True
+            except Exception as e:
+                self._flush_errors.inc()
+                logger.warning("Flush write-behind fallito (tentativo %d/%d): %s", attempt, self.flush_attempts, e)
+                if attempt < self.flush_attempts:
+                    await asyncio.sleep(self.retry_delay * attempt)
+        return False
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            batch = [self._pending[i] for i in range(min(self.batch_size, len(self._pending)))]
+
+            with metrics.timer("write_behind.flush_duration_seconds"):
+                # Upsert per id: la riproduzione dopo un crash non duplica i messaggi
+                message_ops = [
+                    UpdateOne({"id": entry["doc"]["id"]}, {"$setOnInsert": entry["doc"]}, upsert=True)
+                    for entry in batch
+                ]
+                await self.db.messages.bulk_write(message_ops, ordered=False)
+
+                # Aggiornamento contatori per sessione. L'ultima sequenza applicata è salvata per journal
+                # (wb_applied.<writer_id>): un lotto riprodotto non conta due volte, quelli di altri worker sì
+                per_session: Dict[str, Dict] = {}
+                for entry in batch:
+                    stats = per_session.setdefault(entry["session_id"], {"count": 0, "seq": 0, "updated_at": None})
+                    stats["count"] += 1
+                    stats["seq"] = max(stats["seq"], entry["seq"])
+                    stats["updated_at"] = entry["doc"]["timestamp"]
+                applied_key = f"wb_applied.{self.journal.writer_id}"
+                session_ops = [
+                    UpdateOne(
+                        {"session_id": session_id, applied_key: {"$not": {"$gte": stats["seq"]}}},
+                        {
+                            "$inc": {"message_count": stats["count"]},
+                            "$set": {"updated_at": stats["updated_at"], applied_key: stats["seq"]}
+                        }
+                    )
+                    for session_id, stats in per_session.items()
+                ]
+                session_ops.extend(reactivation(session_id) for session_id in per_session)
+                await self.db.chat_sessions.bulk_write(session_ops, ordered=False)
+
+            await asyncio.to_thread(self.journal.mark_flushed, batch[-1]["seq"])
+
+            now = time.time()
+            for entry in batch:
+                self._pending.popleft()
+                self._lag.observe(now - entry["enqueued_at"])
+                session_entries = self._pending_by_session.get(entry["session_id"])
+                if session_entries:
+                    session_entries.remove(entry)
+                    if not session_entries:
+                        del self._pending_by_session[entry["session_id"]]
+
+            self._flushed.inc(len(batch))
+            self._batch_sizes.observe(len(batch))
+            return len(batch)
+
+
+_write_behind: Optional[WriteBehindQueue] = None
+
+
+def get_write_behind() -> Optional[WriteBehindQueue]:
+    """Restituisce la coda write-behind se la modalità è attiva"""
+    return _write_behind
+
+
+async def init_write_behind(db: AsyncIOMotorDatabase, journal_path: str,
+                            batch_size: int = 500, flush_interval: float = 0.05) -> WriteBehindQueue:
+    global _write_behind
+    journal = open_journal(journal_path)
+    queue = WriteBehindQueue(db, journal, batch_size=batch_size, flush_interval=flush_interval)
+    await queue.start()
+    _write_behind = queue
+    logger.info("Write-behind attivo, journal: %s", journal.path)
+    return queue
+
+
+async def shutdown_write_behind():
+    global _write_behind
+    if _write_behind:
+        await _write_behind.stop()
+        memory.unregister("write_behind")
+        _write_behind = None
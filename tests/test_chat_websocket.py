@@ -0,0 +1,87 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "medagent_test")
+
+import server  # noqa: E402
+from routes.chat_routes import HISTORY_WINDOW, get_ai_service  # noqa: E402
+
+
+class _RecordingAIService:
+    """Risposta fissa; registra la storia ricevuta ad ogni turno"""
+
+    def __init__(self):
+        self.histories = []
+
+    async def generate_response(self, session_id, user_message, user_profile=None, conversation_history=None):
+        self.histories.append([msg.content for msg in conversation_history or []])
+        return f"Risposta a: {user_message}", "low", []
+
+
+@pytest.fixture
+def client(db, monkeypatch):
+    monkeypatch.setattr(server, "db", db)
+    service = _RecordingAIService()
+    server.app.dependency_overrides[get_ai_service] = lambda: service
+    with_client = TestClient(server.app)
+    with_client.service = service
+    yield with_client
+    server.app.dependency_overrides.pop(get_ai_service, None)
+
+
+def _long_session(client, db, count: int) -> str:
+    session_id = client.post("/api/chat/session", json={}).json()["session_id"]
+    base = datetime.utcnow() - timedelta(hours=1)
+    asyncio.run(db.messages.insert_many([
+        {"id": f"m{i}", "session_id": session_id, "message_type": "user" if i % 2 == 0 else "assistant",
+         "content": f"messaggio {i}", "timestamp": base + timedelta(seconds=i), "next_questions": [], "metadata": {}}
+        for i in range(count)
+    ]))
+    return session_id
+
+
+def test_websocket_acks_user_message_before_reply(client):
+    session_id = client.post("/api/chat/session", json={}).json()["session_id"]
+    with client.websocket_connect(f"/api/chat/ws/{session_id}") as ws:
+        assert ws.receive_json()["type"] == "context"
+        ws.send_json({"type": "message", "message": "Ho mal di testa"})
+        user_frame, assistant_frame = ws.receive_json(), ws.receive_json()
+    assert user_frame["type"] == "user_message"
+    assert user_frame["message"]["content"] == "Ho mal di testa"
+    assert assistant_frame["type"] == "assistant_message"
+    assert assistant_frame["message"]["content"] == "Risposta a: Ho mal di testa"
+
+
+def test_websocket_and_http_send_the_most_recent_history(client, db):
+    session_id = _long_session(client, db, 30)
+    expected = [f"messaggio {i}" for i in range(30 - HISTORY_WINDOW, 30)]
+
+    with client.websocket_connect(f"/api/chat/ws/{session_id}") as ws:
+        ws.receive_json()
+        ws.send_json({"type": "message", "message": "Sono tornato"})
+        ws.receive_json()
+        ws.receive_json()
+    assert client.service.histories[0] == expected
+
+    other = _long_session(client, db, 30)
+    response = client.post("/api/chat/message", json={"session_id": other, "message": "Sono tornato"})
+    assert response.status_code == 200
+    assert client.service.histories[1] == expected
+
+
+def test_websocket_refresh_error_becomes_error_frame(client, monkeypatch):
+    session_id = client.post("/api/chat/session", json={}).json()["session_id"]
+    with client.websocket_connect(f"/api/chat/ws/{session_id}") as ws:
+        ws.receive_json()
+
+        async def unreachable(*args, **kwargs):
+            raise RuntimeError("mongo non raggiungibile")
+
+        monkeypatch.setattr("routes.chat_routes._load_connection_context", unreachable)
+        ws.send_json({"type": "refresh"})
+        assert ws.receive_json() == {"type": "error", "detail": "Errore interno del server"}
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from services.conversation_state import ConversationStore, window_start
+
+pytestmark = pytest.mark.anyio
+
+
+def test_window_starts_at_zero_until_full():
+    assert [window_start(total, 12, 4) for total in range(13)] == [0] * 13
+
+
+def test_window_slides_in_fixed_steps():
+    starts = [window_start(total, 12, 4) for total in range(13, 40)]
+    # Scatti di max_messages - keep_messages: il prefisso resta uguale tra uno scatto e l'altro
+    assert sorted(set(starts)) == [8, 16, 24, 32]
+    for total, start in zip(range(13, 40), starts):
+        assert start % 8 == 0
+        assert 4 <= total - start <= 12
+
+
+def test_window_never_moves_back():
+    starts = [window_start(total, 6, 2) for total in range(100)]
+    assert starts == sorted(starts)
+
+
+async def _messages(db, session_id: str, first: int, end: int):
+    base = datetime(2024, 1, 1)
+    await db.messages.insert_many([
+        {"id": f"{session_id}-{i}", "session_id": session_id, "message_type": "user" if i % 2 == 0 else "assistant",
+         "content": f"messaggio {i}", "timestamp": base + timedelta(seconds=i)}
+        for i in range(first, end)
+    ])
+
+
+async def test_rebuilt_transcript_matches_window(db):
+    await _messages(db, "s1", 0, 15)
+    store = ConversationStore(db, max_messages=12, keep_messages=4)
+
+    state = await store.prepare("s1", "nuovo messaggio", "")
+    assert state.start == window_start(15, 12, 4) == 8
+    assert [message["content"] for message in state.transcript] == [f"messaggio {i}" for i in range(8, 15)]
+    assert state.transcript[0]["role"] == "user"
+
+
+async def test_appended_state_matches_rebuild_from_another_worker(db):
+    await _messages(db, "s1", 0, 12)
+    store = ConversationStore(db, max_messages=12, keep_messages=4)
+    state = await store.prepare("s1", "messaggio 12", "")
+    store.append(state, "messaggio 12", "messaggio 13")
+    await _messages(db, "s1", 12, 14)
+    assert state.start == 8
+
+    # Un altro worker senza stato in memoria ricostruisce la stessa trascrizione
+    rebuilt = await ConversationStore(db, max_messages=12, keep_messages=4).prepare("s1", "messaggio 14", "")
+    assert rebuilt.start == state.start
+    assert rebuilt.transcript == state.transcript
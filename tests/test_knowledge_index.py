@@ -0,0 +1,48 @@
+import pytest
+
+from models.message import Message
+from models.user_profile import UserProfile
+from services.knowledge_index import DEFAULT_CONTENT_PATH, FaqResolver, KnowledgeIndex, is_question
+
+
+@pytest.fixture(scope="module")
+def resolver():
+    return FaqResolver(KnowledgeIndex.from_file(DEFAULT_CONTENT_PATH))
+
+
+def _direct(resolver, text, user_profile=None, conversation_history=None):
+    match = resolver.lookup(text)
+    return bool(match) and resolver.is_direct(match, text, user_profile, conversation_history)
+
+
+@pytest.mark.parametrize("text", ["ho la febbre", "tosse", "ho mal di testa", "non posso dormire"])
+def test_symptom_statements_are_not_answered_directly(resolver, text):
+    assert not _direct(resolver, text)
+
+
+@pytest.mark.parametrize("text", ["cosa fare per la febbre", "Come abbassare la febbre?", "ho vomitato cosa devo fare"])
+def test_faq_questions_are_answered_directly_on_first_turn(resolver, text):
+    assert _direct(resolver, text)
+
+
+def test_partial_coverage_of_faq_wording_is_only_grounded(resolver):
+    match = resolver.lookup("ho la febbre")
+    assert match.confidence == 1.0
+    assert match.coverage < resolver.direct_coverage
+
+
+def test_personal_context_disables_direct_answer(resolver):
+    text = "cosa fare per la febbre"
+    profile = UserProfile(session_id="s", sintomo_principale="febbre", durata="2 giorni")
+    earlier = Message(session_id="s", message_type="user", content="ciao")
+
+    assert not _direct(resolver, text, user_profile=profile)
+    assert not _direct(resolver, text, conversation_history=[earlier])
+    assert _direct(resolver, text, user_profile=UserProfile(session_id="s", genere="F"))
+
+
+def test_is_question():
+    assert is_question("febbre alta?")
+    assert is_question("Quando preoccuparsi per la tosse")
+    assert is_question("posso prendere il paracetamolo")
+    assert not is_question("ho la febbre da ieri")
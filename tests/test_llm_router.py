@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from benchmarks.fake_llm import FakeLlmChat
+from services.llm_router import CircuitOpenError, LlmRouter
+
+pytestmark = pytest.mark.anyio
+
+RED_FLAG_MESSAGE = "Ho un forte dolore al petto da stamattina"
+
+
+class _TrackingChat(FakeLlmChat):
+    """FakeLlmChat che registra se la chiamata è stata annullata"""
+
+    def __init__(self, latency: float, reply: str):
+        super().__init__(latency=latency, reply=reply)
+        self.cancelled = False
+
+    async def send_message(self, user_message) -> str:
+        try:
+            return await super().send_message(user_message)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+
+class _FailingChat:
+    async def send_message(self, user_message) -> str:
+        raise RuntimeError("provider non disponibile")
+
+
+def _factory(chat):
+    async def make_chat():
+        return chat
+    return make_chat
+
+
+def _router(**kwargs):
+    # Con hedge_min_samples altissimo si usa sempre hedge_default_delay, non il percentile globale
+    kwargs.setdefault("hedge_min_samples", 10 ** 9)
+    return LlmRouter(**kwargs)
+
+
+async def test_hedge_not_fired_before_delay():
+    router = _router(hedge_default_delay=0.2)
+    primary = _TrackingChat(latency=0.02, reply="primaria")
+    backup = _TrackingChat(latency=0.0, reply="backup")
+
+    response = await router.send(router.tiers["standard"], _factory(primary), "ciao", _factory(backup))
+
+    assert response == "primaria"
+    assert backup.calls == 0
+
+
+async def test_hedge_fires_after_delay_and_cancels_loser():
+    router = _router(hedge_default_delay=0.05)
+    primary = _TrackingChat(latency=1.0, reply="primaria")
+    backup = _TrackingChat(latency=0.01, reply="backup")
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    response = await router.send(router.tiers["standard"], _factory(primary), "ciao", _factory(backup))
+    elapsed = loop.time() - start
+    await asyncio.sleep(0)
+
+    assert response == "backup"
+    assert backup.calls == 1
+    assert 0.05 <= elapsed < 0.5
+    assert primary.cancelled
+
+
+async def test_breaker_opens_after_failures_and_half_opens_after_cooldown():
+    router = _router(hedging_enabled=False, breaker_threshold=3, breaker_cooldown=0.05)
+    tier = router.tiers["standard"]
+    breaker = router.breakers["standard"]
+
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            await router.send(tier, _factory(_FailingChat()), "ciao")
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        await router.send(tier, _factory(FakeLlmChat()), "ciao")
+
+    await asyncio.sleep(0.06)
+    assert breaker.state == "half_open"
+    await router.send(tier, _factory(FakeLlmChat()), "ciao")
+    assert breaker.state == "closed"
+
+
+async def test_select_tier_falls_back_when_breaker_open():
+    router = _router(hedging_enabled=False, breaker_threshold=1, breaker_cooldown=60.0)
+    assert router.select_tier(RED_FLAG_MESSAGE).name == "strong"
+
+    with pytest.raises(RuntimeError):
+        await router.send(router.tiers["strong"], _factory(_FailingChat()), "ciao")
+
+    assert router.select_tier(RED_FLAG_MESSAGE).name == "standard"
+    assert router.breaker_state == "degraded"
+
+
+async def test_select_tier_keeps_preferred_when_all_breakers_open():
+    router = _router(breaker_threshold=1, breaker_cooldown=60.0)
+    for breaker in router.breakers.values():
+        breaker.record_failure()
+
+    assert router.select_tier(RED_FLAG_MESSAGE).name == "strong"
+    assert router.breaker_state == "open"
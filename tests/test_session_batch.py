@@ -0,0 +1,102 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "medagent_test")
+
+import server  # noqa: E402
+from models.message import Message  # noqa: E402
+from routes.chat_routes import MAX_BATCH_SESSIONS  # noqa: E402
+from services.session_service import SessionService  # noqa: E402
+
+
+@pytest.fixture
+def client(db, monkeypatch):
+    monkeypatch.setattr(server, "db", db)
+    return TestClient(server.app)
+
+
+def _new_session(client, **profile) -> str:
+    session_id = client.post("/api/chat/session", json={}).json()["session_id"]
+    if profile:
+        assert client.post(f"/api/chat/profile/{session_id}", json=profile).status_code == 200
+    return session_id
+
+
+def test_sessions_batch_is_keyed_by_id_and_reports_missing(client):
+    first = _new_session(client, eta="30-40", sintomo_principale="tosse")
+    second = _new_session(client)
+
+    response = client.post("/api/chat/sessions/batch", json={"session_ids": [second, "assente", first, second]})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert set(body["sessions"]) == {first, second}
+    assert body["sessions"][first]["session"]["session_id"] == first
+    assert body["sessions"][first]["user_profile"]["sintomo_principale"] == "tosse"
+    assert body["sessions"][second]["user_profile"] is None
+    assert body["missing"] == ["assente"]
+
+
+def test_batch_endpoints_reject_too_many_sessions(client):
+    session_ids = [f"s{i}" for i in range(MAX_BATCH_SESSIONS + 1)]
+
+    for path in ("/api/chat/sessions/batch", "/api/chat/summary/batch"):
+        response = client.post(path, json={"session_ids": session_ids})
+        assert response.status_code == 422
+
+
+def test_batch_limit_counts_distinct_ids(client):
+    session_ids = ["s1"] * (MAX_BATCH_SESSIONS + 1)
+    response = client.post("/api/chat/sessions/batch", json={"session_ids": session_ids})
+    assert response.status_code == 200
+    assert response.json()["missing"] == ["s1"]
+
+
+def test_summary_batch_is_keyed_by_id(client, db, monkeypatch):
+    # mongomock non implementa $lookup con let/pipeline: la storia si legge con una find equivalente
+    async def histories(self, session_ids, limit):
+        result = {}
+        async for doc in self.messages_collection.find({"session_id": {"$in": session_ids}}).sort("timestamp", 1):
+            messages = result.setdefault(doc["session_id"], [])
+            if len(messages) < limit:
+                messages.append(Message(**doc))
+        return result
+
+    monkeypatch.setattr(SessionService, "_get_histories", histories)
+    session_id = _new_session(client, sintomo_principale="febbre")
+    base = datetime.utcnow() - timedelta(minutes=5)
+    asyncio.run(db.messages.insert_many([
+        {"id": "m1", "session_id": session_id, "message_type": "user", "content": "Ho la febbre",
+         "timestamp": base, "next_questions": [], "metadata": {}},
+        {"id": "m2", "session_id": session_id, "message_type": "assistant", "content": "Da quanto?",
+         "urgency_level": "medium", "timestamp": base + timedelta(seconds=1), "next_questions": [], "metadata": {}}
+    ]))
+
+    response = client.post("/api/chat/summary/batch", json={"session_ids": [session_id, "assente"]})
+
+    assert response.status_code == 200
+    body = response.json()
+    summary = body["summaries"][session_id]
+    assert summary["message_count"] == 2
+    assert summary["conversation_length"] == 1
+    assert summary["max_urgency_level"] == "medium"
+    assert body["missing"] == ["assente"]
+
+
+def test_histories_pipeline_limits_each_session_on_the_index(db):
+    pipeline = SessionService(db)._histories_pipeline(["s1", "s2"], limit=20)
+
+    assert pipeline[0] == {"$match": {"session_id": {"$in": ["s1", "s2"]}}}
+    lookup = pipeline[-1]["$lookup"]
+    assert lookup["from"] == "messages"
+    # Ordinamento e limite dentro il $lookup: mai l'intera storia della sessione in memoria
+    stages = [next(iter(stage)) for stage in lookup["pipeline"]]
+    assert stages == ["$match", "$sort", "$limit", "$project"]
+    assert lookup["pipeline"][1] == {"$sort": {"timestamp": 1}}
+    assert lookup["pipeline"][2] == {"$limit": 20}
+    assert "content" not in lookup["pipeline"][3]["$project"]
@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from models.message import MessageCreate
+from services.session_service import SessionService
+from services.session_sweeper import SessionSweeper
+
+pytestmark = pytest.mark.anyio
+
+
+async def _session(db, session_id: str, idle: timedelta):
+    updated_at = datetime.utcnow() - idle
+    await db.chat_sessions.insert_one({
+        "session_id": session_id, "status": "active", "message_count": 0,
+        "created_at": updated_at, "updated_at": updated_at
+    })
+
+
+async def test_sweep_abandons_only_idle_sessions(db):
+    await _session(db, "idle", timedelta(hours=2))
+    await _session(db, "recent", timedelta(minutes=5))
+    sweeper = SessionSweeper(db, idle_after=timedelta(hours=1))
+
+    assert await sweeper.sweep_batch(datetime.utcnow() - sweeper.idle_after) == 1
+    idle = await db.chat_sessions.find_one({"session_id": "idle"})
+    assert idle["status"] == "abandoned"
+    assert idle["end_time"] == idle["updated_at"]
+    assert "summary" not in idle
+    assert (await db.chat_sessions.find_one({"session_id": "recent"}))["status"] == "active"
+
+
+async def test_new_message_reactivates_abandoned_session(db):
+    await _session(db, "idle", timedelta(hours=2))
+    sweeper = SessionSweeper(db, idle_after=timedelta(hours=1))
+    await sweeper.sweep_batch(datetime.utcnow() - sweeper.idle_after)
+
+    await SessionService(db).save_message("idle", MessageCreate(content="Sono tornato", message_type="user"))
+    session = await db.chat_sessions.find_one({"session_id": "idle"})
+    assert session["status"] == "active"
+    assert "end_time" not in session
+    assert session["message_count"] == 1
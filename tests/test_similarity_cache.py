@@ -0,0 +1,47 @@
+from models.message import Message
+from models.user_profile import UserProfile
+from services.similarity_cache import SimilarityCache, is_profile_light
+
+QUESTION = "Quanto dura di solito un raffreddore comune"
+PARAPHRASE = "Di solito quanto dura un comune raffreddore"
+
+
+def _cache() -> SimilarityCache:
+    return SimilarityCache(capacity=64, threshold=0.7)
+
+
+def test_paraphrase_hits_same_entry():
+    cache = _cache()
+    assert cache.put(QUESTION, "Circa una settimana", "low", ["Che sintomi hai?"], now=1000.0)
+    cached = cache.get(PARAPHRASE, now=1001.0)
+    assert cached is not None and cached.response == "Circa una settimana"
+
+
+def test_numbers_and_negations_are_part_of_the_key():
+    cache = _cache()
+    cache.put("ho la febbre a 38 da ieri sera", "Risposta 38", "low", [], now=1000.0)
+    assert cache.get("ho la febbre a 40 da ieri sera", now=1001.0) is None
+    cache.put("ho mal di gola e tosse secca", "Risposta gola", "low", [], now=1000.0)
+    assert cache.get("non ho mal di gola e tosse secca", now=1001.0) is None
+
+
+def test_prompt_context_is_part_of_the_key():
+    # Stessa domanda dopo benvenuti diversi: la risposta di un utente non va servita all'altro
+    cache = _cache()
+    cache.put(QUESTION, "Risposta per la tosse", "low", [], now=1000.0, context="Assistente: sintomo tosse")
+    assert cache.get(QUESTION, now=1001.0, context="Assistente: sintomo cefalea") is None
+    assert cache.get(QUESTION, now=1001.0, context="Assistente: sintomo tosse").response == "Risposta per la tosse"
+
+
+def test_expired_entries_are_not_served():
+    cache = SimilarityCache(capacity=64, threshold=0.7, ttl=10.0)
+    cache.put(QUESTION, "Circa una settimana", "low", [], now=1000.0)
+    assert cache.get(QUESTION, now=1011.0) is None
+
+
+def test_profile_light_requires_first_turn_without_personal_fields():
+    welcome = Message(session_id="s", content="Ciao! Come ti senti?", message_type="assistant")
+    assert is_profile_light(UserProfile(session_id="s", genere="F"), [welcome])
+    assert not is_profile_light(UserProfile(session_id="s", sintomo_principale="tosse"), [welcome])
+    earlier = Message(session_id="s", content="Ho la tosse", message_type="user")
+    assert not is_profile_light(None, [welcome, earlier])
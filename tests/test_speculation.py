@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+from services import admission
+from services.metrics import metrics
+from services.speculation import (
+    SpeculativeResponder, get_speculative_responder, init_speculative_responder, shutdown_speculative_responder
+)
+
+pytestmark = pytest.mark.anyio
+
+QUESTIONS = ["Da quanto tempo hai la febbre?", "Hai anche mal di gola?", "Hai preso farmaci?"]
+
+
+class _FakeAIService:
+    """Ogni chiamata dichiara 100 token di input e 50 di output; release sblocca le risposte"""
+
+    def __init__(self):
+        self.calls = []
+        self.release = asyncio.Event()
+
+    async def generate_speculative_response(self, session_id, question, user_profile, history, usage):
+        self.calls.append(question)
+        usage["input_tokens"] = 100
+        await self.release.wait()
+        usage["output_tokens"] = 50
+        return f"Risposta a: {question}", "low", []
+
+
+async def _settle_callbacks():
+    # I done callback dei task girano nelle iterazioni successive del loop
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def _counters(*names):
+    return {name: metrics.counter(f"speculation.{name}").value for name in names}
+
+
+def _delta(before):
+    return {name: metrics.counter(f"speculation.{name}").value - value for name, value in before.items()}
+
+
+async def test_tap_is_served_and_other_speculations_are_wasted():
+    responder, service = SpeculativeResponder(), _FakeAIService()
+    before = _counters("hits", "tokens_served", "tokens_wasted", "tokens_generated")
+    responder.schedule(service, "s1", "m1", QUESTIONS, None, [])
+    await _settle_callbacks()
+    assert len(service.calls) == 3
+
+    service.release.set()
+    await _settle_callbacks()
+    reply = await responder.take("s1", "  hai anche MAL DI GOLA? ", "m1")
+    assert reply == ("Risposta a: Hai anche mal di gola?", "low", [])
+    await responder.close()
+    await _settle_callbacks()
+
+    delta = _delta(before)
+    assert delta["hits"] == 1
+    assert delta["tokens_generated"] == 450
+    # Ogni speculazione è contata una sola volta, come servita o sprecata
+    assert delta["tokens_served"] == 150
+    assert delta["tokens_wasted"] == 300
+    assert not responder.has_pending("s1")
+
+
+async def test_free_text_cancels_and_charges_prompt_tokens():
+    responder, service = SpeculativeResponder(), _FakeAIService()
+    before = _counters("misses", "tokens_served", "tokens_wasted")
+    responder.schedule(service, "s1", "m1", QUESTIONS, None, [])
+    await asyncio.sleep(0)
+
+    assert await responder.take("s1", "Ho anche la nausea", "m1") is None
+    await _settle_callbacks()
+
+    delta = _delta(before)
+    assert delta["misses"] == 1
+    # Chiamate annullate in attesa della risposta: pagato solo l'input
+    assert delta["tokens_wasted"] == 300
+    assert delta["tokens_served"] == 0
+    assert responder._inflight == 0
+    assert responder._spent["s1"] == 300
+
+
+async def test_tap_waits_for_call_in_flight():
+    responder, service = SpeculativeResponder(), _FakeAIService()
+    responder.schedule(service, "s1", "m1", QUESTIONS, None, [])
+
+    taken = asyncio.create_task(responder.take("s1", QUESTIONS[0], "m1"))
+    await asyncio.sleep(0)
+    assert not taken.done()
+    service.release.set()
+    assert (await taken)[0] == f"Risposta a: {QUESTIONS[0]}"
+    await responder.close()
+
+
+async def test_stale_base_message_is_not_served():
+    responder, service = SpeculativeResponder(), _FakeAIService()
+    service.release.set()
+    responder.schedule(service, "s1", "m1", QUESTIONS, None, [])
+    # Un altro messaggio è stato salvato dopo m1: la risposta anticipata non vale più
+    assert await responder.take("s1", QUESTIONS[0], "m2") is None
+    await responder.close()
+
+
+async def test_session_budget_stops_new_speculations():
+    responder, service = SpeculativeResponder(session_token_budget=300), _FakeAIService()
+    service.release.set()
+    before = metrics.counter("speculation.skipped.session_budget").value
+    responder.schedule(service, "s1", "m1", QUESTIONS, None, [])
+    await _settle_callbacks()
+    await responder.take("s1", QUESTIONS[0], "m1")
+    assert responder._spent["s1"] == 450
+
+    responder.schedule(service, "s1", "m2", QUESTIONS, None, [])
+    assert not responder.has_pending("s1")
+    assert len(service.calls) == 3
+    assert metrics.counter("speculation.skipped.session_budget").value == before + 1
+
+
+async def test_speculation_requires_admission_control(monkeypatch):
+    monkeypatch.setattr(admission, "_controller", None)
+    monkeypatch.setenv("ADMISSION_ENABLED", "false")
+    assert init_speculative_responder() is None
+    assert get_speculative_responder() is None
+
+    monkeypatch.setenv("ADMISSION_ENABLED", "true")
+    assert init_speculative_responder() is get_speculative_responder() is not None
+    await shutdown_speculative_responder()
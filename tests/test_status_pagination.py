@@ -0,0 +1,51 @@
+import os
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "medagent_test")
+
+import server  # noqa: E402
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def client(db, monkeypatch):
+    monkeypatch.setattr(server, "db", db)
+    start = datetime(2024, 1, 1)
+    await db.status_checks.insert_many([
+        {"id": f"id-{i:02d}", "client_name": f"c{i}", "timestamp": start + timedelta(seconds=i // 2)}
+        for i in range(10)
+    ])
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test") as c:
+        yield c
+
+
+async def _pages(client, order, cursor_param, header):
+    ids, params = [], {"limit": 3, "order": order}
+    while True:
+        response = await client.get("/api/status", params=params)
+        assert response.status_code == 200
+        ids.extend(item["id"] for item in response.json())
+        if header not in response.headers:
+            return ids
+        params = {"limit": 3, "order": order, cursor_param: response.headers[header],
+                  f"{cursor_param}_id": response.headers[f"{header}-Id"]}
+
+
+async def test_default_keeps_oldest_first_unpaged_list(client):
+    response = await client.get("/api/status")
+    assert [item["id"] for item in response.json()] == [f"id-{i:02d}" for i in range(10)]
+    assert "X-Next-After" not in response.headers
+
+
+async def test_ascending_pages_cover_every_item_once(client):
+    # Timestamp uguali a coppie: il cursore usa anche l'id
+    assert await _pages(client, "asc", "after", "X-Next-After") == [f"id-{i:02d}" for i in range(10)]
+
+
+async def test_descending_pages_cover_every_item_once(client):
+    assert await _pages(client, "desc", "before", "X-Next-Before") == [f"id-{i:02d}" for i in reversed(range(10))]
@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+from services.turn_coordinator import MongoLeaseLockBackend, TurnCoordinator
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_identical_inflight_messages_run_once():
+    coordinator = TurnCoordinator()
+    calls = 0
+    release = asyncio.Event()
+
+    async def turn():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return "risposta"
+
+    first = asyncio.create_task(coordinator.run("s1", "Ho la febbre", turn))
+    await asyncio.sleep(0)
+    # Stesso testo a meno di maiuscole e spazi: unito al turno in corso
+    second = asyncio.create_task(coordinator.run("s1", "  ho la  FEBBRE ", turn))
+    await asyncio.sleep(0)
+    release.set()
+
+    assert await asyncio.gather(first, second) == ["risposta", "risposta"]
+    assert calls == 1
+    assert not coordinator._inflight
+    assert not coordinator._locks
+
+
+async def test_different_messages_of_a_session_are_serialized_in_order():
+    coordinator = TurnCoordinator()
+    running = 0
+    max_running = 0
+    order = []
+
+    def make_turn(label):
+        async def turn():
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            order.append(label)
+            running -= 1
+            return label
+        return turn
+
+    results = await asyncio.gather(*(coordinator.run("s1", f"messaggio {i}", make_turn(i)) for i in range(4)))
+
+    assert results == [0, 1, 2, 3]
+    assert order == [0, 1, 2, 3]
+    assert max_running == 1
+
+
+async def test_other_sessions_are_not_blocked():
+    coordinator = TurnCoordinator()
+    release = asyncio.Event()
+
+    async def blocked():
+        await release.wait()
+        return "s1"
+
+    async def quick():
+        return "s2"
+
+    first = asyncio.create_task(coordinator.run("s1", "ciao", blocked))
+    await asyncio.sleep(0)
+    assert await asyncio.wait_for(coordinator.run("s2", "ciao", quick), timeout=1) == "s2"
+    release.set()
+    assert await first == "s1"
+
+
+async def test_failure_is_shared_with_duplicates_and_not_cached():
+    coordinator = TurnCoordinator()
+    release = asyncio.Event()
+
+    async def failing():
+        await release.wait()
+        raise RuntimeError("llm non disponibile")
+
+    first = asyncio.create_task(coordinator.run("s1", "ciao", failing))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(coordinator.run("s1", "ciao", failing))
+    await asyncio.sleep(0)
+    release.set()
+
+    results = await asyncio.gather(first, second, return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+    async def ok():
+        return "ok"
+
+    # Il turno fallito non resta in corso: lo stesso messaggio viene rieseguito
+    assert await coordinator.run("s1", "ciao", ok) == "ok"
+
+
+async def test_mongo_lease_is_exclusive_until_released(db):
+    backend = MongoLeaseLockBackend(db, lease_seconds=60)
+    token = await backend.try_acquire("s1")
+    assert token
+    assert await backend.try_acquire("s1") is None
+
+    await backend.release("s1", token)
+    assert await backend.try_acquire("s1")
+
+
+async def test_mongo_lease_is_renewed_while_turn_runs(db):
+    backend = MongoLeaseLockBackend(db, lease_seconds=0.06)
+    coordinator = TurnCoordinator(backend)
+    stolen = []
+
+    async def slow_turn():
+        # Senza rinnovo la lease scadrebbe a metà turno e un altro worker la otterrebbe
+        await asyncio.sleep(0.15)
+        stolen.append(await backend.try_acquire("s1"))
+        return "ok"
+
+    assert await coordinator.run("s1", "ciao", slow_turn) == "ok"
+    assert stolen == [None]
+    assert await db.session_leases.count_documents({}) == 0
+
+
+async def test_mongo_lease_renew_rejects_other_owner(db):
+    backend = MongoLeaseLockBackend(db, lease_seconds=60)
+    token = await backend.try_acquire("s1")
+
+    assert await backend.renew("s1", token)
+    assert not await backend.renew("s1", "altro-worker")
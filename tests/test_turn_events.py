@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from services.turn_events import TurnEventConsumer, TurnEventLog
+
+pytestmark = pytest.mark.anyio
+
+
+async def _write(log: TurnEventLog, offset: int, age: float = 0.0):
+    written_at = datetime.utcnow() - timedelta(seconds=age)
+    await log.events.insert_one({"_id": offset, "type": "turn", "session_id": f"s{offset % 2}",
+                                 "ts": written_at, "data": {}, "written_at": written_at})
+
+
+async def test_flush_assigns_contiguous_offsets(db):
+    log = TurnEventLog(db, batch_size=10)
+    for index in range(3):
+        log.emit("turn", "s1", {"index": index})
+    assert await log.flush() == 3
+    log.emit("close", "s1", {})
+    await log.flush()
+
+    events, next_offset = await log.read()
+    assert [event["_id"] for event in events] == [1, 2, 3, 4]
+    assert next_offset == 4 and await log.latest_offset() == 4
+
+
+async def test_read_stops_before_recent_gap(db):
+    # L'offset 3 è riservato da un altro worker che non l'ha ancora scritto
+    log = TurnEventLog(db, gap_grace=10.0)
+    for offset in (1, 2, 4, 5):
+        await _write(log, offset)
+
+    events, next_offset = await log.read()
+    assert [event["_id"] for event in events] == [1, 2]
+    assert next_offset == 2
+
+    await _write(log, 3)
+    events, next_offset = await log.read(after=next_offset)
+    assert [event["_id"] for event in events] == [3, 4, 5]
+    assert next_offset == 5
+
+
+async def _reserve(log: TurnEventLog, first: int, last: int, expires_in: float):
+    await log.reservations.insert_one({"_id": first, "last": last,
+                                       "expires_at": datetime.utcnow() + timedelta(seconds=expires_in)})
+
+
+async def test_read_skips_gap_older_than_grace(db):
+    # Buco senza riserva registrata (rimossa dal TTL): dopo gap_grace non blocca più i consumatori
+    log = TurnEventLog(db, gap_grace=10.0)
+    for offset in (1, 2, 4):
+        await _write(log, offset, age=60.0)
+
+    events, next_offset = await log.read()
+    assert [event["_id"] for event in events] == [1, 2, 4]
+    assert next_offset == 4
+
+
+async def test_read_waits_for_live_reservation_even_after_grace(db):
+    # Il writer dell'offset 3 sta riprovando da un minuto: la sua riserva è ancora valida
+    log = TurnEventLog(db, gap_grace=10.0)
+    for offset in (1, 2, 4):
+        await _write(log, offset, age=60.0)
+    await _reserve(log, 3, 3, expires_in=20.0)
+
+    events, next_offset = await log.read()
+    assert [event["_id"] for event in events] == [1, 2]
+    assert next_offset == 2
+
+
+async def test_read_skips_gap_with_expired_reservation(db):
+    # Writer morto: la riserva è scaduta e il buco si salta anche se gli eventi dopo sono recenti
+    log = TurnEventLog(db, gap_grace=10.0)
+    for offset in (1, 2, 5):
+        await _write(log, offset)
+    await _reserve(log, 3, 4, expires_in=-1.0)
+
+    events, next_offset = await log.read()
+    assert [event["_id"] for event in events] == [1, 2, 5]
+    assert next_offset == 5
+
+
+async def test_failed_flush_keeps_reservation_until_written(db, monkeypatch):
+    log = TurnEventLog(db, batch_size=10, reservation_lease=30.0)
+    log.emit("turn", "s1", {})
+    log.emit("turn", "s1", {})
+
+    async def failing_insert(*args, **kwargs):
+        raise RuntimeError("mongo non raggiungibile")
+
+    monkeypatch.setattr(log.events, "insert_many", failing_insert)
+    with pytest.raises(RuntimeError):
+        await log.flush()
+    reservation = await log.reservations.find_one({"_id": 1})
+    assert reservation["last"] == 2
+
+    # Il nuovo tentativo riusa gli stessi offset, rinnova la lease e la rimuove a scrittura riuscita
+    monkeypatch.undo()
+    assert await log.flush() == 2
+    assert await log.reservations.count_documents({}) == 0
+    events, _ = await log.read()
+    assert [event["_id"] for event in events] == [1, 2]
+
+
+async def test_filtered_read_ignores_gaps(db):
+    log = TurnEventLog(db, gap_grace=10.0)
+    for offset in (1, 2, 4, 5):
+        await _write(log, offset)
+
+    events, next_offset = await log.read(session_id="s1")
+    assert [event["_id"] for event in events] == [1, 5]
+    assert next_offset == 5
+
+
+async def test_consumer_commits_only_after_handler_and_never_goes_back(db):
+    log = TurnEventLog(db)
+    for offset in (1, 2, 3):
+        await _write(log, offset)
+    consumer = TurnEventConsumer(log, "analytics")
+
+    async def failing(events):
+        raise RuntimeError("handler fallito")
+
+    with pytest.raises(RuntimeError):
+        await consumer.run_once(failing)
+    assert await consumer.offset() == 0
+
+    seen = []
+
+    async def collect(events):
+        seen.extend(event["_id"] for event in events)
+
+    assert await consumer.run_once(collect, limit=2) == 2
+    await consumer.commit(1)
+    assert await consumer.offset() == 2
+    assert await consumer.run_once(collect) == 1
+    assert seen == [1, 2, 3]
@@ -0,0 +1,130 @@
+import os
+from datetime import datetime
+
+import pytest
+from pymongo.errors import ServerSelectionTimeoutError
+
+from services.write_behind import WriteBehindJournal, WriteBehindQueue, open_journal
+
+pytestmark = pytest.mark.anyio
+
+
+def _message(session_id: str, index: int) -> dict:
+    return {
+        "id": f"{session_id}-{index}",
+        "session_id": session_id,
+        "message_type": "user",
+        "content": f"messaggio {index}",
+        "timestamp": datetime(2024, 1, 1, 12, 0, index)
+    }
+
+
+class _UnreachableCollection:
+    async def bulk_write(self, *args, **kwargs):
+        raise ServerSelectionTimeoutError("mongo non raggiungibile")
+
+
+class _UnreachableDb:
+    messages = _UnreachableCollection()
+    chat_sessions = _UnreachableCollection()
+
+
+async def test_replay_does_not_increment_message_count_twice(db, tmp_path):
+    journal_path = str(tmp_path / "wb.journal")
+    await db.chat_sessions.insert_one({"session_id": "s1", "message_count": 0})
+
+    queue = WriteBehindQueue(db, WriteBehindJournal(journal_path))
+    for index in range(3):
+        await queue.enqueue_message(_message("s1", index))
+    await queue.flush_all()
+    queue.journal.close()
+
+    # Crash tra la scrittura su Mongo e il checkpoint: le stesse voci vengono riprodotte
+    os.remove(f"{journal_path}.checkpoint")
+    replay = WriteBehindQueue(db, WriteBehindJournal(journal_path))
+    await replay.start()
+    await replay.stop()
+
+    session = await db.chat_sessions.find_one({"session_id": "s1"})
+    assert session["message_count"] == 3
+    assert session["wb_applied"] == {replay.journal.writer_id: 3}
+    assert await db.messages.count_documents({"session_id": "s1"}) == 3
+
+
+async def test_later_batch_still_increments_after_replay(db, tmp_path):
+    await db.chat_sessions.insert_one({"session_id": "s1", "message_count": 0})
+    queue = WriteBehindQueue(db, WriteBehindJournal(str(tmp_path / "wb.journal")))
+    await queue.enqueue_message(_message("s1", 0))
+    await queue.flush_all()
+    await queue.enqueue_message(_message("s1", 1))
+    await queue.flush_all()
+    queue.journal.close()
+
+    session = await db.chat_sessions.find_one({"session_id": "s1"})
+    assert session["message_count"] == 2
+
+
+async def test_unreachable_mongo_keeps_journal_for_next_start(db, tmp_path):
+    journal_path = str(tmp_path / "wb.journal")
+    queue = WriteBehindQueue(_UnreachableDb(), WriteBehindJournal(journal_path), flush_attempts=2, retry_delay=0)
+    await queue.start()
+    await queue.enqueue_message(_message("s1", 0))
+    # Lo spegnimento non solleva eccezioni e non avanza il checkpoint
+    await queue.stop()
+
+    unreachable_start = WriteBehindQueue(_UnreachableDb(), WriteBehindJournal(journal_path),
+                                         flush_attempts=2, retry_delay=0)
+    await unreachable_start.start()
+    assert unreachable_start.pending_messages("s1")
+    await unreachable_start.stop()
+
+    await db.chat_sessions.insert_one({"session_id": "s1", "message_count": 0})
+    recovered = WriteBehindQueue(db, WriteBehindJournal(journal_path))
+    await recovered.start()
+    await recovered.stop()
+    assert await db.messages.count_documents({"session_id": "s1"}) == 1
+
+
+async def test_flush_reactivates_abandoned_session(db, tmp_path):
+    await db.chat_sessions.insert_one({"session_id": "s1", "message_count": 0, "status": "abandoned",
+                                       "end_time": datetime(2024, 1, 1)})
+    queue = WriteBehindQueue(db, WriteBehindJournal(str(tmp_path / "wb.journal")))
+    await queue.enqueue_message(_message("s1", 0))
+    await queue.flush_all()
+    queue.journal.close()
+
+    session = await db.chat_sessions.find_one({"session_id": "s1"})
+    assert session["status"] == "active"
+    assert "end_time" not in session
+
+
+async def test_workers_with_own_journals_all_count(db, tmp_path):
+    # Sequenze indipendenti per journal: la sequenza più alta di un worker non blocca gli altri
+    await db.chat_sessions.insert_one({"session_id": "s1", "message_count": 0})
+    base_path = str(tmp_path / "wb.journal")
+    first, second = WriteBehindQueue(db, open_journal(base_path)), WriteBehindQueue(db, open_journal(base_path))
+    assert first.journal.path != second.journal.path
+    assert first.journal.writer_id != second.journal.writer_id
+
+    for index in range(5):
+        await first.enqueue_message(_message("s1", index))
+    await first.flush_all()
+    await second.enqueue_message(_message("s1", 10))
+    await second.flush_all()
+    first.journal.close()
+    second.journal.close()
+
+    session = await db.chat_sessions.find_one({"session_id": "s1"})
+    assert session["message_count"] == 6
+
+
+async def test_closed_journal_slot_is_reused(tmp_path):
+    base_path = str(tmp_path / "wb.journal")
+    journal = open_journal(base_path)
+    writer_id = journal.writer_id
+    journal.close()
+
+    reopened = open_journal(base_path)
+    assert reopened.path == base_path
+    assert reopened.writer_id == writer_id
+    reopened.close()